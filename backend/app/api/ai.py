@@ -1,65 +1,149 @@
-import tempfile
-import os
-from fastapi import Request, Depends, APIRouter, HTTPException
-from app.services.pdf_service import extract_text_from_pdf, summarize_text
-from app.services.gmail_service import get_message, get_attachment
-from app.services.ai_service import analyze_email_content, generate_email_response
-from app.api.emails import get_gmail_service
+import json
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
+from fastapi import Request, Depends, APIRouter, HTTPException, status
+from fastapi.responses import StreamingResponse
+from app.services.gmail_service import list_message_ids
+from app.services.attachment_service import process_pdf_attachments, select_pdf_text, \
+    attachment_report
+from app.services.message_store import load_message
+from app.services.ai_service import analyze_email_content, generate_email_response, \
+    stream_email_analysis, stream_email_response, finish_analysis, build_analysis_messages, \
+    build_response_messages, PDF_CONTEXT_CHARS
+from app.services.prompt_builder import attachment_token_budget, count_message_tokens
+from app.services.ai_cache import get_ai_cache
+from app.services.batch_service import start_analysis_job, BATCH_MAX_EMAILS
+from app.services.thread_analysis_service import analyze_thread
+from app.services.job_store import get_job_store
+from app.services.prefetch_service import prefetcher
+from app.services.executor import run_in_thread
+from app.api.emails import get_gmail_service, get_account, http_error
 
 
 router = APIRouter()
 
 
+class BatchAnalyzeRequest(BaseModel):
+    """Emails to analyze in bulk, either by Gmail query or by id, up to BATCH_MAX_EMAILS."""
+    query: Optional[str] = None
+    ids: Optional[List[str]] = Field(None, max_length=BATCH_MAX_EMAILS)
+    max_results: int = Field(50, ge=1, le=BATCH_MAX_EMAILS)
+    include_attachments: bool = True
+    mode: Literal["auto", "concurrent", "batch_api"] = "auto"
+
+
+async def load_email_with_pdfs(service, account, email_id, include_attachments):
+    """
+    Load an email and extract text from all of its PDF attachments in parallel.
+
+    Returns:
+        Tuple of (email data, per-attachment results)
+    """
+    email_data = await run_in_thread(load_message, service, account, email_id)
+    if not include_attachments:
+        return email_data, []
+
+    results = await process_pdf_attachments(service, account, email_data, PDF_CONTEXT_CHARS)
+    return email_data, results
+
+
+def pdf_errors(results):
+    """Combine per-attachment errors into one message, or None if all succeeded."""
+    errors = [f"{r['filename']}: {r['error']}" for r in results if "error" in r]
+    return "; ".join(errors) if errors else None
+
+
+def analysis_payload(analysis, results):
+    """Build the analyze response body from the analysis and attachment results."""
+    summaries = [r["info"] for r in results if r["info"]]
+    payload = {
+        "email_analysis": analysis,
+        "pdf_summary": summaries[0] if summaries else None,
+        "pdf_summaries": summaries,
+        "attachments": attachment_report(results),
+    }
+    if pdf_errors(results):
+        payload["error"] = pdf_errors(results)
+    return payload
+
+
+def sse_event(event: str, data) -> str:
+    """Format a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events) -> StreamingResponse:
+    """Wrap an async generator of SSE strings in a streaming response."""
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/analyze/{email_id}")
 async def analyze_email(
     email_id: str,
     request: Request,
     service=Depends(get_gmail_service),
+    account: str = Depends(get_account),
     include_attachments: bool = True,
+    refresh: bool = False,
 ):
     """Analyze an email and its attachments using AI"""
     try:
-        # get the email
-        email_data = get_message(service, email_id)
-        
-        # process attachments if requested and available
-        if include_attachments and email_data.get("attachments"):
-            for attachment in email_data["attachments"]:
-                # check if attachment is a PDF
-                if attachment["mimeType"] == "application/pdf":
-                    # Download the attachment
-                    attachment_data = get_attachment(service, email_id, attachment["id"])
-
-                    # create a temporary file to store the PDF
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                        temp_file.write(attachment_data)
-                        temp_path = temp_file.name
-
-                    try:
-                        # Extract text from the PDF
-                        pdf_text = extract_text_from_pdf(temp_path)
-                        pdf_summary = summarize_text(temp_path)
-                    except Exception as e:
-                        return {
-                            "error": f"Error processing PDF: {str(e)}",
-                            "email_analysis": analyze_email_content(email_data)
-                        }
-                    finally:
-                        # clean up the temporary file
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
-                    
-                    # we only process the first pdf attachment for now
-                    break
+        email_data, results = await load_email_with_pdfs(
+            service, account, email_id, include_attachments
+        )
 
         # generate ai analysis
-        analysis = analyze_email_content(email_data, pdf_text)
-        return {
-            "email_analysis": analysis,
-            "pdf_summary": pdf_summary
-        }
+        pdf_text = await select_pdf_text(email_data, results, attachment_token_budget(email_data))
+        messages = build_analysis_messages(email_data, pdf_text)
+        analysis = await analyze_email_content(messages, force_refresh=refresh)
+        return analysis_payload(analysis, results)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+
+@router.get("/analyze/{email_id}/stream")
+async def analyze_email_stream(
+    email_id: str,
+    request: Request,
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account),
+    include_attachments: bool = True,
+    refresh: bool = False,
+):
+    """
+    Stream an email analysis as Server-Sent Events.
+
+    Emits `token` events with deltas of the analysis JSON, then one `analysis`
+    event with the validated result (summary, key_points, action_items,
+    suggested_response).
+    """
+    try:
+        email_data, results = await load_email_with_pdfs(
+            service, account, email_id, include_attachments
+        )
+    except Exception as e:
+        raise http_error(e)
+    pdf_text = await select_pdf_text(email_data, results, attachment_token_budget(email_data))
+    messages = build_analysis_messages(email_data, pdf_text)
+
+    async def events():
+        chunks = []
+        try:
+            async for delta in stream_email_analysis(messages, force_refresh=refresh):
+                chunks.append(delta)
+                yield sse_event("token", {"text": delta})
+        except Exception as e:
+            yield sse_event("error", {"error": f"Error generating AI analysis: {str(e)}"})
+            return
+        analysis = await finish_analysis(messages, "".join(chunks))
+        analysis["prompt_tokens"] = count_message_tokens(messages)
+        yield sse_event("analysis", analysis_payload(analysis, results))
+
+    return sse_response(events())
     
 
 @router.get("/generate-response/{email_id}")
@@ -67,46 +151,139 @@ async def generate_response(
     email_id: str,
     request: Request,
     include_attachments: bool = True,
-    service=Depends(get_gmail_service)
+    refresh: bool = False,
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account)
 ):
     """
     Generate an email response using AI
     """
     try:
-        email_data = get_message(service, email_id)
-        
-        # process attachments if requested and available
-        if include_attachments and email_data.get("attachments"):
-            for attachment in email_data["attachments"]:
-                # check if attachment is a PDF
-                if attachment["mimeType"] == "application/pdf":
-                    # download the attachment
-                    attachment_data = get_attachment(service, email_id, attachment["id"])
-
-                    # create a temporary file to store the PDF
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                        temp_file.write(attachment_data)
-                        temp_path = temp_file.name
-
-                    try:
-                        # Extract text from the pdf
-                        pdf_text = extract_text_from_pdf(temp_path)
-                    except Exception as e:
-                        return {
-                            "error": f"Error processing PDF: {str(e)}",
-                            "response": generate_email_response(email_data)
-                        }
-                    finally:
-                        # clean up the temporary file
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
-                # we only process the first pdf attachment for now
-                break
+        email_data, results = await load_email_with_pdfs(
+            service, account, email_id, include_attachments
+        )
     
         # generate ai response
-        response = generate_email_response(email_data, pdf_text)
-        return {
-            "response": response
+        pdf_text = await select_pdf_text(email_data, results, attachment_token_budget(email_data))
+        messages = build_response_messages(email_data, pdf_text)
+        response = await generate_email_response(messages, force_refresh=refresh)
+        payload = {
+            "response": response,
+            "prompt_tokens": count_message_tokens(messages),
+            "attachments": attachment_report(results)
         }
+        if pdf_errors(results):
+            payload["error"] = pdf_errors(results)
+        return payload
+    except Exception as e:
+        raise http_error(e)
+
+
+@router.get("/generate-response/{email_id}/stream")
+async def generate_response_stream(
+    email_id: str,
+    request: Request,
+    include_attachments: bool = True,
+    refresh: bool = False,
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account)
+):
+    """
+    Stream a generated email response as Server-Sent Events.
+
+    Emits `token` events with text deltas, then one `response` event with the full text.
+    """
+    try:
+        email_data, results = await load_email_with_pdfs(
+            service, account, email_id, include_attachments
+        )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise http_error(e)
+    pdf_text = await select_pdf_text(email_data, results, attachment_token_budget(email_data))
+    messages = build_response_messages(email_data, pdf_text)
+
+    async def events():
+        chunks = []
+        try:
+            async for delta in stream_email_response(messages, force_refresh=refresh):
+                chunks.append(delta)
+                yield sse_event("token", {"text": delta})
+        except Exception as e:
+            yield sse_event("error", {"error": f"Error generating email response: {str(e)}"})
+            return
+        yield sse_event("response", {
+            "response": "".join(chunks),
+            "prompt_tokens": count_message_tokens(messages),
+            "attachments": attachment_report(results)
+        })
+
+    return sse_response(events())
+
+
+@router.get("/analyze-thread/{thread_id}")
+async def analyze_email_thread(
+    thread_id: str,
+    request: Request,
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account),
+    refresh: bool = False,
+):
+    """
+    Summarize a thread message by message, folding new replies into the stored summary.
+    """
+    try:
+        return await analyze_thread(service, account, thread_id, force_refresh=refresh)
+    except Exception as e:
+        raise http_error(e)
+
+
+@router.post("/batch", status_code=status.HTTP_202_ACCEPTED)
+async def create_batch_analysis(
+    body: BatchAnalyzeRequest,
+    request: Request,
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account)
+):
+    """
+    Start analyzing many emails in the background and return a job id to poll.
+    """
+    if body.ids is None and body.query is None:
+        raise HTTPException(status_code=400, detail="Provide either query or ids")
+
+    try:
+        if body.ids is not None:
+            ids = body.ids
+        else:
+            ids = await run_in_thread(list_message_ids, service, body.query, body.max_results)
+    except Exception as e:
+        raise http_error(e)
+
+    # drop duplicates but keep the requested order
+    ids = list(dict.fromkeys(ids))
+    job = await run_in_thread(get_job_store().create, account, "analyze", len(ids), mode=body.mode)
+    start_analysis_job(job["id"], service, account, ids, body.include_attachments, body.mode)
+    return {"job_id": job["id"], "status": job["status"], "total": job["total"]}
+
+
+@router.get("/batch/{job_id}")
+async def get_batch_analysis(job_id: str, account: str = Depends(get_account)):
+    """
+    Get the progress and results of a batch analysis job.
+    """
+    job = await run_in_thread(get_job_store().get, job_id)
+    if job is None or job["account"] != account:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job.pop("account")
+    return job
+
+
+@router.get("/cache/stats")
+async def ai_cache_stats(account: str = Depends(get_account)):
+    """Hit rate and tokens saved by the AI response cache"""
+    return get_ai_cache().stats()
+
+
+@router.get("/prefetch/stats")
+async def prefetch_stats(account: str = Depends(get_account)):
+    """Progress and token usage of the background prefetch worker"""
+    return prefetcher.stats()
@@ -2,6 +2,8 @@ import os
 from fastapi import APIRouter, Request, status, HTTPException
 from fastapi.responses import RedirectResponse
 from app.services.gmail_service import create_flow, credentials_to_dict
+from app.services.service_cache import service_cache
+from app.services.prefetch_service import prefetcher
 
 
 router = APIRouter()
@@ -40,6 +42,8 @@ async def oauth2callback(request: Request):
     creds_dict = credentials_to_dict(credentials)
 
     request.session["credentials"] = creds_dict
+    # issue a new session id now that the session is authenticated
+    request.scope["regenerate_session"] = True
     
     # redirect to frontend or API homepage
     frontend_url = os.getenv("FRONTEND_URL")
@@ -49,6 +53,9 @@ async def oauth2callback(request: Request):
 @router.get("/logout")
 async def logout(request: Request):
     """Clear the user's session"""
+    if "credentials" in request.session:
+        service_cache.invalidate(request.session["credentials"])
+    prefetcher.unregister(request.session.get("account"))
     request.session.clear()
     frontend_url = os.getenv("FRONTEND_URL")
     return RedirectResponse(url=frontend_url)
@@ -1,11 +1,85 @@
-from fastapi import APIRouter, Request, HTTPException, Depends, status
-from app.services.gmail_service import build_service, get_thread, list_messages, \
-    get_message, get_attachment, list_threads
-import os
+import json
+import math
+import base64
+import hashlib
+import secrets
+import binascii
+from typing import Dict, Literal, Optional
+from fastapi import APIRouter, Request, HTTPException, Depends, Query, status
+from fastapi.responses import StreamingResponse, Response, FileResponse
+from app.services.gmail_service import get_profile, credentials_to_dict
+from app.services.message_store import load_message, load_thread, load_list, search_messages, thread_history_id
+from app.services.projection import parse_fields, project
+from app.services.pagination import iter_previews
+from app.services.attachment_store import load_attachment
+from app.services.service_cache import service_cache
+from app.services.prefetch_service import prefetcher, PREFETCH_ENABLED, PUSH_WEBHOOK_TOKEN
+from app.services.executor import run_in_thread
+from app.services.resilience import UpstreamUnavailable
+from app.responses import FastJSONResponse
 
 router = APIRouter()
 
 
+def http_error(e: Exception) -> HTTPException:
+    """
+    Turn an error raised while handling a request into an HTTP error.
+
+    Gmail or OpenAI being rate limited or down is a 503 with Retry-After, so
+    clients can back off; anything else is a 500.
+    """
+    if isinstance(e, UpstreamUnavailable):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+    return HTTPException(status_code=500, detail=str(e))
+
+
+def selection_for(fields: Optional[str]) -> Optional[Dict]:
+    """Parse a fields= selector, answering a malformed one with 400."""
+    try:
+        return parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid fields: {e}")
+
+
+def weak_etag(*parts) -> str:
+    """
+    Build a weak ETag from the parts that identify a representation.
+
+    Weak, because compression changes the bytes but not the content.
+    """
+    digest = hashlib.sha256(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether If-None-Match names this ETag, compared weakly."""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
+
+
+def conditional_json(request: Request, data, etag: Optional[str]) -> Response:
+    """
+    Answer with 304 Not Modified if the client already has this version, the JSON otherwise.
+
+    Clients must revalidate every time (no-cache), so they never show a stale copy.
+    """
+    headers = {"Cache-Control": "private, no-cache"}
+    if etag is not None:
+        headers["ETag"] = etag
+        if etag_matches(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FastJSONResponse(data, headers=headers)
+
+
 async def get_gmail_service(request: Request):
     """
     Get an authenticated Gmail service or raise an error.
@@ -16,143 +90,231 @@ async def get_gmail_service(request: Request):
             detail="Not authenticated",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    return build_service(request.session["credentials"])
+    credentials_dict = request.session["credentials"]
+    service = await run_in_thread(service_cache.get, credentials_dict)
+
+    # keep the session in sync with tokens refreshed by the cache
+    credentials = service_cache.get_credentials(credentials_dict)
+    if credentials is not None and credentials.token != credentials_dict.get("token"):
+        request.session["credentials"] = credentials_to_dict(credentials)
+    return service
+
+
+async def get_account(request: Request, service=Depends(get_gmail_service)):
+    """
+    Get the mailbox email address for the session, used to scope cached data.
+    """
+    if "account" not in request.session:
+        profile = await run_in_thread(get_profile, service)
+        request.session["account"] = profile["emailAddress"]
+    if PREFETCH_ENABLED:
+        prefetcher.register(request.session["account"], request.session["credentials"])
+    return request.session["account"]
+
+
+def ndjson_response(rows) -> StreamingResponse:
+    """
+    Stream an async iterator of dicts as newline-delimited JSON.
+
+    The status is sent before the first row, so a failure part way through
+    ends the stream with an {"error": ..., "status": ...} row instead.
+    """
+    async def lines():
+        try:
+            async for row in rows:
+                yield json.dumps(row) + "\n"
+        except Exception as e:
+            error = http_error(e)
+            yield json.dumps({"error": error.detail, "status": error.status_code}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @router.get("/emails")
 async def list_emails(
     request: Request,
     service=Depends(get_gmail_service),
+    account: str = Depends(get_account),
     query: str="has:attachment filename:pdf",
-    max_results: int=10
+    max_results: int = Query(10, ge=1, le=500),
+    page_token: Optional[str]=None,
+    stream: bool=False,
+    limit: int = Query(500, ge=1, le=500)
 ):
-    """List emails matching the query."""
+    """
+    List emails matching the query.
+
+    Returns one page and its nextPageToken, or with stream=true walks pages of
+    max_results as NDJSON rows (up to limit), ending with a {"nextPageToken"} row.
+    """
+    if stream:
+        return ndjson_response(
+            iter_previews(service, account, 'messages', query, max_results, limit, page_token)
+        )
     try:
-        messages = list_messages(service, query, max_results)
-
-        # get basic details for each message
-        detailed_messages = []
-        for message in messages:
-            message_detail = service.users().messages().get(
-                userId='me', id=message['id'], format='metadata'
-            ).execute()
-
-            # Extract subject and sender
-            headers = {}
-            for header in message_detail.get('payload', {}).get('headers', []):
-                if header['name'].lower() in ['subject', 'from', 'date']:
-                    headers[header['name'].lower()] = header['value']
-            
-            detailed_messages.append({
-                'id': message['id'],
-                'threadId': message['threadId'],
-                'subject': headers.get('subject', '(No subject)'),
-                'from': headers.get('from', ''),
-                'date': headers.get('date', '')
-            })
-        return {"messages": detailed_messages}
+        page = await run_in_thread(load_list, service, account, 'messages', query, max_results, page_token)
+        return {"messages": page["items"], "nextPageToken": page["nextPageToken"]}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
     
 
 @router.get("/emails/{email_id}")
 async def get_email(
     request: Request,
     email_id: str,
-    service=Depends(get_gmail_service)
+    fields: Optional[str] = None,
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account)
 ):
-    """Get a specific email by ID."""
+    """
+    Get a specific email by ID.
+
+    fields selects parts of the message, e.g. fields=headers(Subject,From),preview
+    for the headers and a plain text preview instead of the HTML body.
+    Messages never change once sent, so a matching If-None-Match is answered
+    with 304 without loading the message at all.
+    """
+    selection = selection_for(fields)
+    etag = weak_etag("message", account, email_id, fields or "")
+    if etag_matches(request, etag):
+        return conditional_json(request, None, etag)
     try:
-        email_data = get_message(service, email_id)
-        return email_data
+        email_data = await run_in_thread(load_message, service, account, email_id)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+    return conditional_json(request, project(email_data, selection), etag)
     
 
-@router.get("/emails/{email_id}/attachments/{attachments_id}")
+@router.get("/emails/{email_id}/attachments/{attachment_id}")
 async def download_attachment(
     email_id: str,
     attachment_id: str,
     request: Request,
-    service=Depends(get_gmail_service)
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account)
 ):
-    """Download an attachment"""
+    """
+    Download an attachment, streamed from the attachment store (supports Range requests).
+    """
     try:
-        attachment_data = get_attachment(service, email_id, attachment_id)
-
-        # get email to find filename
-        email_data = get_message(service, email_id)
-        attachment_info = next(
-            (a for a in email_data["attachments"] if a["id"] == attachment_id),
-            {'filename': 'attachmebt.bin'}
-        )
-
-        # create attachments dir if it does not exist
-        os.makedirs("attachments", exist_ok=True)
-
-        file_path = f"attachments/{attachment_info['filename']}"
-        with open(file_path, "wb") as f:
-            f.write(attachment_data)
-
-        return {"message": "Attachment download", "path": file_path}
+        attachment = await run_in_thread(load_attachment, service, account, email_id, attachment_id)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+    return FileResponse(
+        attachment["path"],
+        media_type=attachment["mimeType"],
+        filename=attachment["filename"],
+        headers={
+            # blobs are content-addressed, so the hash is a strong validator
+            "ETag": f'"{attachment["sha256"]}"',
+            "Cache-Control": "private, max-age=86400",
+        }
+    )
     
 
 @router.get("/threads")
 async def list_email_threads(
     request: Request,
     service=Depends(get_gmail_service),
+    account: str = Depends(get_account),
     query: str="has:attachment filename:pdf",
-    max_results: int=10
+    max_results: int = Query(10, ge=1, le=500),
+    page_token: Optional[str]=None,
+    stream: bool=False,
+    limit: int = Query(500, ge=1, le=500)
 ):
     """
     List email threads matching the query.
+
+    Supports the same page_token / stream=true cursor paging as /emails.
     """
+    if stream:
+        return ndjson_response(
+            iter_previews(service, account, 'threads', query, max_results, limit, page_token)
+        )
     try:
-        threads = list_threads(service, query, max_results)
-        
-        # get basic details for each thread
-        thread_previews = []
-        for thread in threads:
-            thread_detail = service.users().threads().get(
-                userId='me', id=thread['id'], format='metadata'
-            ).execute()
-
-            # use the most recent message in the thread for preview
-            if thread_detail.get('messages'):
-                latest_message = thread_detail['messages'][-1]
-
-                # extract subject and sender
-                headers = {}
-                for header in latest_message.get('payload', {}).get('headers', []):
-                    if header['name'].lower() in ['subject', 'from', 'date']:
-                        headers[header['name'].lower()] = header['value']
-                
-                thread_previews.append({
-                    'id': thread['id'],
-                    'subject': headers.get('subject', '(No subject)'),
-                    'from': headers.get('from', ''),
-                    'date': headers.get('date', ''),
-                    'snippet': thread.get('snippet', ''),
-                    'messageCount': len(thread_detail.get('messages', []))
-                })
-        return {"threads": thread_previews}
+        page = await run_in_thread(load_list, service, account, 'threads', query, max_results, page_token)
+        return {"threads": page["items"], "nextPageToken": page["nextPageToken"]}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 @router.get("/threads/{thread_id}")
 async def get_email_thread(
     request: Request,
     thread_id: str,
-    service=Depends(get_gmail_service)
+    fields: Optional[str] = None,
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account)
 ):
     """
     Get a complete email thread by ID.
+
+    fields selects parts of the thread, e.g. fields=id,messages(id,headers,preview).
+    The ETag comes from the thread's Gmail historyId, so once history sync
+    confirms the stored copy is current, a matching If-None-Match is answered
+    with 304 without loading the thread or asking Gmail for it.
     """
+    selection = selection_for(fields)
     try:
-        thread_data = get_thread(service, thread_id)
-        return thread_data
+        history_id = await run_in_thread(thread_history_id, service, account, thread_id)
+        if history_id is not None:
+            etag = weak_etag("thread", account, thread_id, history_id, fields or "")
+            if etag_matches(request, etag):
+                return conditional_json(request, None, etag)
+        thread_data = await run_in_thread(load_thread, service, account, thread_id)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise http_error(e)
+    history_id = thread_data.get("historyId")
+    etag = weak_etag("thread", account, thread_id, history_id, fields or "") if history_id else None
+    return conditional_json(request, project(thread_data, selection), etag)
+
+
+@router.get("/search")
+async def search(
+    request: Request,
+    q: str,
+    scope: Literal["all", "messages", "attachments"] = "all",
+    limit: int = Query(20, ge=1, le=100),
+    service=Depends(get_gmail_service),
+    account: str = Depends(get_account)
+):
+    """
+    Full-text search over locally stored emails and extracted attachment text.
+
+    Answered from the local index without asking Gmail. Messages are indexed
+    once fetched or seen by history sync; attachment text once it has been
+    extracted for analysis.
+    """
+    try:
+        hits = await run_in_thread(search_messages, service, account, q, scope, limit)
+        return {"query": q, "results": hits}
+    except Exception as e:
+        raise http_error(e)
+
+
+@router.post("/gmail/push", status_code=status.HTTP_204_NO_CONTENT)
+async def gmail_push(request: Request, token: Optional[str] = None):
+    """
+    Receive Gmail push notifications from a Cloud Pub/Sub push subscription.
+
+    The subscription's endpoint must carry ?token=PUSH_WEBHOOK_TOKEN. A
+    notification makes the prefetch worker poll that mailbox right away.
+    """
+    if not PUSH_WEBHOOK_TOKEN:
+        raise HTTPException(status_code=404, detail="Push notifications are not enabled")
+    # bytes, since compare_digest rejects non-ASCII str
+    if not secrets.compare_digest((token or "").encode(), PUSH_WEBHOOK_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid token")
+
+    try:
+        envelope = await request.json()
+        notification = json.loads(base64.b64decode(envelope["message"]["data"]))
+        account = notification["emailAddress"]
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid Pub/Sub message")
+
+    # acknowledge unknown mailboxes too, or Pub/Sub keeps redelivering
+    prefetcher.notify(account)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
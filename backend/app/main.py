@@ -1,19 +1,49 @@
 import os
 os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
-from fastapi import FastAPI
+import time
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.sessions import SessionMiddleware
 from dotenv import load_dotenv
 from .api import auth, emails, ai
+from .services import executor, metrics
+from .services.session_store import get_session_store
+from .middleware import ServerSessionMiddleware, CompressionMiddleware
+from .responses import FastJSONResponse
+from .services.prefetch_service import prefetcher, PREFETCH_ENABLED
+from .services.resilience import UpstreamUnavailable
+from .services.shared_state import WEB_CONCURRENCY
 
 
 load_dotenv()
 
-app = FastAPI(title="Email Digital Twin APP")
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PREFETCH_ENABLED and WEB_CONCURRENCY > 1:
+        # the worker's mailboxes live in process memory, every worker would poll its own subset
+        logger.warning("Prefetching is disabled with %d workers, run a single worker to use it", WEB_CONCURRENCY)
+    elif PREFETCH_ENABLED:
+        prefetcher.start()
+    # with several workers, /metrics adds up what each one publishes
+    metrics.start_publishing()
+    yield
+    await prefetcher.stop()
+    metrics.stop_publishing()
+    # stop the Gmail thread pool and PDF process pool
+    executor.shutdown()
+
+
+app = FastAPI(title="Email Digital Twin APP", lifespan=lifespan, default_response_class=FastJSONResponse)
+# the session cookie only holds an id, credentials stay server-side
 app.add_middleware(
-    SessionMiddleware,
-    secret_key=os.getenv("SESSION_SECRET_KEY"),
+    ServerSessionMiddleware,
+    store=get_session_store(),
 )
 app.add_middleware(
     CORSMiddleware,
@@ -22,6 +52,51 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# long threads are megabytes of JSON, compress them with brotli or gzip
+app.add_middleware(CompressionMiddleware)
+
+
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable(request: Request, exc: UpstreamUnavailable):
+    """Answer Gmail or OpenAI being unavailable outside a route's own error handling with a 503."""
+    error = emails.http_error(exc)
+    return JSONResponse({"detail": error.detail}, status_code=error.status_code, headers=error.headers)
+
+
+def route_template(request: Request) -> str:
+    """
+    Get the request path with path parameters put back as {name}, keeping ids out of metric labels.
+    """
+    if request.scope.get("route") is None:
+        return "unmatched"
+    params = {str(value): name for name, value in request.path_params.items()}
+    return "/".join(
+        "{" + params[segment] + "}" if segment in params else segment
+        for segment in request.url.path.split("/")
+    )
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """Count and time every request, optionally reporting stage timings in Server-Timing."""
+    timings = metrics.start_request_timings()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        metrics.ERRORS.inc(stage="http")
+        raise
+    elapsed = time.perf_counter() - start
+
+    path = route_template(request)
+    metrics.HTTP_REQUESTS.inc(method=request.method, route=path, status=response.status_code)
+    metrics.HTTP_REQUEST_DURATION.observe(elapsed, method=request.method, route=path)
+    if response.status_code >= 500:
+        metrics.ERRORS.inc(stage="http")
+    if metrics.SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings, elapsed)
+    return response
+
 
 # include routers
 app.include_router(auth.router, tags=["Authentication"])
@@ -33,6 +108,13 @@ app.include_router(ai.router, prefix="/api/ai", tags=["AI"])
 async def root():
     return {"message": "Email Digital Twin API"}
 
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus metrics"""
+    # reads the other workers' metrics files
+    return PlainTextResponse(await executor.run_in_thread(metrics.render), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
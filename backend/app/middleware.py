@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import logging
+from functools import partial
+from typing import Callable, Optional
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import HTTPConnection
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.services.session_store import SessionStore, new_session_id, SESSION_MAX_AGE, SESSION_PURGE_INTERVAL
+from app.services.executor import run_in_thread
+
+try:
+    import brotli
+except ImportError:  # optional, responses are gzipped without it
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+# responses smaller than this are sent uncompressed
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "500"))
+# fast settings suited to compressing every response on the fly
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+# body chunks at least this big are compressed in the thread pool
+COMPRESSION_THREAD_MINIMUM_SIZE = 128 * 1024
+# only text compresses well; attachments and SSE (tiny, latency-sensitive) are left alone
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/plain", "text/html")
+
+
+class ServerSessionMiddleware:
+    """
+    Session middleware that keeps session data server-side.
+
+    A drop-in for Starlette's SessionMiddleware: handlers still use
+    request.session, but the cookie only carries an opaque session id and the
+    data lives in a SessionStore. The store is only written when the session
+    actually changed during the request. Setting scope["regenerate_session"]
+    moves the session to a fresh id, e.g. on login to prevent session fixation.
+
+    Store calls are blocking (SQLite, Redis), so they run in the thread pool.
+    Every SESSION_PURGE_INTERVAL a request also starts removing expired
+    sessions in the background.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        store: SessionStore,
+        session_cookie: str = "session",
+        max_age: int = SESSION_MAX_AGE,
+        path: str = "/",
+        same_site: str = "lax",
+        https_only: bool = False,
+    ):
+        self.app = app
+        self.store = store
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.path = path
+        self.security_flags = "httponly; samesite=" + same_site
+        if https_only:
+            self.security_flags += "; secure"
+        self._purged_at = time.monotonic()
+        self._purge_task = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        self.purge_if_due()
+        session_id = HTTPConnection(scope).cookies.get(self.session_cookie)
+        data = await run_in_thread(self.store.get, session_id) if session_id else None
+        if data is None:
+            # unknown or expired ids are never reused, a new one is issued on write
+            session_id = None
+            data = {}
+        scope["session"] = data
+        # nested values can change in place, so compare the serialised session
+        initial = json.dumps(data, sort_keys=True)
+
+        async def send_wrapper(message: Message):
+            nonlocal session_id, initial
+            if message["type"] == "http.response.start":
+                session = scope["session"]
+                if scope.get("regenerate_session") and session_id is not None:
+                    await run_in_thread(self.store.delete, session_id)
+                    session_id = None
+                    initial = None
+                if json.dumps(session, sort_keys=True) != initial:
+                    headers = MutableHeaders(scope=message)
+                    if session:
+                        if session_id is None:
+                            session_id = new_session_id()
+                        await run_in_thread(self.store.set, session_id, session, self.max_age)
+                        headers.append("Set-Cookie", self.cookie(session_id, f"Max-Age={self.max_age}"))
+                    elif session_id is not None:
+                        # the session was cleared
+                        await run_in_thread(self.store.delete, session_id)
+                        headers.append(
+                            "Set-Cookie", self.cookie("null", "expires=Thu, 01 Jan 1970 00:00:00 GMT")
+                        )
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def cookie(self, value: str, lifetime: str) -> str:
+        return f"{self.session_cookie}={value}; path={self.path}; {lifetime}; {self.security_flags}"
+
+    def purge_if_due(self):
+        """Start removing expired sessions if the last purge was SESSION_PURGE_INTERVAL ago."""
+        if time.monotonic() - self._purged_at < SESSION_PURGE_INTERVAL:
+            return
+        if self._purge_task is not None and not self._purge_task.done():
+            return
+        self._purged_at = time.monotonic()
+        self._purge_task = asyncio.create_task(self._purge())
+
+    async def _purge(self):
+        try:
+            await run_in_thread(self.store.purge_expired)
+        except Exception as e:
+            logger.warning("Could not purge expired sessions: %s", e)
+
+
+class _GzipEncoder:
+    """gzip stream for one response."""
+
+    content_encoding = "gzip"
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        # streamed chunks are flushed so NDJSON rows still arrive as they are produced
+        if more_body:
+            return self._compressor.compress(body) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self._compressor.compress(body) + self._compressor.flush()
+
+
+class _BrotliEncoder:
+    """Brotli stream for one response."""
+
+    content_encoding = "br"
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        if more_body:
+            return self._compressor.process(body) + self._compressor.flush()
+        return self._compressor.process(body) + self._compressor.finish()
+
+
+class _CompressionResponder:
+    """
+    Sends one response through an encoder, using only the ASGI send interface.
+
+    The start message is held back until the first body chunk shows whether
+    the response is worth compressing: COMPRESSIBLE_TYPES only, not already
+    encoded or partial, and at least minimum_size unless it is streamed.
+    Without an encoder (the client accepts neither brotli nor gzip) bodies are
+    sent as is, but compressible responses still get Vary: Accept-Encoding.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int, new_encoder: Optional[Callable] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.new_encoder = new_encoder
+        self.encoder = None
+        self.send = None
+        self.start = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        kind = message["type"]
+        if kind == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+            self.passthrough = (
+                "content-encoding" in headers
+                or message["status"] == 206
+                or media_type not in COMPRESSIBLE_TYPES
+            )
+            if self.passthrough:
+                await self.send(message)
+            else:
+                self.start = message
+            return
+
+        if self.passthrough or kind != "http.response.body":
+            # e.g. http.response.pathsend, which is never compressed
+            if self.start is not None and kind != "http.response.early_hint":
+                await self.send(self.start)
+                self.start = None
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is None:
+            # a later chunk of a streamed response
+            if self.encoder is not None:
+                message["body"] = await self.compress(body, more_body)
+            await self.send(message)
+            return
+
+        start, self.start = self.start, None
+        if len(body) >= self.minimum_size or more_body:
+            headers = MutableHeaders(raw=start["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            if self.new_encoder is not None:
+                self.encoder = self.new_encoder()
+                message["body"] = await self.compress(body, more_body)
+                headers["Content-Encoding"] = self.encoder.content_encoding
+                if more_body or start.get("trailers", False):
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(message["body"]))
+        await self.send(start)
+        await self.send(message)
+
+    async def compress(self, body: bytes, more_body: bool) -> bytes:
+        if len(body) >= COMPRESSION_THREAD_MINIMUM_SIZE:
+            # compressing large chunks inline would hold up the event loop
+            return await run_in_thread(self.encoder.compress, body, more_body)
+        return self.encoder.compress(body, more_body)
+
+
+class CompressionMiddleware:
+    """
+    Compresses JSON and text responses with brotli or gzip, as the client accepts.
+
+    Brotli is used when the brotli package is installed. Streamed responses
+    are flushed chunk by chunk, so compression doesn't delay them.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = set()
+        for coding in Headers(scope=scope).get("Accept-Encoding", "").lower().split(","):
+            name, _, params = coding.partition(";")
+            # "br;q=0" means the client refuses br
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(name.strip())
+        if brotli is not None and "br" in accepted:
+            new_encoder = partial(_BrotliEncoder, BROTLI_QUALITY)
+        elif "gzip" in accepted:
+            new_encoder = partial(_GzipEncoder, GZIP_LEVEL)
+        else:
+            new_encoder = None
+        await _CompressionResponder(self.app, self.minimum_size, new_encoder)(scope, receive, send)
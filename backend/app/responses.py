@@ -0,0 +1,28 @@
+import os
+from typing import Any
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library encoder is used without it
+    orjson = None
+
+
+# "orjson" (the default when installed) or "json"
+JSON_ENCODER = os.getenv("JSON_ENCODER", "orjson" if orjson is not None else "json")
+if JSON_ENCODER == "orjson" and orjson is None:
+    raise RuntimeError("JSON_ENCODER is orjson but the orjson package isn't installed: pip install orjson")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson when JSON_ENCODER is orjson.
+
+    Routes returning large stored documents (messages, threads) return this
+    directly, which also skips FastAPI's jsonable_encoder pass over the data.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if JSON_ENCODER == "orjson":
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(content)
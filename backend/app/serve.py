@@ -0,0 +1,47 @@
+"""
+Production entry point: serves the app with several uvicorn worker processes.
+
+    python -m app.serve
+
+Workers share sessions, cached completions and batch jobs through
+STATE_BACKEND: Redis when REDIS_URL is set, otherwise SQLite files under
+data/ (workers on one host). Use `python -m app.main` for development with
+auto-reload.
+"""
+import os
+import glob
+import uvicorn
+from app.services.metrics import METRICS_DIR
+
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+# worker processes, one per core by default; uvicorn and gunicorn read the same variable
+WORKERS = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# proxies trusted to set X-Forwarded-For/Proto, e.g. a load balancer in front of the workers
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+
+
+def main():
+    # workers inherit the environment, so each one knows how many share the rate limits and cores
+    os.environ["WEB_CONCURRENCY"] = str(WORKERS)
+    if WORKERS > 1 and os.getenv("SESSION_BACKEND") == "memory":
+        raise SystemExit("SESSION_BACKEND=memory can't be shared between workers, use sqlite or redis")
+    # /metrics adds up every worker's file, start from zero like a single process would
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        os.remove(path)
+
+    uvicorn.run(
+        "app.main:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
+        proxy_headers=True,
+        forwarded_allow_ips=FORWARDED_ALLOW_IPS,
+        log_level=LOG_LEVEL,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from app.services.shared_state import STATE_BACKEND, get_redis
+
+
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", "data/ai_cache.db")
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "512"))
+# seconds a cached completion stays valid (default one week)
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "604800"))
+
+
+def make_key(model: str, max_tokens: int, messages: List[Dict], response_format: Optional[Dict] = None) -> str:
+    """
+    Hash the prompt messages, model, max_tokens and response format into a cache key.
+    """
+    request = {"model": model, "max_tokens": max_tokens, "messages": messages}
+    # plain text completions keep the keys they had before response formats
+    if response_format is not None:
+        request["response_format"] = response_format
+    payload = json.dumps(request, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AICache(ABC):
+    """
+    Two-tier cache of model completions: an in-memory LRU in front of a
+    shared tier that every worker process reads and writes.
+
+    Entries are content-addressed, so the same prompt against the same model
+    settings is answered from the cache regardless of which email it came
+    from, or which worker generated it. Subclasses implement the shared tier.
+    """
+
+    def __init__(self, max_size: int = AI_CACHE_SIZE, ttl: int = AI_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+    @abstractmethod
+    def _load(self, key: str) -> Optional[Dict]:
+        """Read {"content", "tokens", "expires_at"} from the shared tier."""
+
+    @abstractmethod
+    def _store(self, key: str, entry: Dict):
+        """Write an entry to the shared tier."""
+
+    def _remember(self, key: str, entry: Dict):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Look up a completion, returning {"content", "tokens"} or None.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry["expires_at"] > now:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self.tokens_saved += entry["tokens"]
+                return entry
+
+        entry = self._load(key)
+        with self._lock:
+            if entry is None or entry["expires_at"] <= now:
+                self._memory.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._remember(key, entry)
+            self.disk_hits += 1
+            self.tokens_saved += entry["tokens"]
+            return entry
+
+    def put(self, key: str, content: str, tokens: int):
+        """
+        Store a completion and the number of tokens it cost to generate.
+        """
+        entry = {"content": content, "tokens": tokens, "expires_at": time.time() + self.ttl}
+        with self._lock:
+            self._remember(key, entry)
+        self._store(key, entry)
+
+    def purge_expired(self):
+        """Remove expired entries from the shared tier."""
+
+    def stats(self) -> Dict:
+        """Hit rate and tokens saved by this worker since startup."""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_size": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "tokens_saved": self.tokens_saved,
+            }
+
+
+class SQLiteAICache(AICache):
+    """AI cache whose shared tier is an SQLite file, shared by the workers on one host."""
+
+    def __init__(self, path: str = AI_CACHE_PATH, max_size: int = AI_CACHE_SIZE, ttl: int = AI_CACHE_TTL):
+        super().__init__(max_size, ttl)
+        self._conn_lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, tokens INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL)"
+        )
+
+    def _load(self, key: str) -> Optional[Dict]:
+        with self._conn_lock:
+            row = self._conn.execute(
+                "SELECT content, tokens, expires_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"content": row[0], "tokens": row[1], "expires_at": row[2]}
+
+    def _store(self, key: str, entry: Dict):
+        with self._conn_lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, content, tokens, expires_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, entry["content"], entry["tokens"], entry["expires_at"])
+            )
+
+    def purge_expired(self):
+        with self._conn_lock, self._conn:
+            self._conn.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+
+
+class RedisAICache(AICache):
+    """AI cache whose shared tier is Redis; entries expire there on their own."""
+
+    def __init__(self, redis=None, max_size: int = AI_CACHE_SIZE, ttl: int = AI_CACHE_TTL):
+        super().__init__(max_size, ttl)
+        self.redis = redis or get_redis()
+
+    def _load(self, key: str) -> Optional[Dict]:
+        data = self.redis.get(f"ai:{key}")
+        return json.loads(data) if data is not None else None
+
+    def _store(self, key: str, entry: Dict):
+        self.redis.set(f"ai:{key}", json.dumps(entry), ex=self.ttl)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_ai_cache() -> AICache:
+    """
+    Get the process-wide AI cache for STATE_BACKEND, opening it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if STATE_BACKEND == "redis":
+                    _cache = RedisAICache()
+                elif STATE_BACKEND == "sqlite":
+                    _cache = SQLiteAICache()
+                else:
+                    raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+    return _cache
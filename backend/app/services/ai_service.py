@@ -1,23 +1,214 @@
 import os
+import asyncio
+import logging
 import openai
-from typing import Dict, Optional
+from openai import AsyncOpenAI
+from typing import AsyncIterator, Dict, List, Optional
 from dotenv import load_dotenv
+from app.services.ai_cache import get_ai_cache, make_key
+from app.services.executor import run_in_thread
+from app.services.analysis_schema import ANALYSIS_FIELDS, parse_analysis, cap_analysis, fields_max_tokens, \
+    response_format
+from app.services.metrics import timed, record_cache, OPENAI_TOKENS, ANALYSIS_REPAIRS
+from app.services.prompt_builder import PROMPT_TOKEN_BUDGET, build_context, count_message_tokens, count_tokens
+from app.services.resilience import Upstream, AsyncSingleFlight, UpstreamUnavailable, RATE_LIMITED, UNAVAILABLE
 
 load_dotenv()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+logger = logging.getLogger(__name__)
 
+MODEL = "gpt-4o-mini"
+# the sum of the analysis fields' token caps
+ANALYSIS_MAX_TOKENS = fields_max_tokens(ANALYSIS_FIELDS)
+ANALYSIS_RESPONSE_FORMAT = response_format(ANALYSIS_FIELDS)
+RESPONSE_MAX_TOKENS = 600
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# texts sent per embeddings request
+EMBEDDING_BATCH_SIZE = 256
 
-def analyze_email_content(email_content: Dict, pdf_text: Optional[str] = None) -> Dict:
+# characters worth extracting from a PDF for any prompt; comfortably more
+# than the token budget can hold, even for text that tokenizes very densely
+PDF_CONTEXT_CHARS = PROMPT_TOKEN_BUDGET * 6
+
+# the account's rate limits (requests and tokens per minute) calls are paced against
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+# one set of limits for the API key
+OPENAI_QUOTA_KEY = "api_key"
+
+_client = None
+
+
+def get_client() -> AsyncOpenAI:
     """
-    Generate AI insights based on email content and optional PDF attachment.
-    Args:
-        email_content: Dict containing email data (subject, body, etc)
-        pdf_text: Optional text extracted from PDF attachment
+    Get the shared async OpenAI client, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        # retries are left to openai_upstream
+        _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
+
+
+def classify_openai_error(error: Exception) -> Optional[str]:
+    """Tell rate limits and transient failures (worth retrying) from other errors."""
+    if isinstance(error, openai.RateLimitError):
+        # an exhausted quota won't come back by retrying
+        return None if getattr(error, "code", None) == "insufficient_quota" else RATE_LIMITED
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return UNAVAILABLE
+    return None
+
+
+openai_upstream = Upstream(
+    "openai",
+    {"requests": (OPENAI_RPM / 60, OPENAI_RPM), "tokens": (OPENAI_TPM / 60, OPENAI_TPM)},
+    classify_openai_error
+)
+# identical uncached prompts in flight at the same time share one completion
+_completions = AsyncSingleFlight("completion")
+
 
+def completion_costs(messages: List[Dict], max_tokens: int) -> Dict[str, float]:
+    """Rate limit usage of a completion; OpenAI counts max_tokens up front too."""
+    return {"requests": 1, "tokens": count_message_tokens(messages) + max_tokens}
+
+
+def record_usage(usage) -> int:
+    """
+    Count the prompt and completion tokens of a response, returning the total.
+    """
+    if usage is None:
+        return 0
+    OPENAI_TOKENS.inc(usage.prompt_tokens, direction="in")
+    OPENAI_TOKENS.inc(usage.completion_tokens, direction="out")
+    return usage.total_tokens
+
+
+async def complete(
+    messages: List[Dict], max_tokens: int, force_refresh: bool = False, response_format: Optional[Dict] = None
+) -> str:
+    """
+    Run a chat completion, answering repeated prompts from the AI cache.
+
+    Args:
+        messages: Chat messages to send to the model
+        max_tokens: Completion token limit
+        force_refresh: Skip the cache lookup and regenerate (the result is still stored)
+        response_format: Optional structured output format, e.g. a strict JSON schema
     Returns:
-        Dictionary with AI-generated insights
+        The completion text
     """
+    cache = get_ai_cache()
+    key = make_key(MODEL, max_tokens, messages, response_format)
+
+    if not force_refresh:
+        cached = await run_in_thread(cache.get, key)
+        record_cache("ai", cached is not None)
+        if cached is not None:
+            return cached["content"]
+
+    return await _completions.do(key, _complete_uncached, key, messages, max_tokens, response_format)
+
+
+async def _complete_uncached(
+    key: str, messages: List[Dict], max_tokens: int, response_format: Optional[Dict]
+) -> str:
+    async def create():
+        with timed("openai"):
+            return await get_client().chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                max_tokens=max_tokens,
+                **({"response_format": response_format} if response_format else {})
+            )
+
+    response = await openai_upstream.call_async(
+        OPENAI_QUOTA_KEY, completion_costs(messages, max_tokens), create
+    )
+    content = response.choices[0].message.content
+    tokens = record_usage(response.usage)
+    await run_in_thread(get_ai_cache().put, key, content, tokens)
+    return content
+
+
+async def stream_completion(
+    messages: List[Dict], max_tokens: int, force_refresh: bool = False, response_format: Optional[Dict] = None
+) -> AsyncIterator[str]:
+    """
+    Stream a chat completion as text deltas, caching the full text when it finishes.
+
+    A cached completion is yielded as a single delta.
+    """
+    cache = get_ai_cache()
+    key = make_key(MODEL, max_tokens, messages, response_format)
+
+    if not force_refresh:
+        cached = await run_in_thread(cache.get, key)
+        record_cache("ai", cached is not None)
+        if cached is not None:
+            yield cached["content"]
+            return
+
+    async def create():
+        with timed("openai"):
+            return await get_client().chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+                **({"response_format": response_format} if response_format else {})
+            )
+
+    # only opening the stream is retried, text already sent can't be taken back
+    stream = await openai_upstream.call_async(
+        OPENAI_QUOTA_KEY, completion_costs(messages, max_tokens), create
+    )
+
+    chunks = []
+    tokens = 0
+    async for chunk in stream:
+        if chunk.usage:
+            tokens = record_usage(chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            delta = chunk.choices[0].delta.content
+            chunks.append(delta)
+            yield delta
+
+    await run_in_thread(cache.put, key, "".join(chunks), tokens)
+
+
+async def embed(texts: List[str]) -> List[List[float]]:
+    """
+    Embed texts with EMBEDDING_MODEL, in order, sending batches concurrently.
+    """
+    async def create(batch):
+        with timed("embedding"):
+            return await get_client().embeddings.create(model=EMBEDDING_MODEL, input=batch)
+
+    async def embed_batch(batch):
+        costs = {"requests": 1, "tokens": sum(count_tokens(text) for text in batch)}
+        response = await openai_upstream.call_async(OPENAI_QUOTA_KEY, costs, create, batch)
+        if response.usage is not None:
+            OPENAI_TOKENS.inc(response.usage.prompt_tokens, direction="in")
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    batches = await asyncio.gather(*(
+        embed_batch(texts[start:start + EMBEDDING_BATCH_SIZE])
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+    ))
+    return [vector for batch in batches for vector in batch]
+
+
+def build_analysis_messages(email_content: Dict, pdf_text: Optional[str] = None) -> List[Dict]:
+    """
+    Build the chat messages used to analyze an email and optional PDF attachment.
+
+    The body and PDF text are cleaned and fitted to the prompt token budget.
+    """
+    context = build_context(email_content, pdf_text)
+    pdf_text = context["pdf_text"]
     prompt = f"""
     Analyze the following email:
     
@@ -26,64 +217,133 @@ def analyze_email_content(email_content: Dict, pdf_text: Optional[str] = None) -
     From: {email_content.get('headers', {}).get('From', 'Unknown sender')}
     
     Body:
-    {email_content.get('body', 'No body content')}
+    {context['body']}
     """
     if pdf_text:
         prompt += f"""
         
         The email contains a PDF attachment with the following content:
-        {pdf_text[:3000]}...
+        {pdf_text}...
         
-        Please provide:
-        1. A summary of the email and attachment
-        2. Key points or action items
-        3. Suggested next steps or response
+        Please provide a summary of the email and attachment, its key points,
+        the recipient's action items and a suggested response.
         """
     else:
         prompt += """
 
-        Please provide:
-        1. A summary of the email
-        2. Key points or action items
-        3. Suggested next steps or response
+        Please provide a summary of the email, its key points,
+        the recipient's action items and a suggested response.
         """
 
-    try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an AI assistant that helps analyze emails and their attachments."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=800
-        )
+    return [
+        {
+            "role": "system",
+            "content": "You are an AI assistant that helps analyze emails and their attachments. "
+                       "Answer in JSON, keeping every field within its stated length."
+        },
+        {"role": "user", "content": prompt}
+    ]
+
 
-        # extract and process the ai response
-        ai_response = response.choices[0].message.content
+def analysis_cache_key(messages: List[Dict]) -> str:
+    """AI cache key of the analysis completion for these messages."""
+    return make_key(MODEL, ANALYSIS_MAX_TOKENS, messages, ANALYSIS_RESPONSE_FORMAT)
+
+
+async def finish_analysis(messages: List[Dict], ai_response: str) -> Dict:
+    """
+    Validate the model's JSON analysis, re-requesting only the fields that
+    are missing or invalid, and hold every field to its token cap.
+
+    Fields still missing after the repair request are left empty.
+    """
+    analysis, missing = parse_analysis(ai_response)
+    if missing:
+        for name in missing:
+            ANALYSIS_REPAIRS.inc(field=name)
+        try:
+            repair = await complete(
+                messages,
+                max_tokens=fields_max_tokens(missing),
+                response_format=response_format(missing)
+            )
+            repaired, _ = parse_analysis(repair)
+            analysis.update({name: repaired[name] for name in missing if name in repaired})
+        except Exception as e:
+            # the fields that did validate are still worth returning
+            logger.warning("Could not repair analysis fields %s: %s", missing, e)
+    return cap_analysis(analysis)
 
-        # parse the ai response into structured sections
-        sections = ai_response.split("\n\n")
-        result = {
-            "summary": sections[0] if len(sections) > 0 else "",
-            "key_points": sections[1] if len(sections) > 1 else "",
-            "suggested_response": sections[2] if len(sections) > 2 else "",
-            "full_analysis": ai_response,
-        }
-        return result
 
+async def complete_analysis(messages: List[Dict], force_refresh: bool = False) -> Dict:
+    """
+    Run the analysis completion as structured JSON and return the validated analysis.
+    """
+    ai_response = await complete(
+        messages,
+        max_tokens=ANALYSIS_MAX_TOKENS,
+        force_refresh=force_refresh,
+        response_format=ANALYSIS_RESPONSE_FORMAT
+    )
+    return await finish_analysis(messages, ai_response)
+
+
+def analysis_error(e: Exception) -> Dict:
+    """
+    Build the analysis result returned when the model call fails.
+    """
+    return {
+        "error": f"Error generating AI analysis: {str(e)}",
+        "summary": "Unable to generate analysis.",
+        "key_points": [],
+        "action_items": [],
+        "suggested_response": "",
+    }
+
+
+async def analyze_email_content(messages: List[Dict], force_refresh: bool = False) -> Dict:
+    """
+    Generate AI insights for an email.
+    Args:
+        messages: Prompt from build_analysis_messages for the email and optional PDF text
+        force_refresh: Regenerate instead of using a cached analysis
+
+    Returns:
+        Dictionary with AI-generated insights and the prompt's token count
+    """
+    try:
+        analysis = await complete_analysis(messages, force_refresh=force_refresh)
+    except UpstreamUnavailable:
+        # let the API answer 503 with Retry-After instead of an error analysis
+        raise
     except Exception as e:
-        return {
-            "error": f"Error generating AI analysis: {str(e)}",
-            "summary": "Unable to generate analysis.",
-            "key_points": "",
-            "suggested_response": "",
-        }
-    
- 
-def generate_email_response(email_content: Dict, pdf_text: Optional[str] = None) -> str:
+        analysis = analysis_error(e)
+    analysis["prompt_tokens"] = count_message_tokens(messages)
+    return analysis
+
+
+async def stream_email_analysis(messages: List[Dict], force_refresh: bool = False) -> AsyncIterator[str]:
+    """
+    Stream the analysis JSON for messages from build_analysis_messages as it is
+    generated; validate the joined text with finish_analysis and the same messages.
     """
-    Generate an email response based on the original email and optional PDF attachment.
+    async for delta in stream_completion(
+        messages,
+        max_tokens=ANALYSIS_MAX_TOKENS,
+        force_refresh=force_refresh,
+        response_format=ANALYSIS_RESPONSE_FORMAT
+    ):
+        yield delta
+
+
+def build_response_messages(email_content: Dict, pdf_text: Optional[str] = None) -> List[Dict]:
     """
+    Build the chat messages used to draft a reply to an email.
+
+    The body and PDF text are cleaned and fitted to the prompt token budget.
+    """
+    context = build_context(email_content, pdf_text)
+    pdf_text = context["pdf_text"]
     # Format the input for the AI model
     prompt = f"""
     Generate a professional email response to the following email:
@@ -93,14 +353,14 @@ def generate_email_response(email_content: Dict, pdf_text: Optional[str] = None)
     From: {email_content.get('headers', {}).get('From', 'Unknown sender')}
     
     Body:
-    {email_content.get('body', 'No body content')}
+    {context['body']}
     """
 
     if pdf_text:
          prompt += f"""
         
         The email contains a PDF attachment with the following content:
-        {pdf_text[:2000]}...
+        {pdf_text}...
         
         Generate a professional and helpful response that addresses both the email content and the attachment.
         """
@@ -110,15 +370,35 @@ def generate_email_response(email_content: Dict, pdf_text: Optional[str] = None)
         Generate a professional and helpful response to this email.
         """
 
+    return [
+        {"role": "system", "content": "You are an AI assistant that helps draft email responses."},
+        {"role": "user", "content": prompt}
+    ]
+
+ 
+async def generate_email_response(messages: List[Dict], force_refresh: bool = False) -> str:
+    """
+    Generate an email response for messages from build_response_messages.
+    """
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an AI assistant that helps draft email responses."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=600
+        return await complete(
+            messages,
+            max_tokens=RESPONSE_MAX_TOKENS,
+            force_refresh=force_refresh
         )
-        return response.choices[0].message.content
+    except UpstreamUnavailable:
+        raise
     except Exception as e:
         return f"Error generating email response: {str(e)}"
+
+
+async def stream_email_response(messages: List[Dict], force_refresh: bool = False) -> AsyncIterator[str]:
+    """
+    Stream a drafted email response for messages from build_response_messages as it is generated.
+    """
+    async for delta in stream_completion(
+        messages,
+        max_tokens=RESPONSE_MAX_TOKENS,
+        force_refresh=force_refresh
+    ):
+        yield delta
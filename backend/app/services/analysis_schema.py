@@ -0,0 +1,107 @@
+import json
+from typing import Dict, List, Tuple
+from pydantic import BaseModel, Field, ValidationError
+from app.services.prompt_builder import truncate_to_tokens
+
+
+# output tokens allowed per field; the model is told the limits in words
+SUMMARY_MAX_TOKENS = 100
+MAX_ITEMS = 5
+ITEM_MAX_TOKENS = 30
+SUGGESTED_RESPONSE_MAX_TOKENS = 200
+# JSON punctuation and field names around each field's value
+FIELD_OVERHEAD_TOKENS = 10
+
+
+class EmailAnalysis(BaseModel):
+    """Structured analysis of an email and its attachments."""
+
+    summary: str = Field(
+        description="What the email and any attachment are about, in at most 60 words"
+    )
+    key_points: List[str] = Field(
+        description=f"At most {MAX_ITEMS} key facts or points, each under 20 words"
+    )
+    action_items: List[str] = Field(
+        description=f"At most {MAX_ITEMS} things the recipient needs to do, each under 20 words "
+                    "and starting with a verb; empty if there are none"
+    )
+    suggested_response: str = Field(
+        description="A suggested reply or next step, in at most 150 words"
+    )
+
+
+ANALYSIS_FIELDS = list(EmailAnalysis.model_fields)
+
+FIELD_MAX_TOKENS = {
+    "summary": SUMMARY_MAX_TOKENS,
+    "key_points": MAX_ITEMS * (ITEM_MAX_TOKENS + 2),
+    "action_items": MAX_ITEMS * (ITEM_MAX_TOKENS + 2),
+    "suggested_response": SUGGESTED_RESPONSE_MAX_TOKENS,
+}
+
+
+def fields_max_tokens(fields: List[str]) -> int:
+    """Completion token limit for a response holding the given fields."""
+    return sum(FIELD_MAX_TOKENS[name] + FIELD_OVERHEAD_TOKENS for name in fields) + FIELD_OVERHEAD_TOKENS
+
+
+def response_format(fields: List[str] = ANALYSIS_FIELDS) -> Dict:
+    """
+    Strict JSON schema response format asking for the given analysis fields only.
+    """
+    properties = EmailAnalysis.model_json_schema()["properties"]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "email_analysis",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {name: properties[name] for name in fields},
+                "required": list(fields),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def parse_analysis(text: str) -> Tuple[Dict, List[str]]:
+    """
+    Validate a model reply against EmailAnalysis in one pass.
+
+    Returns:
+        Tuple of (the fields that are valid, the names of missing or invalid fields)
+    """
+    try:
+        # tolerate text around the object, e.g. a markdown code fence
+        data = json.loads(text[text.find("{"):text.rfind("}") + 1])
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    try:
+        return EmailAnalysis.model_validate(data).model_dump(), []
+    except ValidationError as e:
+        invalid = {error["loc"][0] for error in e.errors() if error["loc"]}
+    valid = {name: data[name] for name in ANALYSIS_FIELDS if name in data and name not in invalid}
+    return valid, [name for name in ANALYSIS_FIELDS if name not in valid]
+
+
+def cap_analysis(analysis: Dict) -> Dict:
+    """
+    Hold every field to its token cap, whatever the model returned.
+    """
+    return {
+        "summary": truncate_to_tokens(analysis.get("summary", ""), SUMMARY_MAX_TOKENS),
+        "key_points": [
+            truncate_to_tokens(item, ITEM_MAX_TOKENS) for item in analysis.get("key_points", [])[:MAX_ITEMS]
+        ],
+        "action_items": [
+            truncate_to_tokens(item, ITEM_MAX_TOKENS) for item in analysis.get("action_items", [])[:MAX_ITEMS]
+        ],
+        "suggested_response": truncate_to_tokens(
+            analysis.get("suggested_response", ""), SUGGESTED_RESPONSE_MAX_TOKENS
+        ),
+    }
@@ -0,0 +1,260 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from app.services.attachment_store import load_attachment
+from app.services.message_store import get_message_store
+from app.services.pdf_service import extract_pdf
+from app.services.executor import run_in_thread, run_in_process
+from app.services.metrics import timed
+from app.services.prompt_builder import count_tokens, truncate_to_tokens, clean_email_body, \
+    PROMPT_TOKEN_BUDGET
+from app.services.vector_index import VectorIndex, vector_index_cache, build_index, embed_query
+
+
+logger = logging.getLogger(__name__)
+
+PDF_MIME_TYPE = "application/pdf"
+# pick the attachment text most relevant to the email instead of its beginning
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() in ("1", "true", "yes")
+# characters of a PDF extracted for retrieval (roughly 100k tokens)
+RETRIEVAL_MAX_CHARS = int(os.getenv("RETRIEVAL_MAX_CHARS", "400000"))
+
+# keep references to background index builds, by attachment hash
+_indexing = {}
+
+
+def pdf_attachments(email_data: Dict) -> List[Dict]:
+    """
+    Get the PDF attachments of a parsed message.
+    """
+    return [a for a in email_data.get("attachments", []) if a["mimeType"] == PDF_MIME_TYPE]
+
+
+def shared_info(info: Dict) -> Dict:
+    """PDF info without what belongs to one copy of the file, for indexes shared by attachment hash."""
+    return {key: value for key, value in info.items() if key != "filename"}
+
+
+async def index_attachment(sha256: str, path: str,
+                           try_spend: Optional[Callable[[int], bool]] = None) -> Optional[VectorIndex]:
+    """
+    Get the vector index of a PDF attachment, building it if needed.
+
+    The whole document (up to RETRIEVAL_MAX_CHARS) is extracted, and only
+    documents too long for the prompt are chunked, embedded and saved. This
+    is slow and costs embedding tokens, so it runs off the request path: in
+    the background after an analysis found a long PDF, and in the prefetcher.
+
+    Args:
+        try_spend: Called with the tokens to embed; the index isn't built if it refuses them
+    Returns:
+        The index, or None for documents that fit the prompt or weren't indexed
+    """
+    index = await run_in_thread(vector_index_cache.get, sha256)
+    if index is not None:
+        return index
+    with timed("pdf_extract"):
+        pdf = await run_in_process(extract_pdf, path, "", max_chars=RETRIEVAL_MAX_CHARS)
+    tokens = count_tokens(pdf["text"])
+    if tokens <= PROMPT_TOKEN_BUDGET:
+        return None
+    if try_spend is not None and not try_spend(tokens):
+        return None
+    index = await build_index(pdf["text"], shared_info(pdf["info"]))
+    await run_in_thread(vector_index_cache.put, sha256, index)
+    return index
+
+
+async def _index_in_background(sha256: str, path: str, filename: str):
+    try:
+        await index_attachment(sha256, path)
+    except Exception as e:
+        # analyses keep using the beginning of the document
+        logger.warning("Could not index %s: %s", filename, e)
+
+
+def schedule_indexing(sha256: str, path: str, filename: str):
+    """Build an attachment's vector index in the background, once at a time per attachment hash."""
+    if sha256 in _indexing:
+        return
+    task = _indexing[sha256] = asyncio.create_task(_index_in_background(sha256, path, filename))
+    task.add_done_callback(lambda _: _indexing.pop(sha256, None))
+
+
+async def process_pdf_attachment(service, account: str, email_data: Dict, attachment: Dict,
+                                 max_chars: int, wait_for_index: bool = False,
+                                 try_spend: Optional[Callable[[int], bool]] = None) -> Dict:
+    """
+    Load one PDF attachment through the attachment store and extract up to max_chars of its text.
+
+    With retrieval enabled, an attachment with a vector index (kept per
+    attachment hash) takes its text and info from the index, with this
+    attachment's filename, and the PDF isn't parsed again. Without one,
+    only max_chars are extracted; if the document is longer, its index is
+    built in the background for later prompts, or first with wait_for_index
+    (charging the embedding tokens to try_spend, if given).
+    Freshly extracted text is added to the search index of the mailbox.
+
+    Returns:
+        Dict with filename, text, info, the vector index (or None) and
+        per-stage timings, or an error
+    """
+    result = {"filename": attachment["filename"], "text": "", "info": None, "index": None}
+    timings = {}
+    try:
+        start = time.perf_counter()
+        with timed("attachment_download"):
+            ref = await run_in_thread(load_attachment, service, account, email_data["id"], attachment["id"])
+        timings["download_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        result["sha256"] = ref["sha256"]
+
+        if RETRIEVAL_ENABLED:
+            start = time.perf_counter()
+            if wait_for_index:
+                try:
+                    index = await index_attachment(ref["sha256"], ref["path"], try_spend)
+                except Exception as e:
+                    logger.warning("Could not index %s: %s", attachment["filename"], e)
+                    index = None
+                timings["index_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            else:
+                index = await run_in_thread(vector_index_cache.get, ref["sha256"])
+            if index is not None:
+                # the index is shared by every copy of the PDF, the filename is this message's
+                info = {**index.info, "filename": attachment["filename"]} if index.info else None
+                result.update(text=index.text, info=info, index=index)
+                if wait_for_index:
+                    await run_in_thread(
+                        get_message_store().index_attachment_text, account, email_data, attachment, index.text
+                    )
+                result["timings"] = timings
+                return result
+
+        start = time.perf_counter()
+        with timed("pdf_extract"):
+            # the worker process reads the blob itself instead of receiving the bytes
+            pdf = await run_in_process(extract_pdf, ref["path"], attachment["filename"], max_chars=max_chars)
+        timings["extract_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        result["text"] = pdf["text"]
+        result["info"] = pdf["info"]
+        if RETRIEVAL_ENABLED and not wait_for_index and pdf["info"]["truncated"]:
+            # longer than the prompt: retrieve from it next time
+            schedule_indexing(ref["sha256"], ref["path"], attachment["filename"])
+        if pdf["text"]:
+            await run_in_thread(
+                get_message_store().index_attachment_text, account, email_data, attachment, pdf["text"]
+            )
+    except Exception as e:
+        result["error"] = f"Error processing PDF: {str(e)}"
+    result["timings"] = timings
+    return result
+
+
+async def process_pdf_attachments(service, account: str, email_data: Dict, max_chars: int,
+                                  wait_for_index: bool = False,
+                                  try_spend: Optional[Callable[[int], bool]] = None) -> List[Dict]:
+    """
+    Download and extract every PDF attachment of a message concurrently.
+
+    Each document is extracted up to the whole budget so that merge_pdf_texts can
+    hand the space short documents leave unused to the longer ones.
+    """
+    return await asyncio.gather(*(
+        process_pdf_attachment(service, account, email_data, attachment, max_chars, wait_for_index, try_spend)
+        for attachment in pdf_attachments(email_data)
+    ))
+
+
+def split_budget(lengths: List[int], budget: int) -> List[int]:
+    """
+    Split a token budget across documents fairly.
+
+    Documents shorter than an equal share keep their full length and the rest
+    of the budget is shared among the longer ones.
+    """
+    shares = [0] * len(lengths)
+    remaining = budget
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for position, index in enumerate(order):
+        share = remaining // (len(order) - position)
+        shares[index] = min(lengths[index], share)
+        remaining -= shares[index]
+    return shares
+
+
+def excerpt(result: Dict, budget: int, query_vector: Optional[np.ndarray] = None) -> str:
+    """
+    Fit one attachment's text to budget tokens.
+
+    Indexed documents contribute the chunks most relevant to the query,
+    others (or all, without a query) their beginning.
+    """
+    if result.get("index") is not None and query_vector is not None:
+        return result["index"].excerpt(query_vector, budget)
+    return truncate_to_tokens(result["text"], budget)
+
+
+def merge_pdf_texts(results: List[Dict], budget: int, query_vector: Optional[np.ndarray] = None) -> Optional[str]:
+    """
+    Merge extracted attachment texts into one prompt section within budget tokens.
+
+    Returns None if there is no text or no budget for it.
+    """
+    texts = [result for result in results if result["text"]]
+    if not texts or budget <= 0:
+        return None
+    if len(texts) == 1:
+        return excerpt(texts[0], budget, query_vector)
+
+    # leave room for the per-attachment headings
+    headings = [f"[Attachment: {result['filename']}]\n" for result in texts]
+    available = max(0, budget - sum(count_tokens(heading) + 1 for heading in headings))
+    shares = split_budget([count_tokens(result["text"]) for result in texts], available)
+    return "\n\n".join(
+        heading + excerpt(result, share, query_vector)
+        for heading, result, share in zip(headings, texts, shares)
+    )
+
+
+def retrieval_query(email_data: Dict) -> str:
+    """The text of an email that attachment chunks are matched against."""
+    subject = email_data.get("headers", {}).get("Subject", "")
+    body = clean_email_body(email_data["body"]) if email_data.get("body") else ""
+    return f"{subject}\n\n{body}".strip()
+
+
+async def select_pdf_text(email_data: Dict, results: List[Dict], budget: int,
+                          try_spend: Optional[Callable[[int], bool]] = None) -> Optional[str]:
+    """
+    Merge attachment texts for a prompt, retrieving the parts of long documents relevant to the email.
+
+    try_spend, if given, is charged for embedding the email as the query.
+    """
+    query_vector = None
+    if any(result.get("index") is not None for result in results) and retrieval_query(email_data):
+        try:
+            query_vector = await embed_query(retrieval_query(email_data), try_spend)
+        except Exception as e:
+            logger.warning("Falling back to document beginnings: %s", e)
+    return merge_pdf_texts(results, budget, query_vector)
+
+
+def attachment_report(results: List[Dict]) -> List[Dict]:
+    """
+    Summarize per-attachment outcome and timings for the API response.
+    """
+    report = []
+    for result in results:
+        entry = {
+            "filename": result["filename"],
+            "chars": len(result["text"]),
+            **result["timings"],
+        }
+        if "error" in result:
+            entry["error"] = result["error"]
+        report.append(entry)
+    return report
@@ -0,0 +1,89 @@
+import os
+import hashlib
+import tempfile
+from typing import Dict
+from app.services.gmail_service import get_attachment
+from app.services.message_store import get_message_store, load_message
+from app.services.metrics import record_cache
+from app.services.resilience import SingleFlight
+
+
+ATTACHMENT_STORE_DIR = os.getenv("ATTACHMENT_STORE_DIR", "data/attachments")
+
+
+class BlobStore:
+    """
+    Content-addressed file store: each blob is saved once under its SHA-256.
+
+    Identical attachments from different emails or users share one file, and
+    a blob's content never changes once written.
+    """
+
+    def __init__(self, root: str = ATTACHMENT_STORE_DIR):
+        self.root = root
+
+    def path_for(self, sha256: str) -> str:
+        # fan out over subdirectories to keep directories small
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def has(self, sha256: str) -> bool:
+        return os.path.exists(self.path_for(sha256))
+
+    def put(self, data: bytes) -> str:
+        """Save a blob if it isn't stored yet and return its SHA-256."""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so readers never see partial blobs
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return sha256
+
+
+blob_store = BlobStore()
+# concurrent requests for the same attachment share one download
+_attachment_flight = SingleFlight("attachment")
+
+
+def load_attachment(service, account: str, message_id: str, attachment_id: str) -> Dict:
+    """
+    Get an attachment from the store, downloading it from Gmail on first use.
+
+    The attachment's filename and type come from the stored message, and its
+    reference to the blob is kept in the message store, so repeated requests
+    make no Gmail calls at all.
+
+    Returns:
+        Dict with sha256, filename, mimeType, size and the blob path
+    """
+    return _attachment_flight.do(
+        (account, message_id, attachment_id), _load_attachment, service, account, message_id, attachment_id
+    )
+
+
+def _load_attachment(service, account: str, message_id: str, attachment_id: str) -> Dict:
+    store = get_message_store()
+    ref = store.get_attachment_ref(account, message_id, attachment_id)
+    record_cache("attachment_store", ref is not None and blob_store.has(ref["sha256"]))
+    if ref is None or not blob_store.has(ref["sha256"]):
+        data = get_attachment(service, message_id, attachment_id)
+        message = load_message(service, account, message_id)
+        info = next(
+            (a for a in message["attachments"] if a["id"] == attachment_id),
+            {"filename": "attachment.bin", "mimeType": "application/octet-stream"}
+        )
+        ref = {
+            "sha256": blob_store.put(data),
+            "filename": info["filename"],
+            "mimeType": info["mimeType"],
+            "size": len(data),
+        }
+        store.put_attachment_ref(account, message_id, attachment_id, ref)
+    return {**ref, "path": blob_store.path_for(ref["sha256"])}
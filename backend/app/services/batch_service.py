@@ -0,0 +1,258 @@
+import os
+import json
+import random
+import asyncio
+from typing import Callable, Dict, List, Optional
+from app.services.ai_service import get_client, complete_analysis, finish_analysis, build_analysis_messages, \
+    analysis_cache_key, MODEL, ANALYSIS_MAX_TOKENS, ANALYSIS_RESPONSE_FORMAT, PDF_CONTEXT_CHARS, \
+    openai_upstream, OPENAI_QUOTA_KEY
+from app.services.ai_cache import get_ai_cache
+from app.services.attachment_service import process_pdf_attachments, select_pdf_text
+from app.services.prompt_builder import attachment_token_budget
+from app.services.message_store import load_message
+from app.services.job_store import get_job_store, JOB_HEARTBEAT_INTERVAL
+from app.services.executor import run_in_thread
+from app.services.resilience import UpstreamUnavailable
+
+
+# max messages fetched and analyzed at the same time per job
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# most emails one job may analyze, by ids or by query
+BATCH_MAX_EMAILS = int(os.getenv("BATCH_MAX_EMAILS", "1000"))
+# jobs with at least this many uncached prompts go through the OpenAI Batch API
+BATCH_API_THRESHOLD = int(os.getenv("BATCH_API_THRESHOLD", "200"))
+BATCH_POLL_INTERVAL = int(os.getenv("BATCH_POLL_INTERVAL", "30"))
+# times a job waits out OpenAI being unavailable before failing a message
+MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "6"))
+
+# keep references to running jobs so they aren't garbage collected
+_running = set()
+
+
+async def analyze_with_backoff(messages: List[Dict]) -> Dict:
+    """
+    Run an analysis for a background job, waiting out rate limits and outages.
+
+    complete() already retries briefly; jobs aren't waited on interactively,
+    so they also wait for the suggested Retry-After and try again.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await complete_analysis(messages)
+        except UpstreamUnavailable as e:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(e.retry_after * random.uniform(1.0, 1.5))
+
+
+async def prepare_prompt(service, account: str, email_id: str, include_attachments: bool,
+                         wait_for_index: bool = False,
+                         try_spend: Optional[Callable[[int], bool]] = None) -> Dict:
+    """
+    Fetch a message and its PDF text and build the same prompt the analyze endpoint uses.
+
+    With wait_for_index, long PDFs are indexed first so the prompt retrieves
+    from them, as the analyze endpoint will once their index exists. Embedding
+    tokens are charged to try_spend, if given, and skipped when it refuses them.
+    """
+    email_data = await run_in_thread(load_message, service, account, email_id)
+    pdf_text = None
+    if include_attachments:
+        results = await process_pdf_attachments(
+            service, account, email_data, PDF_CONTEXT_CHARS, wait_for_index, try_spend
+        )
+        pdf_text = await select_pdf_text(email_data, results, attachment_token_budget(email_data), try_spend)
+    return {
+        "subject": email_data.get("headers", {}).get("Subject", ""),
+        "messages": build_analysis_messages(email_data, pdf_text),
+    }
+
+
+async def prepare_prompts(job_id: str, service, account: str, ids: List[str], include_attachments: bool) -> Dict:
+    """
+    Prepare prompts for every message concurrently, recording fetch failures on the job.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    prompts = {}
+
+    async def prepare(email_id):
+        async with semaphore:
+            try:
+                prompts[email_id] = await prepare_prompt(service, account, email_id, include_attachments)
+            except Exception as e:
+                await run_in_thread(
+                    get_job_store().add_result, job_id, email_id, {"error": f"Error fetching email: {str(e)}"}
+                )
+
+    await asyncio.gather(*(prepare(email_id) for email_id in ids))
+    return prompts
+
+
+async def analyze_concurrently(job_id: str, prompts: Dict):
+    """
+    Send analysis prompts to the model with bounded concurrency.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def analyze(email_id, prompt):
+        async with semaphore:
+            try:
+                analysis = await analyze_with_backoff(prompt["messages"])
+                result = {"subject": prompt["subject"], "email_analysis": analysis}
+            except Exception as e:
+                result = {"subject": prompt["subject"], "error": f"Error generating AI analysis: {str(e)}"}
+            await run_in_thread(get_job_store().add_result, job_id, email_id, result)
+
+    await asyncio.gather(*(analyze(email_id, prompt) for email_id, prompt in prompts.items()))
+
+
+async def batch_api_call(fn, *args, **kwargs):
+    """Call the Batch API (files and batches) with the same retries as completions."""
+    return await openai_upstream.call_async(OPENAI_QUOTA_KEY, {"requests": 1}, fn, *args, **kwargs)
+
+
+async def read_batch_file(file_id: str) -> Dict:
+    """Read a Batch API output or error file into custom_id -> line."""
+    content = await batch_api_call(get_client().files.content, file_id)
+    lines = {}
+    for line in content.text.splitlines():
+        if line.strip():
+            output = json.loads(line)
+            lines[output["custom_id"]] = output
+    return lines
+
+
+def batch_error(output: Dict, batch_status: str) -> str:
+    """Why a Batch API request has no completion, from its output or error file line."""
+    error = output.get("error") or ((output.get("response") or {}).get("body") or {}).get("error")
+    if isinstance(error, dict):
+        return error.get("message") or error.get("code") or json.dumps(error)
+    if error:
+        return str(error)
+    if output.get("response"):
+        return f"status {output['response'].get('status_code')}"
+    return f"batch {batch_status}"
+
+
+async def analyze_with_batch_api(job_id: str, prompts: Dict):
+    """
+    Submit analysis prompts through the OpenAI Batch API and wait for the results.
+
+    Completions are also written to the AI cache, so opening one of these
+    emails afterwards is answered without another model call.
+    """
+    client = get_client()
+    lines = [
+        json.dumps({
+            "custom_id": email_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": MODEL,
+                "messages": prompt["messages"],
+                "max_tokens": ANALYSIS_MAX_TOKENS,
+                "response_format": ANALYSIS_RESPONSE_FORMAT,
+            },
+        })
+        for email_id, prompt in prompts.items()
+    ]
+    batch_file = await batch_api_call(
+        client.files.create,
+        file=(f"analyze-{job_id}.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await batch_api_call(
+        client.batches.create,
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    await run_in_thread(get_job_store().update, job_id, batch_id=batch.id)
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await batch_api_call(client.batches.retrieve, batch.id)
+        await run_in_thread(get_job_store().update, job_id, batch_status=batch.status)
+
+    # successful requests are in the output file, failed ones in the error file
+    outputs = {}
+    if batch.error_file_id:
+        outputs.update(await read_batch_file(batch.error_file_id))
+    if batch.output_file_id:
+        outputs.update(await read_batch_file(batch.output_file_id))
+
+    cache = get_ai_cache()
+    for email_id, prompt in prompts.items():
+        output = outputs.get(email_id)
+        response = (output or {}).get("response") or {}
+        if response.get("status_code") != 200:
+            error = batch_error(output or {}, batch.status)
+            await run_in_thread(get_job_store().add_result, job_id, email_id, {
+                "subject": prompt["subject"], "error": f"Error generating AI analysis: {error}"
+            })
+            continue
+
+        body = response["body"]
+        ai_response = body["choices"][0]["message"]["content"]
+        tokens = body.get("usage", {}).get("total_tokens", 0)
+        await run_in_thread(cache.put, analysis_cache_key(prompt["messages"]), ai_response, tokens)
+        await run_in_thread(get_job_store().add_result, job_id, email_id, {
+            "subject": prompt["subject"], "email_analysis": await finish_analysis(prompt["messages"], ai_response)
+        })
+
+
+async def heartbeat(job_id: str):
+    """Keep updating a running job, so pollers can tell it from one whose worker stopped."""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        await run_in_thread(get_job_store().update, job_id)
+
+
+async def run_analysis_job(job_id: str, service, account: str, ids: List[str],
+                           include_attachments: bool, mode: str):
+    """
+    Analyze a list of emails, recording progress and results on the job.
+    """
+    await run_in_thread(get_job_store().update, job_id, status="running")
+    beat = asyncio.create_task(heartbeat(job_id))
+    try:
+        prompts = await prepare_prompts(job_id, service, account, ids, include_attachments)
+
+        # prompts already in the cache are answered directly
+        cache = get_ai_cache()
+        uncached = {}
+        for email_id, prompt in prompts.items():
+            cached = await run_in_thread(cache.get, analysis_cache_key(prompt["messages"]))
+            if cached is not None:
+                await run_in_thread(get_job_store().add_result, job_id, email_id, {
+                    "subject": prompt["subject"],
+                    "email_analysis": await finish_analysis(prompt["messages"], cached["content"])
+                })
+            else:
+                uncached[email_id] = prompt
+
+        use_batch_api = mode == "batch_api" or (mode == "auto" and len(uncached) >= BATCH_API_THRESHOLD)
+        await run_in_thread(get_job_store().update, job_id, mode="batch_api" if use_batch_api else "concurrent")
+        if uncached:
+            if use_batch_api:
+                await analyze_with_batch_api(job_id, uncached)
+            else:
+                await analyze_concurrently(job_id, uncached)
+        await run_in_thread(get_job_store().update, job_id, status="completed")
+    except Exception as e:
+        await run_in_thread(get_job_store().update, job_id, status="failed", error=str(e))
+    finally:
+        beat.cancel()
+
+
+def start_analysis_job(job_id: str, service, account: str, ids: List[str],
+                       include_attachments: bool = True, mode: str = "auto"):
+    """
+    Run an analysis job in the background on the current event loop.
+    """
+    task = asyncio.create_task(
+        run_analysis_job(job_id, service, account, ids, include_attachments, mode)
+    )
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return task
@@ -0,0 +1,73 @@
+import os
+import asyncio
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from app.services.shared_state import WEB_CONCURRENCY
+
+
+# pool sizes, configurable through the environment; by default the workers
+# split the cores between their PDF process pools
+GMAIL_THREAD_POOL_SIZE = int(os.getenv("GMAIL_THREAD_POOL_SIZE", "16"))
+PDF_PROCESS_POOL_SIZE = int(os.getenv(
+    "PDF_PROCESS_POOL_SIZE", str(max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY))
+))
+
+_thread_pool = None
+_process_pool = None
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    """
+    Get the bounded thread pool used for blocking I/O (Gmail API calls).
+    """
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(
+            max_workers=GMAIL_THREAD_POOL_SIZE, thread_name_prefix="gmail"
+        )
+    return _thread_pool
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Get the process pool used for CPU-bound work (PDF parsing).
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PDF_PROCESS_POOL_SIZE)
+    return _process_pool
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """
+    Run a blocking function in the thread pool without blocking the event loop.
+
+    The function runs in a copy of the caller's context, like asyncio.to_thread.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_thread_pool(), partial(context.run, func, *args, **kwargs))
+
+
+async def run_in_process(func, *args, **kwargs):
+    """
+    Run a CPU-bound function in the process pool.
+
+    The function and its arguments must be picklable.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """
+    Shut down the worker pools.
+    """
+    global _thread_pool, _process_pool
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
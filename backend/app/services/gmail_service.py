@@ -1,8 +1,21 @@
 import os
+import json
+import time
 import base64
+import hashlib
+import threading
+import httplib2
+import google_auth_httplib2
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from app.services.mime_parser import parse_payload
+from app.services.metrics import timed, GMAIL_API_CALLS, UPSTREAM_RETRIES
+from app.services.resilience import Upstream, backoff_delay, RATE_LIMITED, UNAVAILABLE, \
+    UPSTREAM_MAX_RETRIES
 
 
 # OAuth configuration
@@ -10,6 +23,52 @@ CLIENTS_SECRETS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirn
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 REDIRECT_URI = "http://localhost:8000/oauth2callback"
 
+# headers requested for list views and the max number of calls per batch request
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+# largest maxResults Gmail accepts for list calls
+MAX_PAGE_SIZE = 500
+
+DISCOVERY_URL = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+# point the API at another host, e.g. a local stand-in for benchmarks
+GMAIL_API_ROOT_URL = os.getenv("GMAIL_API_ROOT_URL")
+_discovery_doc = None
+_discovery_lock = threading.Lock()
+
+# Gmail allows each user 250 quota units per second; calls cost units by method
+GMAIL_USER_QUOTA = float(os.getenv("GMAIL_USER_QUOTA", "250"))
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.threads.get': 10,
+    'gmail.users.threads.list': 10,
+    'gmail.users.watch': 100,
+}
+DEFAULT_QUOTA_UNITS = 5
+RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+
+
+def classify_gmail_error(error):
+    """Tell rate limits and transient failures (worth retrying) from other errors."""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 429 or (status == 403 and any(r in (error.content or b'') for r in RATE_LIMIT_REASONS)):
+            return RATE_LIMITED
+        if status >= 500:
+            return UNAVAILABLE
+        return None
+    if isinstance(error, (OSError, httplib2.HttpLib2Error)):
+        return UNAVAILABLE
+    return None
+
+
+gmail_upstream = Upstream(
+    "gmail", {"units": (GMAIL_USER_QUOTA, GMAIL_USER_QUOTA)}, classify_gmail_error
+)
+
 
 def create_flow():
     """
@@ -33,87 +92,396 @@ def credentials_to_dict(credentials):
         'token_uri': credentials.token_uri,
         'client_id': credentials.client_id,
         'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
+        'scopes': credentials.scopes,
+        'expiry': credentials.expiry.isoformat() + 'Z' if credentials.expiry else None
     }
 
 
-def build_service(credentials_dict):
-    """Build a Gmail service from credentials dictionary."""
-    
+def get_discovery_document():
+    """
+    Get the parsed Gmail discovery document, loading it once per process.
+    """
+    global _discovery_doc
+    if _discovery_doc is None:
+        with _discovery_lock:
+            if _discovery_doc is None:
+                # prefer the copy bundled with googleapiclient over a network fetch
+                doc = get_static_doc('gmail', 'v1')
+                if doc is None:
+                    _, doc = httplib2.Http().request(DISCOVERY_URL)
+                doc = json.loads(doc)
+                if GMAIL_API_ROOT_URL:
+                    root_url = GMAIL_API_ROOT_URL.rstrip('/') + '/'
+                    doc['rootUrl'] = doc['mtlsRootUrl'] = root_url
+                    doc['baseUrl'] = root_url + doc.get('servicePath', '')
+                _discovery_doc = doc
+    return _discovery_doc
+
+
+def quota_units(method_id):
+    return QUOTA_UNITS.get(method_id, DEFAULT_QUOTA_UNITS)
+
+
+class InstrumentedHttpRequest(HttpRequest):
+    """
+    HttpRequest that counts and times every call it makes to the Gmail API.
+
+    Calls go through gmail_upstream, paced by the user's quota and retried on
+    rate limits and transient errors.
+    """
+
+    # the user whose quota the call is paced against
+    quota_key = 'default'
+
+    def execute(self, http=None, num_retries=0):
+        return gmail_upstream.call(
+            self.quota_key, {"units": quota_units(self.methodId)}, self._execute_once, http, num_retries
+        )
+
+    def _execute_once(self, http, num_retries):
+        GMAIL_API_CALLS.inc(method=self.methodId or 'unknown')
+        with timed('gmail'):
+            return super().execute(http=http, num_retries=num_retries)
+
+
+def execute_batch(batch, requests):
+    """
+    Execute a Gmail HTTP batch request, paced by the quota units of the calls inside it.
+    """
+    quota_key = getattr(requests[0], 'quota_key', InstrumentedHttpRequest.quota_key)
+
+    def execute():
+        GMAIL_API_CALLS.inc(method='batch')
+        with timed('gmail'):
+            batch.execute()
+
+    gmail_upstream.call(quota_key, {"units": sum(quota_units(r.methodId) for r in requests)}, execute)
+
+
+def execute_batches(service, build_request, count):
+    """
+    Run count calls in Gmail HTTP batches of up to BATCH_SIZE.
+
+    Calls rate limited (or failing transiently) inside a batch are retried in
+    a later batch with backoff; other failures are left out.
+
+    Args:
+        build_request: Builds the call for an index in range(count)
+    Returns:
+        Dict of index -> response for the calls that succeeded
+    """
+    results = {}
+    pending = list(range(count))
+    attempt = 0
+    while pending:
+        retry = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[int(request_id)] = response
+            elif classify_gmail_error(exception) is not None:
+                retry.append(int(request_id))
+
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            requests = []
+            for index in pending[start:start + BATCH_SIZE]:
+                request = build_request(index)
+                batch.add(request, request_id=str(index))
+                requests.append(request)
+            execute_batch(batch, requests)
+
+        if not retry or attempt >= UPSTREAM_MAX_RETRIES:
+            break
+        UPSTREAM_RETRIES.inc(len(retry), upstream='gmail', reason='batch_item')
+        time.sleep(backoff_delay(attempt))
+        pending = sorted(retry)
+        attempt += 1
+    return results
+
+
+def thread_local_request_builder(credentials):
+    """
+    Create a request builder that gives every thread its own authorized connection.
+
+    httplib2.Http is not thread-safe, so a service shared across the thread pool
+    keeps one persistent connection per thread instead of one per service.
+    """
+    local = threading.local()
+    # the refresh token identifies the user without keeping it around in plain text
+    quota_key = hashlib.sha256((credentials.refresh_token or '').encode()).hexdigest()[:16]
+
+    def build_request(http, *args, **kwargs):
+        authed_http = getattr(local, 'http', None)
+        if authed_http is None:
+            authed_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+            local.http = authed_http
+        request = InstrumentedHttpRequest(authed_http, *args, **kwargs)
+        request.quota_key = quota_key
+        return request
+
+    return build_request
+
+
+def credentials_from_dict(credentials_dict):
+    """Create OAuth credentials from a credentials dictionary."""
+
     required_fields = ['refresh_token', 'token_uri', 'client_id', 'client_secret']
     missing_fields = [field for field in required_fields if not credentials_dict.get(field)]
     
     if missing_fields:
         raise ValueError(f"Missing required credentials fields: {', '.join(missing_fields)}")
     
-    credentials = Credentials.from_authorized_user_info(credentials_dict)
-    return build('gmail', 'v1', credentials=credentials)
+    return Credentials.from_authorized_user_info(credentials_dict)
+
+
+def build_service_from_credentials(credentials):
+    """Build a Gmail service from OAuth credentials."""
+    document = get_discovery_document()
+
+    # building fills in defaults on the shared discovery document, so builds are serialised
+    with _discovery_lock:
+        return build_from_document(
+            document,
+            credentials=credentials,
+            requestBuilder=thread_local_request_builder(credentials)
+        )
+
+
+def build_service(credentials_dict):
+    """Build a Gmail service from credentials dictionary."""
+    return build_service_from_credentials(credentials_from_dict(credentials_dict))
+
+
+def list_page(service, resource='messages', query='', max_results=10, page_token=None):
+    """
+    List one page of messages or threads matching the query.
+
+    Returns:
+        Tuple of (items, nextPageToken or None)
+    """
+    collection = service.users().messages() if resource == 'messages' else service.users().threads()
+    results = collection.list(
+        userId='me', q=query, maxResults=max_results, pageToken=page_token
+    ).execute()
+    return results.get(resource, []), results.get('nextPageToken')
 
 
 def list_messages(service, query='', max_results=10):
     """
     List messages matching the query.
     """
-    results = service.users().messages().list(
-        userId='me', q=query, maxResults=max_results
-    ).execute()
-    return results.get('messages', [])
+    messages, _ = list_page(service, 'messages', query, max_results)
+    return messages
 
 
-def get_message(service, message_id):
+def list_message_ids(service, query='', limit=100):
     """
-    Get a message by its id
+    List up to limit message ids matching the query, following page tokens.
     """
-    message = service.users().messages().get(userId='me', id=message_id).execute()
+    ids = []
+    page_token = None
+    while len(ids) < limit:
+        messages, page_token = list_page(
+            service, 'messages', query, min(MAX_PAGE_SIZE, limit - len(ids)), page_token
+        )
+        ids.extend(message['id'] for message in messages)
+        if not page_token:
+            break
+    return ids
+
 
-    # extract headers
+def extract_headers(message, names=None):
+    """
+    Extract headers from a message payload as a dict keyed by lowercase name.
+    """
+    wanted = {name.lower() for name in names} if names else None
     headers = {}
-    for header in message['payload']['headers']:
-        headers[header['name']] = header['value']
-    
-    # Process parts recursively to extract body and attachments
-    parts = [message['payload']]
-    html_body = None
-    plain_body = None
-    attachments = []
-
-    while parts:
-        part = parts.pop(0)
-        # if the part has subparts, add them to out processing queue
-        if 'parts' in part:
-            parts.extend(part['parts'])
+    for header in message.get('payload', {}).get('headers', []):
+        name = header['name'].lower()
+        if wanted is None or name in wanted:
+            headers[name] = header['value']
+    return headers
+
+
+def batch_get_metadata(service, ids, resource='messages', headers=None):
+    """
+    Fetch metadata for many messages or threads using Gmail HTTP batch requests.
+
+    Args:
+        service: Gmail API service
+        ids: message or thread ids to fetch
+        resource: either 'messages' or 'threads'
+        headers: header names to request through metadataHeaders
+    Returns:
+        List of responses in the same order as ids (None for failed lookups)
+    """
+    if resource == 'messages':
+        collection = service.users().messages()
+    elif resource == 'threads':
+        collection = service.users().threads()
+    else:
+        raise ValueError(f"Unsupported resource: {resource}")
+
+    headers = headers or METADATA_HEADERS
+    # failed lookups are left out rather than failing the whole list
+    results = execute_batches(
+        service,
+        lambda index: collection.get(userId='me', id=ids[index], format='metadata', metadataHeaders=headers),
+        len(ids)
+    )
+    return [results.get(index) for index in range(len(ids))]
+
+
+def enrich_message_previews(service, messages):
+    """
+    Add Subject/From/Date headers to listed messages.
+    """
+    # get basic details for all messages in batched requests
+    details = batch_get_metadata(service, [message['id'] for message in messages], 'messages')
+
+    previews = []
+    for message, message_detail in zip(messages, details):
+        if message_detail is None:
             continue
-    
-        # process this part based on its MIME type
-        mime_type = part.get('mimeType', '')
-
-        if mime_type == 'text/html' and 'data' in part.get('body', {}):
-            body_data = part['body']['data']
-            decoded_bytes = base64.urlsafe_b64decode(body_data)
-            html_body = decoded_bytes.decode('utf-8')
-        elif mime_type == 'text/plain' and 'data' in part.get('body', {}) and not html_body:
-            body_data = part['body']['data']
-            decoded_bytes = base64.urlsafe_b64decode(body_data)
-            plain_body = decoded_bytes.decode('utf-8')
-
-        # handle attachments
-        elif 'attachmentId' in part.get('body', {}):
-            attachments.append({
-                'id': part['body']['attachmentId'],
-                'filename': part.get('filename', ''),
-                'mimeType': mime_type
+
+        # Extract subject and sender
+        headers = extract_headers(message_detail, METADATA_HEADERS)
+
+        previews.append({
+            'id': message['id'],
+            'threadId': message['threadId'],
+            'subject': headers.get('subject', '(No subject)'),
+            'from': headers.get('from', ''),
+            'date': headers.get('date', '')
+        })
+    return previews
+
+
+def enrich_thread_previews(service, threads):
+    """
+    Preview listed threads by their most recent message.
+    """
+    # get basic details for all threads in batched requests
+    details = batch_get_metadata(service, [thread['id'] for thread in threads], 'threads')
+
+    previews = []
+    for thread, thread_detail in zip(threads, details):
+        # use the most recent message in the thread for preview
+        if thread_detail and thread_detail.get('messages'):
+            latest_message = thread_detail['messages'][-1]
+
+            # extract subject and sender
+            headers = extract_headers(latest_message, METADATA_HEADERS)
+
+            previews.append({
+                'id': thread['id'],
+                'subject': headers.get('subject', '(No subject)'),
+                'from': headers.get('from', ''),
+                'date': headers.get('date', ''),
+                'snippet': thread.get('snippet', ''),
+                'messageCount': len(thread_detail.get('messages', []))
             })
+    return previews
+
+
+def enrich_previews(service, resource, items):
+    """
+    Build previews for listed messages or threads.
+    """
+    if resource == 'messages':
+        return enrich_message_previews(service, items)
+    return enrich_thread_previews(service, items)
+
+
+def list_previews(service, resource='messages', query='', max_results=10, page_token=None):
+    """
+    List one page of message or thread previews.
+
+    Returns:
+        Dict with the previews under 'items' and the 'nextPageToken'
+    """
+    items, next_page_token = list_page(service, resource, query, max_results, page_token)
+    return {'items': enrich_previews(service, resource, items), 'nextPageToken': next_page_token}
+
+
+def get_profile(service):
+    """
+    Get the mailbox profile (emailAddress and current historyId).
+    """
+    return service.users().getProfile(userId='me').execute()
 
-    # Use HTML body if available, otherwise use plain text
-    body = html_body if html_body else plain_body
+
+def watch_mailbox(service, topic_name, label_ids=None):
+    """
+    Ask Gmail to publish mailbox changes to a Cloud Pub/Sub topic.
+
+    Returns:
+        Dict with the current historyId and when the watch expires
+    """
+    body = {'topicName': topic_name, 'labelIds': label_ids or ['INBOX']}
+    return service.users().watch(userId='me', body=body).execute()
+
+
+def list_history(service, start_history_id):
+    """
+    List mailbox changes since start_history_id, following every page.
+
+    Returns:
+        Tuple of (history records, latest historyId)
+    """
+    records = []
+    latest_history_id = start_history_id
+    page_token = None
+
+    while True:
+        results = service.users().history().list(
+            userId='me', startHistoryId=start_history_id, pageToken=page_token
+        ).execute()
+        records.extend(results.get('history', []))
+        latest_history_id = results.get('historyId', latest_history_id)
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return records, latest_history_id
+
+
+def parse_message(message):
+    """
+    Turn a full-format Gmail message resource into the parsed message dict.
+    """
+    parsed = parse_payload(message['payload'])
 
     return {
-        'id': message_id,
-        'headers': headers,
-        'body': body,
-        'attachments': attachments
+        'id': message['id'],
+        'threadId': message.get('threadId'),
+        'headers': parsed.headers,
+        'body': parsed.body,
+        'attachments': [attachment.to_dict() for attachment in parsed.attachments]
     }
-    
+
+
+def get_message(service, message_id):
+    """
+    Get a message by its id
+    """
+    message = service.users().messages().get(userId='me', id=message_id).execute()
+    return parse_message(message)
+
+
+def batch_get_messages(service, ids):
+    """
+    Fetch and parse many full messages using Gmail HTTP batch requests.
+
+    Returns:
+        List of parsed messages; failed lookups are left out
+    """
+    collection = service.users().messages()
+    results = execute_batches(
+        service, lambda index: collection.get(userId='me', id=ids[index]), len(ids)
+    )
+    return [parse_message(results[index]) for index in range(len(ids)) if index in results]
+
 
 def get_attachment(service, message_id, attachment_id):
     """Get an attachment by its ID"""
@@ -130,81 +498,36 @@ def list_threads(service, query='', max_results=10):
     """
     List email threads matching the query.
     """
-    results = service.users().threads().list(
-        userId='me', q=query, maxResults=max_results
-    ).execute()
-    return results.get('threads', [])
+    threads, _ = list_page(service, 'threads', query, max_results)
+    return threads
 
 
 def get_thread(service, thread_id):
     """
     Get all messages in a thread by thread_id
     """
-    try:
-        thread = service.users().threads().get(
-            userId='me', id=thread_id
-        ).execute()
-        
-        messages = []
-        for message in thread['messages']:
-            # extract headers
-            headers = {}
-            for header in message['payload']['headers']:
-                headers[header['name']] = header['value']
-
-            # process parts recursively to extract body and attachments
-            parts = [message['payload']]
-            html_body = None
-            plain_body = None
-            attachments = []
-            
-            while parts:
-                part = parts.pop(0)
-                # if the part has subparts add them to our processing queue
-                if 'parts' in part:
-                    parts.extend(part['parts'])
-                    continue
-
-                # process this part based on its MIME type
-                mime_type = part.get('mimeType', '')
-
-                if mime_type == 'text/html' and 'data' in part.get('body', {}):
-                    body_data = part['body']['data']
-                    decoded_bytes = base64.urlsafe_b64decode(body_data)
-                    html_body = decoded_bytes.decode('utf-8')
-                elif mime_type == 'text/plain' and 'data' in part.get('body', {}) and not html_body:
-                    body_data = part['body']['data']
-                    decoded_bytes = base64.urlsafe_b64decode(body_data)
-                    plain_body = decoded_bytes.decode('utf-8')
-
-                # handle attachments
-                elif 'attachmentId' in part.get('body', {}):
-                    attachments.append({
-                        'id': part['body']['attachmentId'],
-                        'filename': part.get('filename', ''),
-                        'mimeType': mime_type,
-                        'messageId': message['id']  # store the message id for attachment retrieval
-                    })
-            
-            # use html body if available, otherwise use plain text
-            body = html_body if html_body else plain_body
-
-            messages.append({
-                'id': message['id'],
-                'threadId': thread_id,
-                'headers': headers,
-                'body': body,
-                'attachments': attachments,
-                'internalDate': message.get('internalDate')  # for sorting
-            })
+    thread = service.users().threads().get(
+        userId='me', id=thread_id
+    ).execute()
+    
+    messages = []
+    for message in thread['messages']:
+        parsed = parse_payload(message['payload'], message['id'])
+
+        messages.append({
+            'id': message['id'],
+            'threadId': thread_id,
+            'headers': parsed.headers,
+            'body': parsed.body,
+            'attachments': [attachment.to_dict() for attachment in parsed.attachments],
+            'internalDate': message.get('internalDate')  # for sorting
+        })
 
-        # sort messages by internalDate
-        messages.sort(key=lambda x: int(x.get('internalDate', 0)))
-        return {
-            'id': thread_id,
-            'messages': messages,
-            'historyId': thread.get('historyId'),
-            'snippet': thread.get('snippet')
-        }
-    except Exception as e:
-        raise Exception(f"Error fetching thread {thread_id}: {e}")
\ No newline at end of file
+    # sort messages by internalDate
+    messages.sort(key=lambda x: int(x.get('internalDate', 0)))
+    return {
+        'id': thread_id,
+        'messages': messages,
+        'historyId': thread.get('historyId'),
+        'snippet': thread.get('snippet')
+    }
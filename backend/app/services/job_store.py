@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+from app.services.shared_state import STATE_BACKEND, get_redis
+
+
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "data/jobs.db")
+# seconds a job can still be polled after its last update (default one day)
+JOB_TTL = int(os.getenv("JOB_TTL", "86400"))
+# seconds between updates of a running job, even while it waits (e.g. on the Batch API)
+JOB_HEARTBEAT_INTERVAL = int(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+# an unfinished job not updated for this long lost its worker (a restart or crash)
+JOB_ORPHANED_AFTER = 3 * JOB_HEARTBEAT_INTERVAL
+ORPHANED_ERROR = "The worker running this job stopped; start the job again for the missing results"
+UNFINISHED = ("pending", "running")
+
+
+def is_orphaned(job: Dict, now: float) -> bool:
+    """Whether an unfinished job stopped getting heartbeats from its worker."""
+    return job.get("status") in UNFINISHED and now - job.get("updated_at", now) > JOB_ORPHANED_AFTER
+
+
+def new_job(account: str, kind: str, total: int, **fields) -> Dict:
+    """The initial state of a job, without results."""
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "account": account,
+        "kind": kind,
+        "status": "pending",
+        "total": total,
+        "completed": 0,
+        "failed": 0,
+        "created_at": now,
+        "updated_at": now,
+        **fields,
+    }
+
+
+class JobStore(ABC):
+    """
+    Batch job state for polling, shared by every worker process.
+
+    A job runs in the worker that started it, while any worker can answer
+    a poll for its progress and results. Running jobs are updated at least
+    every JOB_HEARTBEAT_INTERVAL; one that stops being updated lost its worker
+    and is marked failed, when the store opens or when it is polled.
+    """
+
+    @abstractmethod
+    def create(self, account: str, kind: str, total: int, **fields) -> Dict:
+        ...
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        job = self._load(job_id)
+        if job is not None and is_orphaned(job, time.time()):
+            self.update(job_id, status="failed", error=ORPHANED_ERROR)
+            job.update(status="failed", error=ORPHANED_ERROR)
+        return job
+
+    @abstractmethod
+    def _load(self, job_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def update(self, job_id: str, **fields):
+        ...
+
+    @abstractmethod
+    def add_result(self, job_id: str, item_id: str, result: Dict):
+        """Record the result for one item and bump the completed/failed counters."""
+
+    @abstractmethod
+    def fail_orphaned(self):
+        """Mark unfinished jobs whose worker went away as failed."""
+
+
+class SQLiteJobStore(JobStore):
+    """Jobs kept in SQLite, shared by the workers on one host."""
+
+    def __init__(self, path: str = JOB_STORE_PATH, ttl: int = JOB_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_results ("
+            "job_id TEXT NOT NULL, item_id TEXT NOT NULL, result TEXT NOT NULL, "
+            "PRIMARY KEY (job_id, item_id))"
+        )
+        self.purge_expired()
+        self.fail_orphaned()
+
+    def create(self, account: str, kind: str, total: int, **fields) -> Dict:
+        job = new_job(account, kind, total, **fields)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, data, expires_at) VALUES (?, ?, ?)",
+                (job["id"], json.dumps(job), time.time() + self.ttl)
+            )
+        return {**job, "results": {}}
+
+    def _load(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM jobs WHERE id = ? AND expires_at > ?", (job_id, time.time())
+            ).fetchone()
+            if row is None:
+                return None
+            results = self._conn.execute(
+                "SELECT item_id, result FROM job_results WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        return {**json.loads(row[0]), "results": {item_id: json.loads(result) for item_id, result in results}}
+
+    def update(self, job_id: str, **fields):
+        now = time.time()
+        with self._lock, self._conn:
+            # json_patch merges the fields in one statement, so concurrent updates don't race
+            self._conn.execute(
+                "UPDATE jobs SET data = json_patch(data, ?), expires_at = ? WHERE id = ?",
+                (json.dumps({**fields, "updated_at": now}), now + self.ttl, job_id)
+            )
+
+    def add_result(self, job_id: str, item_id: str, result: Dict):
+        counter = "$.failed" if "error" in result else "$.completed"
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_results (job_id, item_id, result) VALUES (?, ?, ?)",
+                (job_id, item_id, json.dumps(result))
+            )
+            self._conn.execute(
+                "UPDATE jobs SET data = json_set(data, ?, json_extract(data, ?) + 1, '$.updated_at', ?), "
+                "expires_at = ? WHERE id = ?",
+                (counter, counter, now, now + self.ttl, job_id)
+            )
+
+    def fail_orphaned(self):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET data = json_patch(data, ?) "
+                "WHERE json_extract(data, '$.status') IN (?, ?) AND json_extract(data, '$.updated_at') < ?",
+                (json.dumps({"status": "failed", "error": ORPHANED_ERROR, "updated_at": now}),
+                 *UNFINISHED, now - JOB_ORPHANED_AFTER)
+            )
+
+    def purge_expired(self):
+        """Remove expired jobs and their results."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM job_results WHERE job_id IN (SELECT id FROM jobs WHERE expires_at <= ?)",
+                (time.time(),)
+            )
+            self._conn.execute("DELETE FROM jobs WHERE expires_at <= ?", (time.time(),))
+
+
+class RedisJobStore(JobStore):
+    """
+    Jobs kept in Redis as two hashes: job:<id> with one JSON-encoded value
+    per field, and job:<id>:results with one per item.
+    """
+
+    def __init__(self, redis=None, ttl: int = JOB_TTL):
+        self.redis = redis or get_redis()
+        self.ttl = ttl
+        self.fail_orphaned()
+
+    def _write(self, job_id: str, fields: Dict, pipeline=None):
+        pipeline = pipeline or self.redis.pipeline()
+        pipeline.hset(f"job:{job_id}", mapping={name: json.dumps(value) for name, value in fields.items()})
+        pipeline.expire(f"job:{job_id}", self.ttl)
+        pipeline.expire(f"job:{job_id}:results", self.ttl)
+        return pipeline
+
+    def create(self, account: str, kind: str, total: int, **fields) -> Dict:
+        job = new_job(account, kind, total, **fields)
+        self._write(job["id"], job).execute()
+        return {**job, "results": {}}
+
+    def _load(self, job_id: str) -> Optional[Dict]:
+        pipeline = self.redis.pipeline()
+        pipeline.hgetall(f"job:{job_id}")
+        pipeline.hgetall(f"job:{job_id}:results")
+        job, results = pipeline.execute()
+        if not job:
+            return None
+        return {
+            **{name: json.loads(value) for name, value in job.items()},
+            "results": {item_id: json.loads(result) for item_id, result in results.items()},
+        }
+
+    def update(self, job_id: str, **fields):
+        self._write(job_id, {**fields, "updated_at": time.time()}).execute()
+
+    def add_result(self, job_id: str, item_id: str, result: Dict):
+        pipeline = self.redis.pipeline()
+        pipeline.hset(f"job:{job_id}:results", item_id, json.dumps(result))
+        # counters are plain integers, which are valid JSON too
+        pipeline.hincrby(f"job:{job_id}", "failed" if "error" in result else "completed", 1)
+        self._write(job_id, {"updated_at": time.time()}, pipeline).execute()
+
+    def fail_orphaned(self):
+        now = time.time()
+        for key in self.redis.scan_iter(match="job:*"):
+            if key.endswith(":results"):
+                continue
+            status, updated_at = self.redis.hmget(key, "status", "updated_at")
+            if status is None or updated_at is None:
+                continue
+            job = {"status": json.loads(status), "updated_at": json.loads(updated_at)}
+            if is_orphaned(job, now):
+                self.update(key.removeprefix("job:"), status="failed", error=ORPHANED_ERROR)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    """
+    Get the process-wide job store for STATE_BACKEND, opening it on first use.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if STATE_BACKEND == "redis":
+                    _store = RedisJobStore()
+                elif STATE_BACKEND == "sqlite":
+                    _store = SQLiteJobStore()
+                else:
+                    raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+    return _store
@@ -0,0 +1,528 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+from googleapiclient.errors import HttpError
+from app.services.gmail_service import get_message, get_thread, get_profile, list_history, \
+    list_previews, batch_get_messages
+from app.services.metrics import record_cache
+from app.services.prompt_builder import clean_email_body
+from app.services.resilience import SingleFlight
+
+
+MESSAGE_STORE_PATH = os.getenv("MESSAGE_STORE_PATH", "data/messages.db")
+# minimum seconds between users.history.list calls for an account
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", "30"))
+# most new messages fetched (and indexed for search) per history sync, 0 to disable
+SYNC_FETCH_LIMIT = int(os.getenv("SYNC_FETCH_LIMIT", "100"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account, id)
+);
+CREATE TABLE IF NOT EXISTS threads (
+    account TEXT NOT NULL,
+    id TEXT NOT NULL,
+    history_id TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account, id)
+);
+CREATE TABLE IF NOT EXISTS list_pages (
+    account TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    query TEXT NOT NULL,
+    max_results INTEGER NOT NULL,
+    page_token TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (account, kind, query, max_results, page_token)
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    account TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    attachment_id TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (account, message_id, attachment_id)
+);
+CREATE TABLE IF NOT EXISTS message_summaries (
+    account TEXT NOT NULL,
+    id TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    PRIMARY KEY (account, id)
+);
+CREATE TABLE IF NOT EXISTS thread_summaries (
+    account TEXT NOT NULL,
+    id TEXT NOT NULL,
+    history_id TEXT,
+    message_ids TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (account, id)
+);
+-- full-text search: one document per message body and per extracted attachment,
+-- the FTS rowid is the id of the document row
+CREATE TABLE IF NOT EXISTS search_docs (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    attachment_id TEXT NOT NULL,
+    thread_id TEXT,
+    date TEXT,
+    UNIQUE (account, message_id, attachment_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5(
+    subject, sender, filename, body,
+    tokenize = 'porter unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    account TEXT PRIMARY KEY,
+    history_id TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+"""
+
+
+class MessageStore:
+    """
+    Persistent SQLite store of parsed messages, threads and list results.
+
+    Everything is scoped by account (the mailbox email address). Messages never
+    change once sent, threads and list results are invalidated by history sync.
+    AI summaries of messages and threads are kept alongside; thread summaries
+    record which messages they cover so they can be extended rather than redone.
+    Attachments are indexed to the content hash of their bytes in the attachment store.
+    Message bodies and extracted attachment text are kept in an FTS5 index for local search.
+    """
+
+    def __init__(self, path: str = MESSAGE_STORE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def _fetchone(self, sql: str, params: tuple):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _execute(self, sql: str, params=()):
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
+
+    def _executemany(self, sql: str, rows: List[tuple]):
+        with self._lock, self._conn:
+            self._conn.executemany(sql, rows)
+
+    def get_message(self, account: str, message_id: str) -> Optional[Dict]:
+        row = self._fetchone(
+            "SELECT data FROM messages WHERE account = ? AND id = ?", (account, message_id)
+        )
+        return json.loads(row[0]) if row else None
+
+    def put_message(self, account: str, message: Dict):
+        self._execute(
+            "INSERT OR REPLACE INTO messages (account, id, data) VALUES (?, ?, ?)",
+            (account, message['id'], json.dumps(message))
+        )
+        self.index_message(account, message)
+
+    def get_thread(self, account: str, thread_id: str) -> Optional[Dict]:
+        row = self._fetchone(
+            "SELECT data FROM threads WHERE account = ? AND id = ?", (account, thread_id)
+        )
+        return json.loads(row[0]) if row else None
+
+    def get_thread_history_id(self, account: str, thread_id: str) -> Optional[str]:
+        row = self._fetchone(
+            "SELECT history_id FROM threads WHERE account = ? AND id = ?", (account, thread_id)
+        )
+        return row[0] if row else None
+
+    def put_thread(self, account: str, thread: Dict):
+        self._execute(
+            "INSERT OR REPLACE INTO threads (account, id, history_id, data) VALUES (?, ?, ?, ?)",
+            (account, thread['id'], thread.get('historyId'), json.dumps(thread))
+        )
+        for message in thread.get('messages', []):
+            self.index_message(account, message)
+
+    def get_list_page(self, account: str, kind: str, query: str, max_results: int,
+                      page_token: Optional[str] = None) -> Optional[Dict]:
+        row = self._fetchone(
+            "SELECT data FROM list_pages WHERE account = ? AND kind = ? AND query = ? "
+            "AND max_results = ? AND page_token = ?",
+            (account, kind, query, max_results, page_token or "")
+        )
+        return json.loads(row[0]) if row else None
+
+    def put_list_page(self, account: str, kind: str, query: str, max_results: int,
+                      page_token: Optional[str], page: Dict):
+        self._execute(
+            "INSERT OR REPLACE INTO list_pages (account, kind, query, max_results, page_token, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (account, kind, query, max_results, page_token or "", json.dumps(page))
+        )
+
+    def get_attachment_ref(self, account: str, message_id: str, attachment_id: str) -> Optional[Dict]:
+        row = self._fetchone(
+            "SELECT sha256, filename, mime_type, size FROM attachments "
+            "WHERE account = ? AND message_id = ? AND attachment_id = ?",
+            (account, message_id, attachment_id)
+        )
+        if row is None:
+            return None
+        return {"sha256": row[0], "filename": row[1], "mimeType": row[2], "size": row[3]}
+
+    def put_attachment_ref(self, account: str, message_id: str, attachment_id: str, ref: Dict):
+        self._execute(
+            "INSERT OR REPLACE INTO attachments "
+            "(account, message_id, attachment_id, sha256, filename, mime_type, size) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (account, message_id, attachment_id, ref["sha256"], ref["filename"], ref["mimeType"], ref["size"])
+        )
+
+    def _index_document(self, account: str, message_id: str, attachment_id: str,
+                        thread_id: Optional[str], date: Optional[str], fields: tuple, replace: bool):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT id FROM search_docs WHERE account = ? AND message_id = ? AND attachment_id = ?",
+                (account, message_id, attachment_id)
+            ).fetchone()
+            if row is not None:
+                if not replace:
+                    return
+                doc_id = row[0]
+                self._conn.execute("DELETE FROM search_text WHERE rowid = ?", (doc_id,))
+            else:
+                doc_id = self._conn.execute(
+                    "INSERT INTO search_docs (account, message_id, attachment_id, thread_id, date) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (account, message_id, attachment_id, thread_id, date)
+                ).lastrowid
+            self._conn.execute(
+                "INSERT INTO search_text (rowid, subject, sender, filename, body) VALUES (?, ?, ?, ?, ?)",
+                (doc_id, *fields)
+            )
+
+    def index_message(self, account: str, message: Dict):
+        """Add a message body to the search index; messages never change, so indexed ones are skipped."""
+        headers = message.get('headers', {})
+        body = clean_email_body(message['body']) if message.get('body') else ""
+        self._index_document(
+            account, message['id'], "", message.get('threadId'), headers.get('Date'),
+            (headers.get('Subject', ""), headers.get('From', ""), "", body),
+            replace=False
+        )
+
+    def index_attachment_text(self, account: str, message: Dict, attachment: Dict, text: str):
+        """Add (or replace) the text extracted from an attachment in the search index."""
+        headers = message.get('headers', {})
+        self._index_document(
+            account, message['id'], attachment['id'], message.get('threadId'), headers.get('Date'),
+            (headers.get('Subject', ""), headers.get('From', ""), attachment['filename'], text),
+            replace=True
+        )
+
+    def search(self, account: str, query: str, scope: str = "all", limit: int = 20) -> List[Dict]:
+        """
+        Rank indexed messages and attachments for a query with BM25.
+
+        Args:
+            query: FTS5 match expression (see to_match_expression)
+            scope: 'all', 'messages' (bodies only) or 'attachments' (attachment text only)
+        Returns:
+            List of hits, best first, each with a snippet around the matched terms
+        """
+        if scope == "messages":
+            scope_filter = "AND d.attachment_id = ''"
+        elif scope == "attachments":
+            scope_filter = "AND d.attachment_id != ''"
+        else:
+            scope_filter = ""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT d.message_id, d.attachment_id, d.thread_id, d.date, "
+                "s.subject, s.sender, s.filename, "
+                "snippet(search_text, 3, '**', '**', '...', 16), "
+                # matches in the subject weigh more than in the sender, filename and body
+                "bm25(search_text, 5.0, 3.0, 3.0, 1.0) AS rank "
+                "FROM search_text s JOIN search_docs d ON d.id = s.rowid "
+                f"WHERE search_text MATCH ? AND d.account = ? {scope_filter} "
+                "ORDER BY rank LIMIT ?",
+                (query, account, limit)
+            ).fetchall()
+        return [
+            {
+                "messageId": row[0],
+                "attachmentId": row[1] or None,
+                "threadId": row[2],
+                "date": row[3],
+                "subject": row[4],
+                "from": row[5],
+                "filename": row[6] or None,
+                "snippet": row[7],
+                "score": round(-row[8], 4),
+            }
+            for row in rows
+        ]
+
+    def get_message_summary(self, account: str, message_id: str) -> Optional[str]:
+        row = self._fetchone(
+            "SELECT summary FROM message_summaries WHERE account = ? AND id = ?", (account, message_id)
+        )
+        return row[0] if row else None
+
+    def put_message_summary(self, account: str, message_id: str, summary: str):
+        self._execute(
+            "INSERT OR REPLACE INTO message_summaries (account, id, summary) VALUES (?, ?, ?)",
+            (account, message_id, summary)
+        )
+
+    def get_thread_summary(self, account: str, thread_id: str) -> Optional[Dict]:
+        row = self._fetchone(
+            "SELECT history_id, message_ids, summary, updated_at FROM thread_summaries "
+            "WHERE account = ? AND id = ?",
+            (account, thread_id)
+        )
+        if row is None:
+            return None
+        return {
+            "history_id": row[0],
+            "message_ids": json.loads(row[1]),
+            "summary": row[2],
+            "updated_at": row[3],
+        }
+
+    def put_thread_summary(self, account: str, thread_id: str, history_id: Optional[str],
+                           message_ids: List[str], summary: str):
+        self._execute(
+            "INSERT OR REPLACE INTO thread_summaries "
+            "(account, id, history_id, message_ids, summary, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (account, thread_id, history_id, json.dumps(message_ids), summary, time.time())
+        )
+
+    def get_sync_state(self, account: str) -> Optional[Dict]:
+        row = self._fetchone(
+            "SELECT history_id, synced_at FROM sync_state WHERE account = ?", (account,)
+        )
+        return {"history_id": row[0], "synced_at": row[1]} if row else None
+
+    def set_sync_state(self, account: str, history_id: str):
+        self._execute(
+            "INSERT OR REPLACE INTO sync_state (account, history_id, synced_at) VALUES (?, ?, ?)",
+            (account, str(history_id), time.time())
+        )
+
+    def apply_changes(self, account: str, deleted_ids: List[str], changed_thread_ids: List[str]):
+        """Drop deleted messages and changed threads, and every cached list."""
+        self._executemany(
+            "DELETE FROM messages WHERE account = ? AND id = ?",
+            [(account, message_id) for message_id in deleted_ids]
+        )
+        self._executemany(
+            "DELETE FROM threads WHERE account = ? AND id = ?",
+            [(account, thread_id) for thread_id in changed_thread_ids]
+        )
+        self._executemany(
+            "DELETE FROM search_text WHERE rowid IN "
+            "(SELECT id FROM search_docs WHERE account = ? AND message_id = ?)",
+            [(account, message_id) for message_id in deleted_ids]
+        )
+        self._executemany(
+            "DELETE FROM search_docs WHERE account = ? AND message_id = ?",
+            [(account, message_id) for message_id in deleted_ids]
+        )
+        self._execute("DELETE FROM list_pages WHERE account = ?", (account,))
+
+    def reset(self, account: str):
+        """Forget everything cached for an account except immutable messages."""
+        self._execute("DELETE FROM threads WHERE account = ?", (account,))
+        self._execute("DELETE FROM list_pages WHERE account = ?", (account,))
+        self._execute("DELETE FROM sync_state WHERE account = ?", (account,))
+
+
+_store = None
+_store_lock = threading.Lock()
+# concurrent loads of the same item (e.g. from two tabs) share one Gmail call
+_message_flight = SingleFlight("message")
+_thread_flight = SingleFlight("thread")
+_list_flight = SingleFlight("list")
+
+
+def get_message_store() -> MessageStore:
+    """
+    Get the process-wide message store, opening it on first use.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MessageStore()
+    return _store
+
+
+def sync_account(service, store: MessageStore, account: str, force: bool = False):
+    """
+    Bring the store up to date with users.history.list deltas.
+
+    Runs at most once every SYNC_INTERVAL seconds per account unless forced.
+    """
+    state = store.get_sync_state(account)
+    if state is None:
+        # first sync: start tracking from the current mailbox state
+        store.set_sync_state(account, get_profile(service)['historyId'])
+        return
+    if not force and time.time() - state['synced_at'] < SYNC_INTERVAL:
+        return
+
+    try:
+        records, latest_history_id = list_history(service, state['history_id'])
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        # the start historyId is too old, fall back to a full resync
+        store.reset(account)
+        store.set_sync_state(account, get_profile(service)['historyId'])
+        return
+
+    added_ids = []
+    deleted_ids = set()
+    changed_thread_ids = set()
+    for record in records:
+        for change in record.get('messagesAdded', []):
+            added_ids.append(change['message']['id'])
+            changed_thread_ids.add(change['message']['threadId'])
+        for change in record.get('messagesDeleted', []):
+            deleted_ids.add(change['message']['id'])
+            changed_thread_ids.add(change['message']['threadId'])
+        # label changes can move messages in and out of query results
+        for change in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+            changed_thread_ids.add(change['message']['threadId'])
+
+    if records:
+        store.apply_changes(account, list(deleted_ids), list(changed_thread_ids))
+
+    # fetch new mail into the store so it is searchable (and opens) without a round trip
+    new_ids = [
+        message_id for message_id in dict.fromkeys(added_ids)
+        if message_id not in deleted_ids and store.get_message(account, message_id) is None
+    ]
+    if SYNC_FETCH_LIMIT > 0 and new_ids:
+        # history is listed oldest first, keep the most recent
+        for message in batch_get_messages(service, new_ids[-SYNC_FETCH_LIMIT:]):
+            store.put_message(account, message)
+    store.set_sync_state(account, latest_history_id)
+
+
+def load_message(service, account: str, message_id: str) -> Dict:
+    """
+    Get a parsed message from the store, fetching it from Gmail on a miss.
+    """
+    return _message_flight.do((account, message_id), _load_message, service, account, message_id)
+
+
+def _load_message(service, account: str, message_id: str) -> Dict:
+    store = get_message_store()
+    message = store.get_message(account, message_id)
+    record_cache("message_store", message is not None)
+    if message is None:
+        message = get_message(service, message_id)
+        store.put_message(account, message)
+    return message
+
+
+def load_thread(service, account: str, thread_id: str) -> Dict:
+    """
+    Get a parsed thread from the store, fetching it again once history sync marks it stale.
+    """
+    return _thread_flight.do((account, thread_id), _load_thread, service, account, thread_id)
+
+
+def _load_thread(service, account: str, thread_id: str) -> Dict:
+    store = get_message_store()
+    sync_account(service, store, account)
+    thread = store.get_thread(account, thread_id)
+    record_cache("message_store", thread is not None)
+    if thread is None:
+        thread = get_thread(service, thread_id)
+        store.put_thread(account, thread)
+    return thread
+
+
+def thread_history_id(service, account: str, thread_id: str) -> Optional[str]:
+    """
+    Get the historyId of the stored copy of a thread, after history sync.
+
+    Returns None if the thread isn't stored or changed since it was, so a
+    matching historyId means the stored thread is still current.
+    """
+    store = get_message_store()
+    sync_account(service, store, account)
+    return store.get_thread_history_id(account, thread_id)
+
+
+def load_list(service, account: str, kind: str, query: str, max_results: int,
+              page_token: Optional[str] = None) -> Dict:
+    """
+    Get a page of message or thread previews from the store, listing it from Gmail on a miss.
+
+    Returns:
+        Dict with the previews under 'items' and the 'nextPageToken'
+    """
+    return _list_flight.do(
+        (account, kind, query, max_results, page_token),
+        _load_list, service, account, kind, query, max_results, page_token
+    )
+
+
+def _load_list(service, account: str, kind: str, query: str, max_results: int,
+               page_token: Optional[str] = None) -> Dict:
+    store = get_message_store()
+    sync_account(service, store, account)
+    page = store.get_list_page(account, kind, query, max_results, page_token)
+    record_cache("message_store", page is not None)
+    if page is None:
+        page = list_previews(service, kind, query, max_results, page_token)
+        store.put_list_page(account, kind, query, max_results, page_token, page)
+    return page
+
+
+def to_match_expression(query: str) -> Optional[str]:
+    """
+    Turn free text into a safe FTS5 match expression.
+
+    Every word must match; "quoted phrases" are kept together and the last
+    word also matches as a prefix, so partial input finds results as it is typed.
+    Returns None if the query has no searchable words.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\w+)', query):
+        words = re.findall(r"\w+", phrase or word)
+        if words:
+            terms.append('"' + " ".join(words) + '"')
+    if not terms:
+        return None
+    if not query.rstrip().endswith('"'):
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_messages(service, account: str, query: str, scope: str = "all", limit: int = 20) -> List[Dict]:
+    """
+    Search the local index of a mailbox, after pulling in any new mail from history sync.
+    """
+    store = get_message_store()
+    sync_account(service, store, account)
+    expression = to_match_expression(query)
+    if expression is None:
+        return []
+    return store.search(account, expression, scope, limit)
@@ -0,0 +1,304 @@
+import os
+import glob
+import json
+import time
+import bisect
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from app.services.shared_state import WEB_CONCURRENCY
+
+
+logger = logging.getLogger(__name__)
+
+# add a Server-Timing header with the per-stage breakdown to every response
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+# with several workers, each one writes its metrics here and /metrics adds them all up
+METRICS_DIR = os.getenv("METRICS_DIR", "data/metrics")
+# seconds between a worker's writes, i.e. how far behind other workers' numbers can be
+METRICS_PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_INTERVAL", "5"))
+
+# seconds; covers fast cache reads up to slow model calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> List:
+        """The current values in a JSON-serialisable form, for merge()."""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(snapshots: List[List]) -> Dict:
+        """Add up snapshots (e.g. from every worker) into values for samples()."""
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        return values
+
+    def samples(self, values: Optional[Dict] = None):
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}_total{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    """Observations counted into cumulative buckets per label set."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def snapshot(self) -> List:
+        """The current values in a JSON-serialisable form, for merge()."""
+        with self._lock:
+            return [[list(key), list(counts), total] for key, (counts, total) in self._values.items()]
+
+    @staticmethod
+    def merge(snapshots: List[List]) -> Dict:
+        """Add up snapshots (e.g. from every worker) into values for samples()."""
+        values = {}
+        for snapshot in snapshots:
+            for key, counts, total in snapshot:
+                merged_counts, merged_total = values.get(tuple(key), ([0] * len(counts), 0.0))
+                values[tuple(key)] = ([a + b for a, b in zip(merged_counts, counts)], merged_total + total)
+        return values
+
+    def samples(self, values: Optional[Dict] = None):
+        if values is None:
+            with self._lock:
+                values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+HTTP_REQUESTS = Counter(
+    "http_requests", "HTTP requests handled", ("method", "route", "status")
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency until the response starts", ("method", "route")
+)
+STAGE_DURATION = Histogram(
+    "stage_duration_seconds", "Latency of request stages (Gmail, attachments, PDF, model)", ("stage",)
+)
+GMAIL_API_CALLS = Counter(
+    "gmail_api_calls", "Gmail API HTTP requests, batches counted once", ("method",)
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens", "OpenAI tokens used, by direction", ("direction",)
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests", "Cache lookups by cache and result", ("cache", "result")
+)
+ERRORS = Counter(
+    "errors", "Errors raised by request stages", ("stage",)
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries", "Gmail and OpenAI calls retried, by reason", ("upstream", "reason")
+)
+UPSTREAM_REJECTED = Counter(
+    "upstream_rejected", "Calls failed fast without reaching Gmail or OpenAI, by reason", ("upstream", "reason")
+)
+COALESCED_REQUESTS = Counter(
+    "coalesced_requests", "Calls that joined an identical call already in flight", ("kind",)
+)
+ANALYSIS_REPAIRS = Counter(
+    "analysis_repairs", "Analysis fields missing or invalid in the model's reply, by field", ("field",)
+)
+
+
+def publish():
+    """
+    Write this worker's metrics to METRICS_DIR/<pid>.json for the other workers' /metrics.
+
+    Files of workers that exited are kept, so totals never go down; serve.py
+    clears the directory when the app starts.
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    snapshot = {metric.name: metric.snapshot() for metric in _registry}
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _worker_snapshots() -> List[Dict]:
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable metrics file %s: %s", path, e)
+    return snapshots
+
+
+_publisher = None
+_publisher_stop = threading.Event()
+
+
+def start_publishing():
+    """With several workers, publish this worker's metrics every METRICS_PUBLISH_INTERVAL seconds."""
+    global _publisher
+    if WEB_CONCURRENCY <= 1 or _publisher is not None:
+        return
+
+    def loop():
+        while not _publisher_stop.wait(METRICS_PUBLISH_INTERVAL):
+            try:
+                publish()
+            except Exception as e:
+                logger.warning("Could not publish metrics: %s", e)
+
+    _publisher_stop.clear()
+    _publisher = threading.Thread(target=loop, name="metrics-publisher", daemon=True)
+    _publisher.start()
+
+
+def stop_publishing():
+    """Stop publishing, writing this worker's final numbers."""
+    global _publisher
+    if _publisher is None:
+        return
+    _publisher_stop.set()
+    _publisher.join()
+    _publisher = None
+    publish()
+
+
+def render() -> str:
+    """
+    Render every metric in the Prometheus text exposition format.
+
+    With several workers the metrics of all of them are added up, so every
+    scrape sees the same totals whichever worker answers it.
+    """
+    snapshots = None
+    if WEB_CONCURRENCY > 1:
+        publish()
+        snapshots = _worker_snapshots()
+    lines = []
+    for metric in _registry:
+        name = f"{metric.name}_total" if metric.kind == "counter" else metric.name
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        if snapshots is None:
+            lines.extend(metric.samples())
+        else:
+            lines.extend(metric.samples(metric.merge(
+                [snapshot[metric.name] for snapshot in snapshots if metric.name in snapshot]
+            )))
+    return "\n".join(lines) + "\n"
+
+
+# stage -> accumulated seconds for the request being handled
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+def start_request_timings() -> Dict[str, float]:
+    """
+    Start collecting stage timings for the current request.
+
+    The dict is shared with tasks and threads started from this context, so
+    stages timed in the thread pool are added to the same request. Stages that
+    run in parallel are summed, so they can add up to more than the total.
+    """
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Time a block as a request stage, counting it as an error if it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def record_cache(cache: str, hit: bool):
+    """Count a cache lookup."""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def server_timing_header(timings: Dict[str, float], total: float) -> str:
+    """
+    Format stage timings as a Server-Timing header value (durations in ms).
+    """
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in sorted(timings.items())]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
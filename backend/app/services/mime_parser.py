@@ -0,0 +1,112 @@
+import base64
+from collections import deque
+from typing import Dict, List, Optional
+
+
+class BodyPart:
+    """
+    A text body part whose content is only base64-decoded when asked for.
+    """
+    __slots__ = ("mime_type", "data")
+
+    def __init__(self, mime_type: str, data: str):
+        self.mime_type = mime_type
+        self.data = data
+
+    def decode(self) -> str:
+        return base64.urlsafe_b64decode(self.data).decode('utf-8')
+
+
+class Attachment:
+    """
+    Attachment reference found while walking a message payload.
+    """
+    __slots__ = ("id", "filename", "mime_type", "message_id")
+
+    def __init__(self, attachment_id: str, filename: str, mime_type: str, message_id: Optional[str] = None):
+        self.id = attachment_id
+        self.filename = filename
+        self.mime_type = mime_type
+        self.message_id = message_id
+
+    def to_dict(self) -> Dict:
+        attachment = {
+            'id': self.id,
+            'filename': self.filename,
+            'mimeType': self.mime_type
+        }
+        if self.message_id is not None:
+            # store the message id for attachment retrieval
+            attachment['messageId'] = self.message_id
+        return attachment
+
+
+class ParsedPayload:
+    """
+    Headers, body and attachments of a message payload.
+
+    Only the winning body part (the last HTML part, otherwise the last plain
+    text part) is decoded, and only when body is first read.
+    """
+    __slots__ = ("headers", "html_part", "plain_part", "attachments", "_body", "_decoded")
+
+    def __init__(self, headers: Dict, html_part: Optional[BodyPart], plain_part: Optional[BodyPart],
+                 attachments: List[Attachment]):
+        self.headers = headers
+        self.html_part = html_part
+        self.plain_part = plain_part
+        self.attachments = attachments
+        self._body = None
+        self._decoded = False
+
+    @property
+    def body(self) -> Optional[str]:
+        if not self._decoded:
+            # use html body if available, otherwise use plain text
+            part = self.html_part or self.plain_part
+            self._body = part.decode() if part else None
+            self._decoded = True
+        return self._body
+
+
+def parse_payload(payload: Dict, message_id: Optional[str] = None) -> ParsedPayload:
+    """
+    Walk a Gmail message payload iteratively to find its body and attachments.
+
+    Args:
+        payload: The message 'payload' from the Gmail API
+        message_id: Recorded on attachments when given (used for thread messages)
+    """
+    headers = {}
+    for header in payload.get('headers', []):
+        headers[header['name']] = header['value']
+
+    html_part = None
+    plain_part = None
+    attachments = []
+
+    parts = deque([payload])
+    while parts:
+        part = parts.popleft()
+        # if the part has subparts, add them to our processing queue
+        if 'parts' in part:
+            parts.extend(part['parts'])
+            continue
+
+        # process this part based on its MIME type
+        mime_type = part.get('mimeType', '')
+        body = part.get('body', {})
+
+        if mime_type == 'text/html' and 'data' in body:
+            # a later html part supersedes earlier ones, keep it undecoded for now
+            html_part = BodyPart(mime_type, body['data'])
+        elif mime_type == 'text/plain' and 'data' in body and not html_part:
+            plain_part = BodyPart(mime_type, body['data'])
+
+        # handle attachments
+        elif 'attachmentId' in body:
+            attachments.append(Attachment(
+                body['attachmentId'], part.get('filename', ''), mime_type, message_id
+            ))
+
+    return ParsedPayload(headers, html_part, plain_part, attachments)
@@ -0,0 +1,84 @@
+import asyncio
+from typing import AsyncIterator, Dict, Optional
+from app.services.gmail_service import list_page, enrich_previews
+from app.services.message_store import get_message_store, sync_account
+from app.services.executor import run_in_thread
+
+
+async def fetch_listing(service, account: str, kind: str, query: str, page_size: int,
+                        page_token: Optional[str]) -> Dict:
+    """
+    Get one page listing, from the store when it has the enriched page already.
+    """
+    store = get_message_store()
+    page = await run_in_thread(store.get_list_page, account, kind, query, page_size, page_token)
+    if page is not None:
+        return {"previews": page["items"], "nextPageToken": page["nextPageToken"]}
+
+    items, next_page_token = await run_in_thread(list_page, service, kind, query, page_size, page_token)
+    return {"items": items, "nextPageToken": next_page_token}
+
+
+async def iter_previews(
+    service,
+    account: str,
+    kind: str = 'messages',
+    query: str = '',
+    page_size: int = 50,
+    limit: Optional[int] = None,
+    page_token: Optional[str] = None
+) -> AsyncIterator[Dict]:
+    """
+    Yield up to limit message or thread previews across pages.
+
+    The next page is listed while the current one is being enriched with
+    headers. The last page is shortened to end at limit, so the final item
+    yielded, {"nextPageToken": ...}, resumes right after it.
+    """
+    def size_after(seen: int) -> int:
+        return page_size if limit is None else min(page_size, limit - seen)
+
+    store = get_message_store()
+    await run_in_thread(sync_account, service, store, account)
+
+    count = 0
+    size = size_after(0)
+    if size <= 0:
+        yield {"nextPageToken": page_token}
+        return
+    listing = await fetch_listing(service, account, kind, query, size, page_token)
+    while True:
+        next_page_token = listing["nextPageToken"]
+        next_size = size_after(count + len(listing.get("previews", listing.get("items", []))))
+
+        # prefetch the next listing while this page is enriched
+        prefetch = None
+        if next_page_token and next_size > 0:
+            prefetch = asyncio.ensure_future(
+                fetch_listing(service, account, kind, query, next_size, next_page_token)
+            )
+
+        try:
+            previews = listing.get("previews")
+            if previews is None:
+                previews = await run_in_thread(enrich_previews, service, kind, listing["items"])
+                await run_in_thread(
+                    store.put_list_page, account, kind, query, size, page_token,
+                    {"items": previews, "nextPageToken": next_page_token}
+                )
+
+            for preview in previews:
+                count += 1
+                yield preview
+        except BaseException:
+            if prefetch is not None:
+                prefetch.cancel()
+            raise
+
+        if prefetch is None:
+            break
+        page_token = next_page_token
+        size = next_size
+        listing = await prefetch
+
+    yield {"nextPageToken": next_page_token}
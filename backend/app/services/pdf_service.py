@@ -1,67 +1,208 @@
+import io
 import os
+import signal
+import threading
 import PyPDF2
-from typing import Dict
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
 
 
-def extract_text_from_pdf(file_path: str) -> str:
+# a file path, raw PDF bytes (or a memoryview over them), or a binary file-like object
+PdfSource = Union[str, bytes, bytearray, memoryview, BinaryIO]
+
+# seconds a single page may spend in extract_text before it is skipped
+PDF_PAGE_TIMEOUT = float(os.getenv("PDF_PAGE_TIMEOUT", "5"))
+# rough characters per token, used to turn a token budget into a character budget
+CHARS_PER_TOKEN = 4
+
+
+class PageTimeoutError(Exception):
+    """Raised when extracting a single page takes longer than the page timeout."""
+
+
+@contextmanager
+def time_limit(seconds: Optional[float]):
+    """
+    Raise PageTimeoutError if the block runs longer than seconds.
+
+    Uses SIGALRM, so it only applies on the main thread of a process (which is
+    where process pool workers run); elsewhere the block runs unbounded.
+    """
+    if (
+        not seconds
+        or not hasattr(signal, "SIGALRM")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def on_timeout(signum, frame):
+        raise PageTimeoutError(f"Page extraction exceeded {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+@contextmanager
+def open_pdf_stream(source: PdfSource):
+    """
+    Open a PDF source as a binary stream without writing it to disk.
+    """
+    if isinstance(source, str):
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"File not found: {source}")
+        with open(source, 'rb') as file:
+            yield file
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(source)
+    else:
+        yield source
+
+
+def iter_page_text(
+    reader: PyPDF2.PdfReader,
+    page_timeout: Optional[float] = PDF_PAGE_TIMEOUT,
+    skipped: Optional[List[int]] = None
+) -> Iterator[Tuple[int, str]]:
+    """
+    Lazily extract text page by page, yielding (page number, text).
+
+    Pages that fail or exceed page_timeout are skipped and their numbers
+    appended to skipped.
+    """
+    for page_num in range(len(reader.pages)):
+        try:
+            with time_limit(page_timeout):
+                text = reader.pages[page_num].extract_text() or ""
+        except Exception:
+            if skipped is not None:
+                skipped.append(page_num)
+            continue
+        yield page_num, text
+
+
+def iter_pdf_pages(source: PdfSource, page_timeout: Optional[float] = PDF_PAGE_TIMEOUT) -> Iterator[str]:
+    """
+    Stream the text of each page of a PDF, parsing pages only as they are consumed.
+    """
+    with open_pdf_stream(source) as stream:
+        reader = PyPDF2.PdfReader(stream)
+        for _, text in iter_page_text(reader, page_timeout):
+            yield text
+
+
+def pdf_info(reader: PyPDF2.PdfReader, extracted_words: int, extracted_chars: int, filename: str = "") -> Dict:
+    """
+    Build basic information about a parsed PDF.
+
+    The word and char counts are of the extracted text, which stops at the
+    extraction budget, not of the whole document.
+    """
+    # basic pdf info
+    info = {
+        "page_count": len(reader.pages),
+        "extracted_words": extracted_words,
+        "extracted_chars": extracted_chars,
+        "filename": filename,
+    }
+
+    # get metadata if available
+    if reader.metadata:
+        info["title"] = reader.metadata.get("/Title", "")
+        info["author"] = reader.metadata.get("/Author", "")
+        info["subject"] = reader.metadata.get("/Subject", "")
+        info["creation_date"] = reader.metadata.get("/CreationDate", "")
+
+    return info
+
+
+def extract_pdf(
+    source: PdfSource,
+    filename: Optional[str] = None,
+    max_chars: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    page_timeout: Optional[float] = PDF_PAGE_TIMEOUT
+) -> Dict:
+    """
+    Parse a PDF once and return both its text and its information.
+
+    Pages are extracted lazily and extraction stops as soon as the character
+    (or token) budget is reached, so only the pages needed are parsed.
+    Args:
+        source: File path, PDF bytes/memoryview or a binary file-like object.
+        filename: Name reported in the info (defaults to the basename of a path).
+        max_chars: Stop after this many characters of text.
+        max_tokens: Stop after roughly this many tokens of text.
+        page_timeout: Seconds allowed per page before it is skipped.
+    Returns:
+        Dict: {"text": str, "info": Dict} with page count, extracted_words and
+        extracted_chars of the extracted text, pages extracted, skipped pages and metadata.
+    """
+    if filename is None:
+        filename = os.path.basename(source) if isinstance(source, str) else ""
+
+    budget = max_chars
+    if max_tokens is not None:
+        token_chars = max_tokens * CHARS_PER_TOKEN
+        budget = token_chars if budget is None else min(budget, token_chars)
+
+    with open_pdf_stream(source) as stream:
+        try:
+            reader = PyPDF2.PdfReader(stream)
+            chunks = []
+            extracted_chars = 0
+            extracted_words = 0
+            pages_extracted = 0
+            truncated = False
+            skipped = []
+
+            for _, text in iter_page_text(reader, page_timeout, skipped):
+                text += "\n\n"
+                if budget is not None and extracted_chars + len(text) > budget:
+                    text = text[:budget - extracted_chars]
+                    truncated = True
+
+                chunks.append(text)
+                extracted_chars += len(text)
+                extracted_words += len(text.split())
+                pages_extracted += 1
+                if budget is not None and extracted_chars >= budget:
+                    break
+
+            info = pdf_info(reader, extracted_words, extracted_chars, filename)
+            info["pages_extracted"] = pages_extracted
+            info["truncated"] = truncated or pages_extracted + len(skipped) < info["page_count"]
+            info["skipped_pages"] = skipped
+            return {"text": "".join(chunks), "info": info}
+        except Exception as e:
+            raise Exception(f"Error extracting text from PDF: {str(e)}")
+
+
+def extract_text_from_pdf(source: PdfSource, max_chars: Optional[int] = None) -> str:
     """
     Extract text content from a PDF file.
     Args:
-        file_path (str): The path to the PDF file.
+        source: File path, PDF bytes/memoryview or a binary file-like object.
+        max_chars: Stop after this many characters of text.
     Returns:
         str: The text content of the PDF file.
     """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-    
-    text = ""
-    try:
-        with open(file_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            for page_num in range(len(reader.pages)):
-                page = reader.pages[page_num]
-                text += page.extract_text() + "\n\n"
-    except Exception as e:
-        raise Exception(f"Error extracting text from PDF: {str(e)}")
-
-    return text
+    return extract_pdf(source, max_chars=max_chars)["text"]
 
 
-def summarize_text(file_path: str) -> Dict:
+def summarize_text(source: PdfSource, filename: Optional[str] = None) -> Dict:
     """
     Extract basic information about a PDF.
 
     Args:
-        file_path (str): The path to the PDF file.
+        source: File path, PDF bytes/memoryview or a binary file-like object.
+        filename: Name reported in the info (defaults to the basename of a path).
     Returns:
-        Dict: Dictionary with PDF information (page count, word count, etc).
+        Dict: Dictionary with PDF information (page count, extracted word count, etc).
     """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"PDF file not found: {file_path}")
-    
-    try:
-        with open(file_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page_num in range(len(reader.pages)):
-                page = reader.pages[page_num]
-                text += page.extract_text() + "\n\n"
-
-            # basic pdf info
-            info = {
-                "page_count": len(reader.pages),
-                "word_count": len(text.split()),
-                "char_count": len(text),
-                "filename": os.path.basename(file_path),
-            }
-
-            # get metadata if available
-            if reader.metadata:
-                info["title"] = reader.metadata.get("/Title", "")
-                info["author"] = reader.metadata.get("/Author", "")
-                info["subject"] = reader.metadata.get("/Subject", "")
-                info["creation_date"] = reader.metadata.get("/CreationDate", "")
-
-            return info
-    except Exception as e:
-        pass
\ No newline at end of file
+    return extract_pdf(source, filename)["info"]
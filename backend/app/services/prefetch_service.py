@@ -0,0 +1,258 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from googleapiclient.errors import HttpError
+from app.services.ai_service import complete_analysis, analysis_cache_key, ANALYSIS_MAX_TOKENS
+from app.services.ai_cache import get_ai_cache
+from app.services.batch_service import prepare_prompt
+from app.services.gmail_service import get_profile, list_history, list_message_ids, watch_mailbox
+from app.services.prompt_builder import count_message_tokens
+from app.services.service_cache import service_cache
+from app.services.executor import run_in_thread
+
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+PREFETCH_QUERY = os.getenv("PREFETCH_QUERY", "has:attachment filename:pdf")
+# seconds between history polls per mailbox (push notifications trigger a poll right away)
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", "60"))
+# messages prefetched and analyzed at the same time, across all mailboxes
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "4"))
+# most matching messages prefetched per poll, including the first one after login
+PREFETCH_MAX_MESSAGES = int(os.getenv("PREFETCH_MAX_MESSAGES", "20"))
+# model tokens (prompt plus max completion, and embeddings) the worker may spend per UTC day
+PREFETCH_DAILY_TOKEN_BUDGET = int(os.getenv("PREFETCH_DAILY_TOKEN_BUDGET", "200000"))
+# Cloud Pub/Sub topic for Gmail push notifications; polling only if unset
+PREFETCH_PUSH_TOPIC = os.getenv("PREFETCH_PUSH_TOPIC")
+# shared secret the push subscription passes as ?token= on the webhook URL
+PUSH_WEBHOOK_TOKEN = os.getenv("PUSH_WEBHOOK_TOKEN")
+# Gmail watches expire after 7 days, renew them a day early
+WATCH_RENEW_SECONDS = 6 * 24 * 3600
+
+
+class TokenBudget:
+    """
+    Daily allowance of model tokens, reset at midnight UTC.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.day = self._today()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _today():
+        return datetime.now(timezone.utc).date()
+
+    def try_spend(self, tokens: int) -> bool:
+        """Reserve tokens if today's budget allows it."""
+        with self._lock:
+            if self._today() != self.day:
+                self.day = self._today()
+                self.used = 0
+            if self.used + tokens > self.limit:
+                return False
+            self.used += tokens
+            return True
+
+    def remaining(self) -> int:
+        with self._lock:
+            if self._today() != self.day:
+                return self.limit
+            return max(0, self.limit - self.used)
+
+
+class _Mailbox:
+    """What the worker tracks for one logged-in mailbox."""
+
+    __slots__ = ("credentials", "history_id", "polled_at", "watched_at")
+
+    def __init__(self, credentials: Dict):
+        self.credentials = credentials
+        self.history_id = None
+        self.polled_at = 0.0
+        self.watched_at = 0.0
+
+
+class Prefetcher:
+    """
+    Background worker that prefetches and pre-analyzes new mail for logged-in mailboxes.
+
+    Each mailbox is polled with users.history.list every PREFETCH_INTERVAL
+    seconds, or as soon as a Gmail push notification arrives for it. New
+    messages matching PREFETCH_QUERY are fetched into the message store, their
+    PDFs extracted (and long ones indexed for retrieval) and their analysis
+    computed into the AI cache, so opening one later is answered without
+    waiting on Gmail or the model.
+    """
+
+    def __init__(self, budget: TokenBudget):
+        self.budget = budget
+        self._mailboxes = {}
+        self._pending = set()
+        self._wakeup = None
+        self._task = None
+        self.prefetched = 0
+        self.analyzed = 0
+        self.already_cached = 0
+        self.skipped_budget = 0
+        self.errors = 0
+
+    def register(self, account: str, credentials: Dict):
+        """Start (or keep) prefetching for a mailbox, with the session's latest credentials."""
+        mailbox = self._mailboxes.get(account)
+        if mailbox is None:
+            self._mailboxes[account] = _Mailbox(credentials)
+            self.notify(account)
+        else:
+            mailbox.credentials = credentials
+
+    def unregister(self, account: Optional[str]):
+        self._mailboxes.pop(account, None)
+        self._pending.discard(account)
+
+    def notify(self, account: str) -> bool:
+        """Poll a mailbox as soon as possible. Returns False for unknown mailboxes."""
+        if account not in self._mailboxes:
+            return False
+        self._pending.add(account)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        """Start the worker on the running event loop."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            now = time.time()
+            due = [
+                account for account, mailbox in self._mailboxes.items()
+                if account in self._pending or now - mailbox.polled_at >= PREFETCH_INTERVAL
+            ]
+            self._pending.difference_update(due)
+            await asyncio.gather(*(self.poll_mailbox(account) for account in due))
+
+    async def poll_mailbox(self, account: str):
+        """Find new messages matching the query for a mailbox and prefetch them."""
+        mailbox = self._mailboxes.get(account)
+        if mailbox is None:
+            return
+        mailbox.polled_at = time.time()
+        try:
+            service = await run_in_thread(service_cache.get, mailbox.credentials)
+            if PREFETCH_PUSH_TOPIC and time.time() - mailbox.watched_at > WATCH_RENEW_SECONDS:
+                await run_in_thread(watch_mailbox, service, PREFETCH_PUSH_TOPIC)
+                mailbox.watched_at = time.time()
+            ids = await self.new_message_ids(service, mailbox)
+            await self.prefetch(service, account, ids)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Prefetch failed for %s: %s", account, e)
+
+    async def new_message_ids(self, service, mailbox: _Mailbox) -> List[str]:
+        """
+        Ids of messages matching PREFETCH_QUERY added since the last poll.
+
+        The first poll after login takes the most recent matching messages.
+        """
+        if mailbox.history_id is not None:
+            try:
+                records, latest_history_id = await run_in_thread(list_history, service, mailbox.history_id)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # the history id is too old, start over from the most recent messages
+                mailbox.history_id = None
+            else:
+                mailbox.history_id = latest_history_id
+                added = {
+                    change['message']['id']
+                    for record in records
+                    for change in record.get('messagesAdded', [])
+                }
+                if not added:
+                    return []
+                matching = await run_in_thread(
+                    list_message_ids, service, PREFETCH_QUERY, PREFETCH_MAX_MESSAGES
+                )
+                return [message_id for message_id in matching if message_id in added]
+
+        profile = await run_in_thread(get_profile, service)
+        mailbox.history_id = profile['historyId']
+        return await run_in_thread(list_message_ids, service, PREFETCH_QUERY, PREFETCH_MAX_MESSAGES)
+
+    async def prefetch(self, service, account: str, ids: List[str]):
+        semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+        async def one(message_id):
+            async with semaphore:
+                try:
+                    await self.prefetch_message(service, account, message_id)
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning("Prefetch of %s failed: %s", message_id, e)
+
+        await asyncio.gather(*(one(message_id) for message_id in ids))
+
+    async def prefetch_message(self, service, account: str, message_id: str):
+        """
+        Fetch a message and its PDFs and cache the analysis the analyze endpoint would compute.
+        """
+        # embedding long PDFs for retrieval counts against the budget too
+        prompt = await prepare_prompt(
+            service, account, message_id, True, wait_for_index=True, try_spend=self.budget.try_spend
+        )
+        self.prefetched += 1
+
+        messages = prompt["messages"]
+        cache = get_ai_cache()
+        if await run_in_thread(cache.get, analysis_cache_key(messages)) is not None:
+            self.already_cached += 1
+            return
+        # charge the prompt and the largest possible completion up front
+        if not self.budget.try_spend(count_message_tokens(messages) + ANALYSIS_MAX_TOKENS):
+            self.skipped_budget += 1
+            return
+        await complete_analysis(messages)
+        self.analyzed += 1
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self._task is not None,
+            "mailboxes": len(self._mailboxes),
+            "prefetched": self.prefetched,
+            "analyzed": self.analyzed,
+            "already_cached": self.already_cached,
+            "skipped_budget": self.skipped_budget,
+            "errors": self.errors,
+            "daily_token_budget": self.budget.limit,
+            "tokens_remaining": self.budget.remaining(),
+        }
+
+
+prefetcher = Prefetcher(TokenBudget(PREFETCH_DAILY_TOKEN_BUDGET))
@@ -0,0 +1,100 @@
+import re
+from typing import Dict, Optional
+from app.services.prompt_builder import clean_email_body
+
+
+# characters of body text in a message's computed preview field
+PREVIEW_CHARS = 300
+
+_TOKEN = re.compile(r"\s*([\w-]+|[(),])")
+
+
+def parse_fields(fields: Optional[str]) -> Optional[Dict]:
+    """
+    Parse a fields selector into a nested selection.
+
+    The syntax follows Google APIs' partial responses: comma-separated names,
+    with a sub-selection in parentheses, e.g. "id,headers(Subject,From),preview"
+    gives {"id": None, "headers": {"Subject": None, "From": None}, "preview": None}.
+
+    Returns:
+        The selection, or None to select everything
+    Raises:
+        ValueError: If the selector is malformed
+    """
+    if fields is None or not fields.strip():
+        return None
+    tokens = []
+    position = 0
+    fields = fields.strip()
+    while position < len(fields):
+        match = _TOKEN.match(fields, position)
+        if match is None:
+            raise ValueError(f"Unexpected character in fields at {position}: {fields[position]!r}")
+        tokens.append(match.group(1))
+        position = match.end()
+
+    selection, end = _parse_selection(tokens, 0)
+    if end != len(tokens):
+        raise ValueError("Unbalanced parentheses in fields")
+    return selection
+
+
+def _parse_selection(tokens, index):
+    selection = {}
+    while True:
+        if index >= len(tokens) or tokens[index] in "(),":
+            raise ValueError("Expected a field name in fields")
+        name = tokens[index]
+        index += 1
+        sub_selection = None
+        if index < len(tokens) and tokens[index] == "(":
+            sub_selection, index = _parse_selection(tokens, index + 1)
+            if index >= len(tokens) or tokens[index] != ")":
+                raise ValueError("Unbalanced parentheses in fields")
+            index += 1
+        selection[name] = sub_selection
+        if index < len(tokens) and tokens[index] == ",":
+            index += 1
+            continue
+        return selection, index
+
+
+def message_preview(message: Dict) -> Optional[str]:
+    """Plain text start of a message body, for list and thread views that don't need the HTML."""
+    if "body" not in message:
+        return None
+    text = clean_email_body(message["body"]) if message["body"] else ""
+    if len(text) <= PREVIEW_CHARS:
+        return text
+    # cut at a word boundary
+    return text[:PREVIEW_CHARS].rsplit(" ", 1)[0] + "…"
+
+
+# fields computed from the data when selected, rather than stored
+COMPUTED_FIELDS = {
+    "preview": message_preview,
+}
+
+
+def project(data, selection: Optional[Dict]):
+    """
+    Keep only the selected fields of a response, recursing into lists and
+    sub-selections. Unknown fields are left out rather than rejected.
+    """
+    if selection is None:
+        return data
+    if isinstance(data, list):
+        return [project(item, selection) for item in data]
+    if not isinstance(data, dict):
+        return data
+
+    result = {}
+    for name, sub_selection in selection.items():
+        if name in data:
+            result[name] = project(data[name], sub_selection)
+        elif name in COMPUTED_FIELDS:
+            value = COMPUTED_FIELDS[name](data)
+            if value is not None:
+                result[name] = value
+    return result
@@ -0,0 +1,202 @@
+import os
+import re
+import html
+import logging
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# tokens of email and attachment content allowed in a prompt
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+TOKENIZER_MODEL = "gpt-4o-mini"
+# used when no local tokenizer is available
+CHARS_PER_TOKEN = 4
+
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding():
+    """
+    Get the tiktoken encoding for the model, or None if it can't be loaded.
+    """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+        except Exception as e:
+            logger.warning("Falling back to estimated token counts: %s", e)
+    return _encoding
+
+
+@lru_cache(maxsize=1024)
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens in text with the local tokenizer (estimated without one).
+    """
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut text down to at most max_tokens tokens.
+    """
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """
+    Count the tokens of chat messages, including the per-message overhead.
+    """
+    # every message costs a few tokens for its role and separators
+    return sum(count_tokens(message["content"]) + 4 for message in messages) + 3
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document, skipping quoted replies."""
+
+    BLOCK_TAGS = {"br", "p", "div", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "blockquote"}
+    SKIP_TAGS = {"script", "style", "head", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self._skip_tag = None
+        self._skip_depth = 0
+
+    def _is_quote(self, tag, attrs):
+        attrs = dict(attrs)
+        if "gmail_quote" in (attrs.get("class") or ""):
+            return True
+        return tag == "blockquote" and attrs.get("type") == "cite"
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+        if tag in self.SKIP_TAGS or self._is_quote(tag, attrs):
+            self._skip_tag = tag
+            self._skip_depth = 1
+            return
+        if tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    self._skip_tag = None
+            return
+        if tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if self._skip_tag is None:
+            self.chunks.append(data)
+
+
+def html_to_text(markup: str) -> str:
+    """
+    Convert an HTML email body to plain text, dropping markup, styles and quoted replies.
+    """
+    parser = _TextExtractor()
+    try:
+        parser.feed(markup)
+        parser.close()
+    except Exception:
+        # fall back to stripping tags if the markup is too broken to parse
+        return html.unescape(re.sub(r"<[^>]+>", " ", markup))
+    return "".join(parser.chunks)
+
+
+ATTRIBUTION_LINE = re.compile(r"^On .{1,200} wrote:$")
+ORIGINAL_MESSAGE = re.compile(r"^(-{3,}\s*Original Message\s*-{3,}|_{10,})$", re.IGNORECASE)
+
+
+def strip_quoted_replies(text: str) -> str:
+    """
+    Remove quoted reply chains from a plain text body.
+
+    Drops '>' quoted lines and "On ... wrote:" attributions, and cuts
+    everything below an Outlook style "Original Message" separator.
+    """
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if ORIGINAL_MESSAGE.match(stripped):
+            break
+        if stripped.startswith(">") or ATTRIBUTION_LINE.match(stripped):
+            continue
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+
+def collapse_whitespace(text: str) -> str:
+    """Collapse runs of spaces and blank lines."""
+    text = re.sub(r"[ \t ]+", " ", text)
+    text = re.sub(r"\n\s*\n+", "\n\n", text)
+    return text.strip()
+
+
+@lru_cache(maxsize=256)
+def clean_email_body(body: str) -> str:
+    """
+    Turn a raw (HTML or plain text) email body into compact text for a prompt.
+    """
+    if re.search(r"<(html|body|div|p|br|table|span)\b", body, re.IGNORECASE):
+        body = html_to_text(body)
+    return collapse_whitespace(strip_quoted_replies(body))
+
+
+def fit_body(email_content: Dict, budget: int = PROMPT_TOKEN_BUDGET) -> str:
+    """
+    Get the cleaned email body, cut to the token budget.
+    """
+    body = email_content.get("body")
+    if not body:
+        return "No body content"
+    return truncate_to_tokens(clean_email_body(body), budget)
+
+
+def attachment_token_budget(email_content: Dict, budget: int = PROMPT_TOKEN_BUDGET) -> int:
+    """
+    Tokens left for attachments once the body has taken its share.
+    """
+    return max(0, budget - count_tokens(fit_body(email_content, budget)))
+
+
+def build_context(email_content: Dict, pdf_text: Optional[str] = None,
+                  budget: int = PROMPT_TOKEN_BUDGET) -> Dict:
+    """
+    Fill the token budget by priority: the email body first, then attachment text.
+
+    Returns:
+        Dict with body, pdf_text (None if nothing fits) and the content tokens used
+    """
+    body = fit_body(email_content, budget)
+    remaining = max(0, budget - count_tokens(body))
+    pdf_text = truncate_to_tokens(pdf_text, remaining) if pdf_text else None
+    return {
+        "body": body,
+        "pdf_text": pdf_text or None,
+        "tokens": count_tokens(body) + count_tokens(pdf_text or ""),
+    }
@@ -0,0 +1,348 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from typing import Callable, Dict, Optional, Tuple
+from app.services.metrics import timed, UPSTREAM_RETRIES, UPSTREAM_REJECTED, COALESCED_REQUESTS
+from app.services.shared_state import WEB_CONCURRENCY
+
+
+# retries after the first attempt for rate limits and transient errors
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "4"))
+# longest a call waits for its rate limit before failing fast instead
+UPSTREAM_MAX_WAIT = float(os.getenv("UPSTREAM_MAX_WAIT", "20"))
+# consecutive failures that open a circuit, and seconds before it is tried again
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# error kinds returned by an upstream's classify function
+RATE_LIMITED = "rate_limited"
+UNAVAILABLE = "unavailable"
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Gmail or OpenAI can't take the call right now: rate limited, failing or
+    behind an open circuit. The API answers these with 503 and Retry-After.
+    """
+
+    def __init__(self, upstream: str, reason: str, retry_after: float):
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = max(1.0, retry_after)
+        super().__init__(f"{upstream} is {reason}, retry in {self.retry_after:.0f}s")
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """The Retry-After an error's HTTP response asked for, if any."""
+    response = getattr(error, "response", None) or getattr(error, "resp", None)
+    headers = getattr(response, "headers", response)
+    retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+    try:
+        return float(retry_after) if retry_after else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, error: Optional[Exception] = None, cap: float = 60.0) -> float:
+    """
+    Seconds to wait before retrying: the server's Retry-After if given,
+    otherwise jittered exponential backoff; either is capped at cap.
+    """
+    retry_after = retry_after_seconds(error) if error is not None else None
+    if retry_after is not None:
+        return min(cap, retry_after)
+    return min(cap, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class TokenBucket:
+    """
+    Rate limiter refilled continuously at rate units per second, up to capacity.
+
+    reserve() takes the units immediately and returns how long the caller
+    must wait before using them, so sync and async callers share one bucket.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, max_wait: float) -> Optional[float]:
+        """
+        Reserve amount units, returning the seconds to wait, or None (and
+        reserving nothing) if that would be longer than max_wait.
+        """
+        # a single call larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = max(0.0, (amount - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self.tokens -= amount
+            return wait
+
+    def pause(self, seconds: float):
+        """Empty the bucket for seconds, e.g. after the server answered 429."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after repeated upstream failures.
+
+    After failure_threshold consecutive failures the circuit opens for
+    reset_timeout seconds; then one trial call is let through, and its
+    outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_timeout else "half_open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # half open: let this call through and hold the others back until it finishes
+            self.opened_at = time.monotonic()
+            return True
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class Upstream:
+    """
+    Pacing, retries and a circuit breaker around the calls to one upstream API.
+
+    Calls are paced with token buckets per key (e.g. one per Gmail user), one
+    bucket per limit (e.g. requests and tokens per minute); a call states how
+    much of each limit it costs. Rate-limit errors and transient failures are
+    retried with jittered exponential backoff. A 429 also pauses that key's
+    buckets for everyone. Only transient failures count towards the breaker,
+    so one user exhausting their quota doesn't cut off the others.
+
+    Buckets live in process memory, so with several workers each one paces
+    itself to its share (1 / WEB_CONCURRENCY) of every limit.
+    """
+
+    def __init__(self, name: str, limits: Dict[str, Tuple[float, float]],
+                 classify: Callable[[Exception], Optional[str]],
+                 max_retries: int = UPSTREAM_MAX_RETRIES, max_wait: float = UPSTREAM_MAX_WAIT):
+        """
+        Args:
+            name: Upstream name for errors and metrics
+            limits: limit name -> (units per second, burst capacity)
+            classify: Returns RATE_LIMITED or UNAVAILABLE for retryable errors, None otherwise
+        """
+        self.name = name
+        self.limits = limits
+        self.classify = classify
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.breaker = CircuitBreaker()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str, limit: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get((key, limit))
+            if bucket is None:
+                rate, capacity = self.limits[limit]
+                bucket = self._buckets[(key, limit)] = TokenBucket(
+                    rate / WEB_CONCURRENCY, capacity / WEB_CONCURRENCY
+                )
+            return bucket
+
+    def reset(self):
+        """Forget every key's pacing and close the breaker, e.g. between benchmark runs."""
+        with self._lock:
+            self._buckets.clear()
+        self.breaker.record_success()
+
+    def _admit(self, key: str, costs: Dict[str, float]) -> float:
+        """Check the breaker and reserve the call's costs, returning the seconds to wait."""
+        if not self.breaker.allow():
+            UPSTREAM_REJECTED.inc(upstream=self.name, reason="circuit_open")
+            raise UpstreamUnavailable(self.name, "paused after repeated failures", self.breaker.retry_after())
+        wait = 0.0
+        for limit, cost in costs.items():
+            bucket = self._bucket(key, limit)
+            reserved = bucket.reserve(cost, self.max_wait)
+            if reserved is None:
+                UPSTREAM_REJECTED.inc(upstream=self.name, reason="rate_limit")
+                shortfall = min(cost, bucket.capacity) - bucket.tokens
+                raise UpstreamUnavailable(self.name, "over its rate limit", shortfall / bucket.rate)
+            wait = max(wait, reserved)
+        return wait
+
+    def _failed(self, key: str, attempt: int, error: Exception) -> float:
+        """
+        Record a failed attempt, returning the seconds to wait before retrying.
+
+        Raises the error itself if it isn't retryable, or UpstreamUnavailable
+        once retries are used up or the wait would be longer than max_wait.
+        """
+        kind = self.classify(error)
+        if kind is None:
+            # the upstream answered, e.g. 404 for a deleted message
+            self.breaker.record_success()
+            raise error
+        # the server's Retry-After is kept whole here, so a long one fails fast
+        # (and is passed on to the client) rather than being shortened
+        delay = backoff_delay(attempt, error, cap=float("inf"))
+        if kind == RATE_LIMITED:
+            for limit in self.limits:
+                self._bucket(key, limit).pause(delay)
+        else:
+            self.breaker.record_failure()
+        if attempt >= self.max_retries or delay > self.max_wait or self.breaker.state == "open":
+            reason = "rate limited" if kind == RATE_LIMITED else "failing"
+            raise UpstreamUnavailable(self.name, reason, delay) from error
+        UPSTREAM_RETRIES.inc(upstream=self.name, reason=kind)
+        return delay
+
+    def call(self, key: str, costs: Dict[str, float], fn: Callable, *args, **kwargs):
+        """Run a blocking upstream call with pacing, retries and the breaker."""
+        attempt = 0
+        while True:
+            wait = self._admit(key, costs)
+            if wait:
+                with timed(f"{self.name}_pacing"):
+                    time.sleep(wait)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                time.sleep(self._failed(key, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, key: str, costs: Dict[str, float], fn: Callable, *args, **kwargs):
+        """Await an upstream coroutine function with pacing, retries and the breaker."""
+        attempt = 0
+        while True:
+            wait = self._admit(key, costs)
+            if wait:
+                with timed(f"{self.name}_pacing"):
+                    await asyncio.sleep(wait)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self._failed(key, attempt, e))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical blocking calls made at the same time from different threads.
+
+    The first caller for a key runs the function; callers arriving while it
+    runs wait for and share its result (or exception).
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn: Callable, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            COALESCED_REQUESTS.inc(kind=self.kind)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """
+    Coalesces identical coroutine calls awaited at the same time.
+
+    The call runs as its own task, so a caller that goes away (e.g. a closed
+    tab) doesn't cancel it for the others.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._tasks = {}
+
+    async def do(self, key, fn: Callable, *args):
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._finished(key, task))
+        else:
+            COALESCED_REQUESTS.inc(kind=self.kind)
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task: asyncio.Task):
+        self._tasks.pop(key, None)
+        # mark the error as seen in case every caller went away
+        if not task.cancelled():
+            task.exception()
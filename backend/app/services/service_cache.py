@@ -0,0 +1,136 @@
+import os
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from typing import Dict
+from google.auth.transport.requests import Request as AuthRequest
+from app.services.gmail_service import credentials_from_dict, build_service_from_credentials
+from app.services.metrics import record_cache
+
+
+SERVICE_CACHE_SIZE = int(os.getenv("SERVICE_CACHE_SIZE", "256"))
+SERVICE_CACHE_TTL = int(os.getenv("SERVICE_CACHE_TTL", "3600"))
+# refresh access tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+
+
+def expiry_utc(credentials) -> datetime:
+    """The credentials' expiry as an aware UTC datetime (google-auth stores it naive, in UTC)."""
+    expiry = credentials.expiry
+    return expiry if expiry.tzinfo is not None else expiry.replace(tzinfo=timezone.utc)
+
+
+class _Entry:
+    __slots__ = ("service", "credentials", "created_at", "lock")
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.service = build_service_from_credentials(credentials)
+        self.created_at = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class ServiceCache:
+    """
+    Thread-safe LRU/TTL cache of built Gmail service objects.
+
+    Entries are keyed on the OAuth client id and refresh token, so every
+    logged-in user reuses one service (and its HTTP connections) across requests.
+    """
+
+    def __init__(self, max_size: int = SERVICE_CACHE_SIZE, ttl: int = SERVICE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    @staticmethod
+    def cache_key(credentials_dict: Dict) -> str:
+        """Hash the identifying credential fields so secrets aren't kept as keys."""
+        raw = f"{credentials_dict.get('client_id')}:{credentials_dict.get('refresh_token')}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, credentials_dict: Dict):
+        """
+        Get a Gmail service for the credentials, building it on a miss.
+        """
+        key = self.cache_key(credentials_dict)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.created_at > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+        record_cache("gmail_service", entry is not None)
+        if entry is None:
+            # build outside the cache lock, building can hit the network
+            entry = _Entry(credentials_from_dict(credentials_dict))
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        self._refresh_if_expiring(entry)
+        return entry.service
+
+    def get_credentials(self, credentials_dict: Dict):
+        """Get the live (possibly refreshed) credentials behind a cached service."""
+        with self._lock:
+            entry = self._entries.get(self.cache_key(credentials_dict))
+        return entry.credentials if entry is not None else None
+
+    def _refresh_if_expiring(self, entry: _Entry):
+        """Refresh the access token before it expires instead of on a 401."""
+        credentials = entry.credentials
+        if credentials.expiry is None:
+            return
+
+        deadline = datetime.now(timezone.utc) + timedelta(seconds=TOKEN_REFRESH_MARGIN)
+        if expiry_utc(credentials) > deadline:
+            return
+
+        with entry.lock:
+            # another thread may have refreshed while we waited for the lock
+            if credentials.expiry is not None and expiry_utc(credentials) <= deadline:
+                credentials.refresh(AuthRequest())
+                with self._lock:
+                    self.refreshes += 1
+
+    def invalidate(self, credentials_dict: Dict):
+        """Drop the cached service for these credentials (e.g. on logout)."""
+        with self._lock:
+            self._entries.pop(self.cache_key(credentials_dict), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "refreshes": self.refreshes,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+service_cache = ServiceCache()
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import secrets
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional
+from app.services.shared_state import STATE_BACKEND, get_redis
+
+
+# "sqlite" and "redis" keep sessions across restarts and share them between
+# workers, "memory" forgets them and only works with a single worker
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", STATE_BACKEND)
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "data/sessions.db")
+# seconds a session lives after it was last changed (default two weeks)
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE", str(14 * 24 * 3600)))
+# sessions kept in memory in front of the SQLite store
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1024"))
+# seconds between removals of expired sessions from the memory and SQLite stores
+SESSION_PURGE_INTERVAL = int(os.getenv("SESSION_PURGE_INTERVAL", "3600"))
+
+
+def new_session_id() -> str:
+    """Generate an unguessable session id for the cookie."""
+    return secrets.token_urlsafe(32)
+
+
+class SessionStore(ABC):
+    """
+    Server-side session data keyed by an opaque session id.
+
+    Implementations return copies, so callers can change the session dict
+    freely and save it back with set.
+    """
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def set(self, session_id: str, data: Dict, max_age: int = SESSION_MAX_AGE):
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        ...
+
+    def purge_expired(self):
+        """Remove expired sessions; stores that expire them by themselves don't need to."""
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in process memory; lost on restart and not shared between workers."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._sessions[session_id]
+                return None
+            return json.loads(entry[0])
+
+    def set(self, session_id: str, data: Dict, max_age: int = SESSION_MAX_AGE):
+        with self._lock:
+            self._sessions[session_id] = (json.dumps(data), time.time() + max_age)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [session_id for session_id, entry in self._sessions.items() if entry[1] <= now]
+            for session_id in expired:
+                del self._sessions[session_id]
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions persisted in SQLite, with an in-memory LRU of recent sessions.
+
+    Writes go through to disk, so refreshed tokens survive restarts, while
+    reads of active sessions are served from memory. The memory copy is
+    dropped whenever another worker process has written to the database, so
+    workers never serve each other's stale (or logged out) sessions.
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH, cache_size: int = SESSION_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        self._data_version = None
+        self.purge_expired()
+
+    def _sync(self):
+        """Forget cached sessions if another connection committed since the last check."""
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._cache.clear()
+            self._data_version = version
+
+    def _remember(self, session_id: str, entry):
+        self._cache[session_id] = entry
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            self._sync()
+            entry = self._cache.get(session_id)
+            if entry is not None:
+                self._cache.move_to_end(session_id)
+            else:
+                entry = self._conn.execute(
+                    "SELECT data, expires_at FROM sessions WHERE id = ?", (session_id,)
+                ).fetchone()
+                if entry is None:
+                    return None
+                self._remember(session_id, entry)
+
+            if entry[1] <= now:
+                self._cache.pop(session_id, None)
+                return None
+            return json.loads(entry[0])
+
+    def set(self, session_id: str, data: Dict, max_age: int = SESSION_MAX_AGE):
+        entry = (json.dumps(data), time.time() + max_age)
+        with self._lock, self._conn:
+            self._remember(session_id, entry)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, entry[0], entry[1])
+            )
+
+    def delete(self, session_id: str):
+        with self._lock, self._conn:
+            self._cache.pop(session_id, None)
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def purge_expired(self):
+        """Remove expired sessions from disk."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions kept in Redis under session:<id>, expiring with the session."""
+
+    def __init__(self, redis=None):
+        self.redis = redis or get_redis()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        data = self.redis.get(f"session:{session_id}")
+        return json.loads(data) if data is not None else None
+
+    def set(self, session_id: str, data: Dict, max_age: int = SESSION_MAX_AGE):
+        self.redis.set(f"session:{session_id}", json.dumps(data), ex=max_age)
+
+    def delete(self, session_id: str):
+        self.redis.delete(f"session:{session_id}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """
+    Get the process-wide session store for SESSION_BACKEND, opening it on first use.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if SESSION_BACKEND == "memory":
+                    _store = MemorySessionStore()
+                elif SESSION_BACKEND == "sqlite":
+                    _store = SQLiteSessionStore()
+                elif SESSION_BACKEND == "redis":
+                    _store = RedisSessionStore()
+                else:
+                    raise ValueError(f"Unknown SESSION_BACKEND: {SESSION_BACKEND}")
+    return _store
@@ -0,0 +1,36 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Redis shared by every worker (and host), e.g. redis://localhost:6379/0
+REDIS_URL = os.getenv("REDIS_URL")
+# where sessions, AI completions and batch jobs are shared between worker
+# processes: "redis", or "sqlite" files under data/ for workers on one host
+STATE_BACKEND = os.getenv("STATE_BACKEND", "redis" if REDIS_URL else "sqlite")
+# worker processes serving the app; the production entry point sets it for its workers
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def get_redis():
+    """
+    Get the process-wide Redis client for REDIS_URL, connecting on first use.
+
+    The redis package is only needed when the Redis backend is used.
+    """
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                if not REDIS_URL:
+                    raise ValueError("STATE_BACKEND is redis but REDIS_URL is not set")
+                try:
+                    import redis
+                except ImportError:
+                    raise RuntimeError("The redis package is required for the Redis backend: pip install redis")
+                _redis = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _redis
@@ -0,0 +1,198 @@
+import os
+import asyncio
+from typing import Dict, List, Optional
+from app.services.ai_service import complete
+from app.services.message_store import get_message_store, load_thread
+from app.services.prompt_builder import PROMPT_TOKEN_BUDGET, fit_body, count_tokens
+from app.services.executor import run_in_thread
+
+
+MESSAGE_SUMMARY_MAX_TOKENS = 200
+THREAD_SUMMARY_MAX_TOKENS = 500
+# tokens of a single message body included in its summary prompt
+MESSAGE_SUMMARY_TOKEN_BUDGET = int(os.getenv("MESSAGE_SUMMARY_TOKEN_BUDGET", "1500"))
+# max message summaries generated at the same time per thread
+THREAD_SUMMARY_CONCURRENCY = int(os.getenv("THREAD_SUMMARY_CONCURRENCY", "8"))
+
+
+def build_message_summary_messages(message: Dict) -> List[Dict]:
+    """
+    Build the chat messages used to summarize one message of a thread.
+    """
+    headers = message.get('headers', {})
+    attachments = ", ".join(a['filename'] for a in message.get('attachments', []))
+    prompt = f"""
+    Summarize this email from a longer thread in two or three sentences.
+    Mention any questions, decisions, requests or deadlines it contains.
+
+    From: {headers.get('From', 'Unknown sender')}
+    Date: {headers.get('Date', 'Unknown date')}
+    Subject: {headers.get('Subject', 'No subject')}
+    Attachments: {attachments or 'None'}
+
+    Body:
+    {fit_body(message, MESSAGE_SUMMARY_TOKEN_BUDGET)}
+    """
+    return [
+        {"role": "system", "content": "You are an AI assistant that summarizes email threads."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def format_message_summary(message: Dict, summary: str) -> str:
+    """One line per message for the fold prompt."""
+    headers = message.get('headers', {})
+    return f"- {headers.get('From', 'Unknown sender')} ({headers.get('Date', 'unknown date')}): {summary}"
+
+
+def build_fold_messages(previous_summary: Optional[str], lines: List[str]) -> List[Dict]:
+    """
+    Build the chat messages used to fold new message summaries into the thread summary.
+    """
+    new_messages = "\n".join(lines)
+    if previous_summary:
+        prompt = f"""
+        Here is the summary of an email thread so far:
+        {previous_summary}
+
+        These messages have since been added to the thread, oldest first:
+        {new_messages}
+
+        Rewrite the summary so it covers the whole thread, including the new messages.
+        Keep open questions, decisions and action items, and note who owes a reply.
+        """
+    else:
+        prompt = f"""
+        Here are summaries of the messages in an email thread, oldest first:
+        {new_messages}
+
+        Write a concise summary of the whole thread.
+        Keep open questions, decisions and action items, and note who owes a reply.
+        """
+    return [
+        {"role": "system", "content": "You are an AI assistant that summarizes email threads."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def chunk_lines(lines: List[str], budget: int) -> List[List[str]]:
+    """
+    Group summary lines into chunks that each fit in budget tokens.
+    """
+    chunks = [[]]
+    used = 0
+    for line in lines:
+        tokens = count_tokens(line)
+        if chunks[-1] and used + tokens > budget:
+            chunks.append([])
+            used = 0
+        chunks[-1].append(line)
+        used += tokens
+    return chunks
+
+
+async def summarize_message(account: str, message: Dict, force_refresh: bool = False) -> str:
+    """
+    Get the summary of one message, generating and storing it on first use.
+    """
+    store = get_message_store()
+    if not force_refresh:
+        summary = await run_in_thread(store.get_message_summary, account, message['id'])
+        if summary is not None:
+            return summary
+
+    summary = await complete(
+        build_message_summary_messages(message),
+        max_tokens=MESSAGE_SUMMARY_MAX_TOKENS,
+        force_refresh=force_refresh
+    )
+    await run_in_thread(store.put_message_summary, account, message['id'], summary)
+    return summary
+
+
+async def summarize_messages(account: str, messages: List[Dict], force_refresh: bool = False) -> List[str]:
+    """
+    Summarize messages with bounded concurrency, keeping their order.
+    """
+    semaphore = asyncio.Semaphore(THREAD_SUMMARY_CONCURRENCY)
+
+    async def summarize(message):
+        async with semaphore:
+            return await summarize_message(account, message, force_refresh)
+
+    return await asyncio.gather(*(summarize(message) for message in messages))
+
+
+async def fold_summaries(previous_summary: Optional[str], lines: List[str],
+                         force_refresh: bool = False) -> str:
+    """
+    Fold message summary lines into the rolling thread summary, one chunk at a time.
+    """
+    summary = previous_summary
+    budget = max(1, PROMPT_TOKEN_BUDGET - count_tokens(previous_summary or ""))
+    for chunk in chunk_lines(lines, budget):
+        summary = await complete(
+            build_fold_messages(summary, chunk),
+            max_tokens=THREAD_SUMMARY_MAX_TOKENS,
+            force_refresh=force_refresh
+        )
+    return summary
+
+
+async def analyze_thread(service, account: str, thread_id: str, force_refresh: bool = False) -> Dict:
+    """
+    Summarize a thread incrementally.
+
+    Each message is summarized once and stored. The thread summary records the
+    messages it covers; when the thread grows only the new messages are
+    summarized and folded into it. If messages were removed the summary is
+    rebuilt from the stored per-message summaries.
+
+    Returns:
+        Dict with the thread summary, per-message summaries and how many
+        messages were newly summarized
+    """
+    store = get_message_store()
+    thread = await run_in_thread(load_thread, service, account, thread_id)
+    messages = thread['messages']
+    message_ids = [message['id'] for message in messages]
+
+    state = None if force_refresh else await run_in_thread(store.get_thread_summary, account, thread_id)
+    if state is not None and message_ids[:len(state['message_ids'])] == state['message_ids']:
+        previous_summary = state['summary']
+        new_messages = messages[len(state['message_ids']):]
+    else:
+        previous_summary = None
+        new_messages = messages
+
+    # summaries of already covered messages come straight from the store
+    summaries = await summarize_messages(account, messages, force_refresh)
+    by_id = dict(zip(message_ids, summaries))
+
+    summary = previous_summary
+    if new_messages:
+        lines = [format_message_summary(message, by_id[message['id']]) for message in new_messages]
+        if previous_summary is None and len(lines) == 1:
+            # a single message needs no separate thread summary
+            summary = by_id[new_messages[0]['id']]
+        else:
+            summary = await fold_summaries(previous_summary, lines, force_refresh)
+        await run_in_thread(
+            store.put_thread_summary, account, thread_id, thread.get('historyId'), message_ids, summary
+        )
+
+    return {
+        "thread_id": thread_id,
+        "history_id": thread.get('historyId'),
+        "summary": summary,
+        "messages": [
+            {
+                "id": message['id'],
+                "from": message.get('headers', {}).get('From'),
+                "date": message.get('headers', {}).get('Date'),
+                "summary": by_id[message['id']],
+            }
+            for message in messages
+        ],
+        "new_messages": len(new_messages),
+    }
@@ -0,0 +1,191 @@
+import os
+import json
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from app.services.ai_service import embed, EMBEDDING_MODEL
+from app.services.metrics import record_cache
+from app.services.prompt_builder import get_encoding, count_tokens, truncate_to_tokens, CHARS_PER_TOKEN
+
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "data/vectors")
+# indexes kept in memory in front of the files
+VECTOR_INDEX_CACHE_SIZE = int(os.getenv("VECTOR_INDEX_CACHE_SIZE", "32"))
+# tokens per chunk of attachment text
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "200"))
+# tokens of the email used to look up relevant chunks
+QUERY_MAX_TOKENS = 1000
+# marks text left out between two retrieved chunks
+GAP = "\n[...]\n"
+
+
+def chunk_text(text: str, chunk_tokens: int = CHUNK_TOKENS) -> List[str]:
+    """
+    Split text into consecutive chunks of about chunk_tokens tokens.
+
+    Chunks don't overlap, so neighbouring chunks join back into the original text.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        size = chunk_tokens * CHARS_PER_TOKEN
+        return [text[start:start + size] for start in range(0, len(text), size)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return [
+        encoding.decode(tokens[start:start + chunk_tokens])
+        for start in range(0, len(tokens), chunk_tokens)
+    ]
+
+
+class VectorIndex:
+    """
+    Embedded chunks of one document, searched by brute-force cosine similarity.
+
+    Fine for the few hundred chunks of a single attachment; search is the
+    only method a nearest-neighbour index would need to replace.
+    """
+
+    def __init__(self, chunks: List[str], vectors: np.ndarray, info: Optional[Dict] = None):
+        self.chunks = chunks
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+        self.info = info
+        self.chunk_tokens = [count_tokens(chunk) for chunk in chunks]
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def search(self, query_vector: np.ndarray, k: Optional[int] = None) -> List[int]:
+        """Indexes of the k chunks most similar to the query, best first."""
+        scores = self.vectors @ (query_vector / max(np.linalg.norm(query_vector), 1e-12))
+        if k is not None and k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+            return top[np.argsort(-scores[top])].tolist()
+        return np.argsort(-scores).tolist()
+
+    def excerpt(self, query_vector: np.ndarray, budget: int) -> str:
+        """
+        The chunks most relevant to the query that fit in budget tokens, in document order.
+        """
+        gap_tokens = count_tokens(GAP)
+        selected = []
+        used = 0
+        for index in self.search(query_vector):
+            cost = self.chunk_tokens[index] + gap_tokens
+            if used + cost <= budget:
+                selected.append(index)
+                used += cost
+        if not selected:
+            return truncate_to_tokens(self.chunks[self.search(query_vector, 1)[0]], budget)
+
+        selected.sort()
+        parts = [self.chunks[selected[0]]]
+        for previous, index in zip(selected, selected[1:]):
+            # neighbouring chunks continue each other, others get a gap marker
+            parts.append(self.chunks[index] if index == previous + 1 else GAP + self.chunks[index])
+        return "".join(parts)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    vectors=self.vectors,
+                    chunks=np.array(json.dumps(self.chunks)),
+                    info=np.array(json.dumps(self.info, default=str))
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "VectorIndex":
+        with np.load(path) as data:
+            return cls(json.loads(str(data["chunks"])), data["vectors"], json.loads(str(data["info"])))
+
+
+class VectorIndexCache:
+    """
+    Vector indexes of attachments keyed by the SHA-256 of the attachment bytes.
+
+    Indexes are saved as .npz files and the most recently used are kept in
+    memory. The embedding model and chunk size are part of the file name, so
+    changing either builds new indexes.
+    """
+
+    def __init__(self, root: str = VECTOR_INDEX_DIR, max_size: int = VECTOR_INDEX_CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], f"{sha256}-{EMBEDDING_MODEL}-{CHUNK_TOKENS}.npz")
+
+    def _remember(self, sha256: str, index: VectorIndex):
+        self._memory[sha256] = index
+        self._memory.move_to_end(sha256)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get(self, sha256: str) -> Optional[VectorIndex]:
+        with self._lock:
+            index = self._memory.get(sha256)
+            if index is not None:
+                self._memory.move_to_end(sha256)
+        if index is None and os.path.exists(self.path_for(sha256)):
+            try:
+                index = VectorIndex.load(self.path_for(sha256))
+            except Exception as e:
+                logger.warning("Ignoring unreadable vector index %s: %s", sha256, e)
+            else:
+                with self._lock:
+                    self._remember(sha256, index)
+        record_cache("vector_index", index is not None)
+        return index
+
+    def put(self, sha256: str, index: VectorIndex):
+        index.save(self.path_for(sha256))
+        with self._lock:
+            self._remember(sha256, index)
+
+
+vector_index_cache = VectorIndexCache()
+
+_query_vectors = OrderedDict()
+
+
+async def build_index(text: str, info: Optional[Dict] = None) -> VectorIndex:
+    """Chunk and embed a document."""
+    chunks = chunk_text(text)
+    vectors = await embed(chunks)
+    return VectorIndex(chunks, np.array(vectors, dtype=np.float32), info)
+
+
+async def embed_query(text: str, try_spend: Optional[Callable[[int], bool]] = None) -> Optional[np.ndarray]:
+    """
+    Embed retrieval query text, remembering recent queries.
+
+    Reusing the vector keeps repeated prompts identical, so they stay AI cache hits.
+
+    Args:
+        try_spend: Called with the tokens to embed; None is returned if it refuses them
+    """
+    text = truncate_to_tokens(text, QUERY_MAX_TOKENS)
+    vector = _query_vectors.get(text)
+    if vector is None:
+        if try_spend is not None and not try_spend(count_tokens(text)):
+            return None
+        vector = np.array((await embed([text]))[0], dtype=np.float32)
+        _query_vectors[text] = vector
+        while len(_query_vectors) > VECTOR_INDEX_CACHE_SIZE * 8:
+            _query_vectors.popitem(last=False)
+    return vector
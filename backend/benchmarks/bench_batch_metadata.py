@@ -0,0 +1,59 @@
+"""
+Benchmark list view metadata fetching: one call per result vs batched requests.
+
+Gmail quota pacing is raised out of the way (like the load suite does), so
+the numbers show round trips rather than the per-user quota.
+
+Usage:
+    python -m benchmarks.bench_batch_metadata [--latency 0.05]
+"""
+import os
+import argparse
+import time
+
+# before the app reads it
+os.environ.setdefault('GMAIL_USER_QUOTA', '1000000')
+
+from app.services.gmail_service import (
+    list_messages, list_threads, batch_get_metadata, METADATA_HEADERS, gmail_upstream
+)
+from benchmarks.fake_gmail import FakeGmailHttp, build_fake_service
+
+
+def sequential(service, ids, resource):
+    collection = getattr(service.users(), resource)()
+    return [
+        collection.get(userId='me', id=item_id, format='metadata').execute()
+        for item_id in ids
+    ]
+
+
+def batched(service, ids, resource):
+    return batch_get_metadata(service, ids, resource, METADATA_HEADERS)
+
+
+def run(latency, sizes):
+    print(f"{'resource':<10}{'max_results':>12}{'mode':>12}{'round trips':>14}{'seconds':>10}")
+    for resource, lister in (('messages', list_messages), ('threads', list_threads)):
+        for size in sizes:
+            for mode, fetch in (('sequential', sequential), ('batched', batched)):
+                http = FakeGmailHttp(latency=latency)
+                service = build_fake_service(http)
+                # each run starts with a full quota
+                gmail_upstream.reset()
+
+                start = time.perf_counter()
+                items = lister(service, '', size)
+                fetch(service, [item['id'] for item in items], resource)
+                elapsed = time.perf_counter() - start
+
+                print(f"{resource:<10}{size:>12}{mode:>12}{http.round_trips:>14}{elapsed:>10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated seconds per HTTP round trip')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 25, 50, 100])
+    args = parser.parse_args()
+    run(args.latency, args.sizes)
@@ -0,0 +1,98 @@
+"""
+Micro-benchmark the MIME walker on large synthetic threads.
+
+Compares the previous list.pop(0) walker that decodes every text part with
+parse_payload, which walks a deque and decodes only the winning body.
+
+Usage:
+    python -m benchmarks.bench_mime_parser [--messages 200 500] [--depth 12]
+"""
+import argparse
+import base64
+import time
+
+from app.services.mime_parser import parse_payload
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode("ascii")
+
+
+def make_payload(index, depth, alternatives, body_size):
+    """A message nested depth levels deep with several plain/html alternatives per level."""
+    text = ("lorem ipsum dolor sit amet " * (body_size // 27 + 1))[:body_size]
+    part = {"mimeType": "application/pdf", "filename": f"doc-{index}.pdf",
+            "body": {"attachmentId": f"att-{index}", "size": 1000}}
+    for level in range(depth):
+        children = [part]
+        for alt in range(alternatives):
+            children.append({"mimeType": "text/plain", "body": {"data": encode(f"{level}-{alt} {text}")}})
+            children.append({"mimeType": "text/html", "body": {"data": encode(f"<p>{level}-{alt} {text}</p>")}})
+        part = {"mimeType": "multipart/mixed", "parts": children}
+    part["headers"] = [
+        {"name": "Subject", "value": f"Message {index}"},
+        {"name": "From", "value": "sender@example.com"},
+    ]
+    return part
+
+
+def legacy_parse(payload):
+    headers = {}
+    for header in payload["headers"]:
+        headers[header["name"]] = header["value"]
+
+    parts = [payload]
+    html_body = None
+    plain_body = None
+    attachments = []
+    while parts:
+        part = parts.pop(0)
+        if "parts" in part:
+            parts.extend(part["parts"])
+            continue
+        mime_type = part.get("mimeType", "")
+        if mime_type == "text/html" and "data" in part.get("body", {}):
+            html_body = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
+        elif mime_type == "text/plain" and "data" in part.get("body", {}) and not html_body:
+            plain_body = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
+        elif "attachmentId" in part.get("body", {}):
+            attachments.append({"id": part["body"]["attachmentId"],
+                                "filename": part.get("filename", ""), "mimeType": mime_type})
+    return headers, html_body or plain_body, attachments
+
+
+def new_parse(payload):
+    parsed = parse_payload(payload)
+    return parsed.headers, parsed.body, [a.to_dict() for a in parsed.attachments]
+
+
+def timed(func, payloads, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for payload in payloads:
+            func(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(message_counts, depth, alternatives, body_size, repeat):
+    print(f"{'messages':>9}{'depth':>7}{'legacy s':>11}{'new s':>9}{'speedup':>9}")
+    for count in message_counts:
+        payloads = [make_payload(i, depth, alternatives, body_size) for i in range(count)]
+        assert all(legacy_parse(p) == new_parse(p) for p in payloads[:5])
+        legacy = timed(legacy_parse, payloads, repeat)
+        new = timed(new_parse, payloads, repeat)
+        print(f"{count:>9}{depth:>7}{legacy:>11.3f}{new:>9.3f}{legacy / new:>8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, nargs="+", default=[100, 300, 600])
+    parser.add_argument("--depth", type=int, default=12)
+    parser.add_argument("--alternatives", type=int, default=3)
+    parser.add_argument("--body-size", type=int, default=4000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.messages, args.depth, args.alternatives, args.body_size, args.repeat)
@@ -0,0 +1,65 @@
+"""
+Benchmark PDF extraction on large documents.
+
+Compares the old approach (temp file, full text built with +=, parsed twice for
+text and info) with the single-pass extract_pdf that stops at the prompt budget.
+
+Usage:
+    python -m benchmarks.bench_pdf_extraction [--pages 100 300 1000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import PyPDF2
+
+from app.services.pdf_service import extract_pdf
+from app.services.ai_service import PDF_CONTEXT_CHARS
+from benchmarks.pdf_fixtures import make_pdf
+
+
+def legacy_extract(data):
+    """Text and info the way the endpoints used to get them."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+        temp_file.write(data)
+        path = temp_file.name
+    try:
+        results = []
+        for _ in range(2):
+            with open(path, "rb") as file:
+                reader = PyPDF2.PdfReader(file)
+                text = ""
+                for page_num in range(len(reader.pages)):
+                    text += reader.pages[page_num].extract_text() + "\n\n"
+                results.append((text, len(text.split())))
+        return results
+    finally:
+        os.remove(path)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run(page_counts, repeat):
+    print(f"{'pages':>6}{'size KB':>10}{'legacy s':>11}{'full s':>9}{'budget s':>10}{'speedup':>9}")
+    for pages in page_counts:
+        data = make_pdf(pages)
+        legacy = min(timed(legacy_extract, data) for _ in range(repeat))
+        full = min(timed(extract_pdf, data) for _ in range(repeat))
+        budget = min(timed(extract_pdf, data, max_chars=PDF_CONTEXT_CHARS) for _ in range(repeat))
+        print(
+            f"{pages:>6}{len(data) / 1024:>10.0f}{legacy:>11.3f}{full:>9.3f}"
+            f"{budget:>10.3f}{legacy / budget:>8.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 300, 1000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.pages, args.repeat)
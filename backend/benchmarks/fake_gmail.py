@@ -0,0 +1,162 @@
+"""
+Fake Gmail transport used by the benchmarks.
+
+FakeGmailHttp stands in for httplib2.Http underneath a real googleapiclient
+service, so requests go through the normal request/batch serialisation code and
+only the network is simulated (a fixed sleep per HTTP round trip).
+"""
+import base64
+import json
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+from app.services.gmail_service import InstrumentedHttpRequest
+from benchmarks.pdf_fixtures import make_pdf
+
+
+BATCH_PART = re.compile(
+    r'Content-ID: <([^>]+)>.*?\r?\n(GET|POST|PUT|DELETE) (\S+) HTTP/1\.1', re.S
+)
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def make_message(message_id, thread_id=None, subject=None, pdf_pages=()):
+    """Build a canned message, with one PDF attachment per entry in pdf_pages."""
+    body = f"Hello,\n\nPlease find message {message_id} attached.\n\nThanks".encode()
+    parts = [{'mimeType': 'text/plain', 'body': {'size': len(body), 'data': encode(body)}}]
+    for index, pages in enumerate(pdf_pages):
+        parts.append({
+            'mimeType': 'application/pdf',
+            'filename': f"document-{index}.pdf",
+            'body': {'attachmentId': f"{message_id}-att-{index}-{pages}", 'size': 0},
+        })
+    return {
+        'id': message_id,
+        'threadId': thread_id or f"t-{message_id}",
+        'historyId': '1000',
+        'internalDate': '1700000000000',
+        'payload': {
+            'mimeType': 'multipart/mixed',
+            'headers': [
+                {'name': 'Subject', 'value': subject or f"Invoice {message_id}"},
+                {'name': 'From', 'value': 'Billing <billing@example.com>'},
+                {'name': 'Date', 'value': 'Tue, 14 Nov 2023 22:13:20 +0000'},
+            ],
+            'parts': parts,
+        },
+    }
+
+
+class FakeGmailHttp:
+    """httplib2.Http replacement that answers Gmail list/get/batch calls."""
+
+    def __init__(self, latency=0.05, messages_per_thread=3, pdf_pages=(), mailbox_size=1000,
+                 pdf_mix=None):
+        self.latency = latency
+        self.mailbox_size = mailbox_size
+        self.messages_per_thread = messages_per_thread
+        self.pdf_pages = pdf_pages
+        # optional list of pdf_pages tuples, cycled through by message number
+        self.pdf_mix = pdf_mix
+        self.round_trips = 0
+        self._pdfs = {}
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.round_trips += 1
+        time.sleep(self.latency)
+
+        parsed = urlparse(uri)
+        if parsed.path.startswith('/batch'):
+            return self._batch(body)
+        status, payload = self._dispatch(parsed.path, parse_qs(parsed.query))
+        return self._response(status, 'application/json'), json.dumps(payload).encode()
+
+    def _dispatch(self, path, query):
+        parts = path.rstrip('/').split('/')
+        # /gmail/v1/users/me/<resource>[/<id>]
+        resource = parts[5] if len(parts) > 5 else ''
+        item_id = parts[6] if len(parts) > 6 else None
+        max_results = int(query.get('maxResults', ['10'])[0])
+        # page tokens are just the offset of the next page
+        offset = int(query.get('pageToken', ['0'])[0])
+        end = min(offset + max_results, self.mailbox_size)
+        page = {'nextPageToken': str(end)} if end < self.mailbox_size else {}
+
+        if resource == 'profile':
+            return 200, {'emailAddress': 'bench@example.com', 'historyId': '1000'}
+        if resource == 'history':
+            return 200, {'history': [], 'historyId': '1000'}
+        if resource == 'messages' and item_id is None:
+            return 200, {'messages': [
+                {'id': f"m{i}", 'threadId': f"t{i}"} for i in range(offset, end)
+            ], **page}
+        if resource == 'messages' and len(parts) > 8 and parts[7] == 'attachments':
+            # attachment ids end with the page count of the PDF they stand for
+            pages = int(parts[8].rsplit('-', 1)[1])
+            if pages not in self._pdfs:
+                self._pdfs[pages] = encode(make_pdf(pages))
+            return 200, {'size': len(self._pdfs[pages]), 'data': self._pdfs[pages]}
+        if resource == 'messages':
+            return 200, make_message(item_id, pdf_pages=self._pdf_pages(item_id))
+        if resource == 'threads' and item_id is None:
+            return 200, {'threads': [
+                {'id': f"t{i}", 'snippet': f"snippet {i}"} for i in range(offset, end)
+            ], **page}
+        if resource == 'threads':
+            return 200, {
+                'id': item_id,
+                'historyId': '1000',
+                'messages': [
+                    make_message(f"{item_id}-{i}", item_id, pdf_pages=self._pdf_pages(f"{item_id}-{i}"))
+                    for i in range(self.messages_per_thread)
+                ],
+            }
+        return 404, {'error': {'code': 404, 'message': 'Not found'}}
+
+    def _pdf_pages(self, message_id):
+        if not self.pdf_mix:
+            return self.pdf_pages
+        number = int(''.join(c for c in message_id if c.isdigit()) or 0)
+        return self.pdf_mix[number % len(self.pdf_mix)]
+
+    def _batch(self, body):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+
+        boundary = 'batch_fake_boundary'
+        chunks = []
+        for content_id, _method, path in BATCH_PART.findall(body):
+            parsed = urlparse(path)
+            status, payload = self._dispatch(parsed.path, parse_qs(parsed.query))
+            chunks.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        content = ''.join(chunks) + f"--{boundary}--"
+        return (
+            self._response(200, f"multipart/mixed; boundary={boundary}"),
+            content.encode('utf-8'),
+        )
+
+    @staticmethod
+    def _response(status, content_type):
+        return httplib2.Response({'status': status, 'content-type': content_type})
+
+
+def build_fake_service(http):
+    """Build a real Gmail service object on top of a fake transport."""
+    return build_from_document(
+        get_static_doc('gmail', 'v1'), http=http, requestBuilder=InstrumentedHttpRequest
+    )
@@ -0,0 +1,117 @@
+"""
+Fake async OpenAI client used by the benchmarks.
+
+Mimics the parts of openai.AsyncOpenAI the services use and answers with a
+deterministic completion after a configurable delay, as JSON holding the
+requested fields when a JSON schema response format is given. Embeddings are
+hashed bags of words, so texts sharing words come out similar.
+"""
+import re
+import json
+import asyncio
+import hashlib
+from types import SimpleNamespace
+
+
+COMPLETION = (
+    "The sender shares an invoice for November and asks for payment.\n\n"
+    "- Invoice total is due in 30 days\n- Payment details are attached\n\n"
+    "Thank them, confirm receipt and give an expected payment date."
+)
+
+STRUCTURED_COMPLETION = {
+    "summary": "The sender shares an invoice for November and asks for payment.",
+    "key_points": ["Invoice total is due in 30 days", "Payment details are attached"],
+    "action_items": ["Confirm receipt of the invoice", "Schedule the payment"],
+    "suggested_response": "Thank them, confirm receipt and give an expected payment date.",
+}
+
+
+def completion_for(response_format=None):
+    """The completion text, as JSON with the schema's required fields for json_schema formats."""
+    if not response_format or response_format.get("type") != "json_schema":
+        return COMPLETION
+    fields = response_format["json_schema"]["schema"]["required"]
+    return json.dumps({name: STRUCTURED_COMPLETION.get(name, "") for name in fields})
+
+
+EMBEDDING_DIMENSIONS = 256
+
+
+def fake_embedding(text):
+    """Deterministic unit vector that counts each word into a hashed dimension."""
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for word in re.findall(r"\w+", text.lower()):
+        bucket = int.from_bytes(hashlib.md5(word.encode()).digest()[:4], "little")
+        vector[bucket % EMBEDDING_DIMENSIONS] += 1.0
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+class _Embeddings:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def create(self, model, input, **kwargs):
+        self.calls += 1
+        texts = [input] if isinstance(input, str) else input
+        await asyncio.sleep(self.latency / 10)
+        tokens = sum(len(text.split()) for text in texts)
+        return SimpleNamespace(
+            model=model,
+            data=[
+                SimpleNamespace(index=index, embedding=fake_embedding(text))
+                for index, text in enumerate(texts)
+            ],
+            usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens),
+        )
+
+
+class _Completions:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def create(self, model, messages, max_tokens=None, stream=False, response_format=None, **kwargs):
+        self.calls += 1
+        content = completion_for(response_format)
+        prompt_tokens = sum(len(m["content"].split()) for m in messages)
+        completion_tokens = len(content.split())
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        )
+        if stream:
+            return self._stream(model, content, usage)
+
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(
+                index=0,
+                finish_reason="stop",
+                message=SimpleNamespace(role="assistant", content=content),
+            )],
+            usage=usage,
+        )
+
+    async def _stream(self, model, content, usage):
+        # spread the latency over the words, like tokens arriving from the API
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            await asyncio.sleep(self.latency / len(words))
+            delta = word if index == 0 else " " + word
+            yield SimpleNamespace(
+                model=model,
+                usage=None,
+                choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=delta))],
+            )
+        yield SimpleNamespace(model=model, usage=usage, choices=[])
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, latency=1.0):
+        self.chat = SimpleNamespace(completions=_Completions(latency))
+        self.embeddings = _Embeddings(latency)
@@ -0,0 +1,214 @@
+"""
+Local HTTP stand-ins for the Gmail and OpenAI APIs.
+
+The app talks to them over real sockets: point GMAIL_API_ROOT_URL at the Gmail
+server (the bundled discovery document is rewritten to use it) and
+OPENAI_BASE_URL at the OpenAI server. Both answer from canned data after a
+configurable delay.
+
+Usage:
+    python -m benchmarks.fake_servers [--gmail-latency 0.05] [--openai-latency 1]
+"""
+import argparse
+import base64
+import json
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.fake_gmail import FakeGmailHttp
+from benchmarks.fake_openai import completion_for, fake_embedding
+from benchmarks.pdf_fixtures import PDF_CORPUS
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else None
+
+    def send(self, status, content_type, content):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class GmailHandler(_QuietHandler):
+    """Serves Gmail API calls (and the OAuth token endpoint) from a FakeGmailHttp."""
+
+    fake = None
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def handle_api(self, method):
+        body = self.read_body()
+        if self.path.startswith("/token"):
+            payload = {"access_token": "fake-access-token", "expires_in": 3600, "token_type": "Bearer"}
+            return self.send(200, "application/json", json.dumps(payload).encode())
+
+        response, content = self.fake.request(
+            f"http://{self.headers.get('Host')}{self.path}", method, body, dict(self.headers)
+        )
+        self.send(int(response.status), response["content-type"], content)
+
+
+class OpenAIHandler(_QuietHandler):
+    """
+    Serves /v1/chat/completions with a deterministic completion, streamed or not,
+    and /v1/embeddings with hashed bag-of-words vectors.
+    """
+
+    latency = 1.0
+    calls = 0
+
+    def do_POST(self):
+        if self.path.endswith("/embeddings"):
+            return self.embeddings(json.loads(self.read_body() or b"{}"))
+        if not self.path.endswith("/chat/completions"):
+            return self.send(404, "application/json", b'{"error": {"message": "Not found"}}')
+
+        request = json.loads(self.read_body() or b"{}")
+        type(self).calls += 1
+        content = completion_for(request.get("response_format"))
+        prompt_tokens = sum(len(m["content"].split()) for m in request.get("messages", []))
+        completion_tokens = len(content.split())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": request.get("model")}
+
+        if request.get("stream"):
+            return self.stream(base, content, usage, request.get("stream_options") or {})
+
+        time.sleep(self.latency)
+        payload = {
+            **base,
+            "object": "chat.completion",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }],
+            "usage": usage,
+        }
+        self.send(200, "application/json", json.dumps(payload).encode())
+
+    def embeddings(self, request):
+        texts = request.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+        time.sleep(self.latency / 10)
+        tokens = sum(len(text.split()) for text in texts)
+        vectors = [fake_embedding(text) for text in texts]
+        if request.get("encoding_format") == "base64":
+            # the SDK asks for packed little-endian float32 by default
+            vectors = [
+                base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode()
+                for vector in vectors
+            ]
+        payload = {
+            "object": "list",
+            "model": request.get("model"),
+            "data": [
+                {"object": "embedding", "index": index, "embedding": vector}
+                for index, vector in enumerate(vectors)
+            ],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+        self.send(200, "application/json", json.dumps(payload).encode())
+
+    def stream(self, base, content, usage, stream_options):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(data):
+            line = f"data: {data}\n\n".encode()
+            self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.flush()
+
+        # spread the latency over the words, like tokens arriving from the API
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            delta = word if index == 0 else " " + word
+            event(json.dumps({
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+            }))
+        if stream_options.get("include_usage"):
+            event(json.dumps({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}))
+        event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_server(handler, port=0):
+    """Start a threaded HTTP server in the background and return (server, base url)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_fake_gmail(latency=0.05, mailbox_size=1000, messages_per_thread=3, pdf_mix=None, port=0):
+    """
+    Start the fake Gmail API server.
+
+    Messages cycle through the PDF corpus by default: none, small, medium,
+    large and huge attachments.
+    """
+    if pdf_mix is None:
+        pdf_mix = [()] + [(pages,) for pages in PDF_CORPUS.values()]
+    fake = FakeGmailHttp(
+        latency=latency,
+        mailbox_size=mailbox_size,
+        messages_per_thread=messages_per_thread,
+        pdf_mix=pdf_mix,
+    )
+    handler = type("BoundGmailHandler", (GmailHandler,), {"fake": fake})
+    server, url = start_server(handler, port)
+    return server, url, fake
+
+
+def start_fake_openai(latency=1.0, port=0):
+    """Start the fake OpenAI API server; the base URL to use ends in /v1."""
+    handler = type("BoundOpenAIHandler", (OpenAIHandler,), {"latency": latency})
+    server, url = start_server(handler, port)
+    return server, f"{url}/v1", handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--gmail-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--gmail-port", type=int, default=8081)
+    parser.add_argument("--openai-port", type=int, default=8082)
+    args = parser.parse_args()
+
+    _, gmail_url, _ = start_fake_gmail(args.gmail_latency, port=args.gmail_port)
+    _, openai_url, _ = start_fake_openai(args.openai_latency, port=args.openai_port)
+    print(f"GMAIL_API_ROOT_URL={gmail_url}")
+    print(f"OPENAI_BASE_URL={openai_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
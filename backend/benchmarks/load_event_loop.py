@@ -0,0 +1,101 @@
+"""
+Load test: /api/emails latency while /api/ai/analyze calls are in flight.
+
+Gmail and OpenAI are replaced with fakes that only add latency, so the numbers
+show whether slow upstream calls hold up the event loop for other requests.
+Gmail quota pacing is raised out of the way, like the load suite does.
+
+Usage:
+    python -m benchmarks.load_event_loop [--analyze 8] [--openai-latency 2]
+"""
+import os
+import tempfile
+os.environ.setdefault("SESSION_BACKEND", "memory")
+# before the app reads it
+os.environ.setdefault("GMAIL_USER_QUOTA", "1000000")
+_data_dir = tempfile.mkdtemp()
+os.environ.setdefault("MESSAGE_STORE_PATH", os.path.join(_data_dir, "messages.db"))
+os.environ.setdefault("AI_CACHE_PATH", os.path.join(_data_dir, "ai_cache.db"))
+
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+from app.main import app
+from app.api.emails import get_gmail_service, get_account
+from app.services import ai_service
+from app.services.gmail_service import gmail_upstream
+from benchmarks.fake_gmail import FakeGmailHttp, build_fake_service
+from benchmarks.fake_openai import FakeAsyncOpenAI
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def timed_get(client, url):
+    start = time.perf_counter()
+    response = await client.get(url)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def list_emails_load(client, requests, concurrency):
+    # each run starts with a full quota
+    gmail_upstream.reset()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            # vary the query so every request goes through to (fake) Gmail
+            query = f"bench-{uuid.uuid4().hex}"
+            return await timed_get(client, f"/api/emails?max_results=10&query={query}")
+
+    return await asyncio.gather(*(one() for _ in range(requests)))
+
+
+def report(label, latencies):
+    print(
+        f"{label:<28} n={len(latencies):<4} "
+        f"p50={statistics.median(latencies) * 1000:8.1f}ms "
+        f"p99={percentile(latencies, 99) * 1000:8.1f}ms"
+    )
+
+
+async def run(args):
+    service = build_fake_service(FakeGmailHttp(latency=args.gmail_latency))
+    app.dependency_overrides[get_gmail_service] = lambda: service
+    app.dependency_overrides[get_account] = lambda: "bench@example.com"
+    ai_service._client = FakeAsyncOpenAI(latency=args.openai_latency)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        baseline = await list_emails_load(client, args.requests, args.concurrency)
+        report("/api/emails (idle)", baseline)
+
+        analyze = [
+            asyncio.create_task(timed_get(client, f"/api/ai/analyze/m{i}"))
+            for i in range(args.analyze)
+        ]
+        # let the analyze calls reach the model before measuring
+        await asyncio.sleep(args.gmail_latency * 2)
+        loaded = await list_emails_load(client, args.requests, args.concurrency)
+        report(f"/api/emails ({args.analyze} analyzing)", loaded)
+        report("/api/ai/analyze", await asyncio.gather(*analyze))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--analyze", type=int, default=8,
+                        help="number of concurrent /api/ai/analyze calls")
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=2.0)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,361 @@
+"""
+Load suite: throughput and latency of every API route against local fakes.
+
+Starts the fake Gmail and OpenAI servers, runs the app from app/main.py under
+uvicorn in a subprocess pointed at them (or app/serve.py with --workers), and
+drives each route with concurrent requests. Results are written as JSON so runs can be compared between releases.
+
+Each route spreads its requests over a pool of ids, so the numbers mix cold
+(Gmail/model) and warm (store/cache) requests the way real traffic does.
+
+Usage:
+    python -m benchmarks.load_suite [--requests 200] [--concurrency 16]
+        [--routes analyze] [--workers 4] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+from app.services.session_store import SQLiteSessionStore, new_session_id
+from benchmarks.fake_servers import start_fake_gmail, start_fake_openai
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+
+
+def route_table(ids):
+    """
+    (name, method, url factory, json body) for every API route.
+
+    The OAuth routes are left out: they redirect to Google.
+    """
+    def message(i):
+        return f"m{i % ids}"
+
+    def thread(i):
+        return f"t{i % ids}"
+
+    return [
+        ("root", "GET", lambda i: "/", None),
+        ("list_emails", "GET", lambda i: f"/api/emails?max_results=20&query=q{i % ids}", None),
+        ("list_emails_stream", "GET", lambda i: f"/api/emails?stream=true&max_results=50&limit=200&query=s{i % ids}", None),
+        ("get_email", "GET", lambda i: f"/api/emails/{message(i)}", None),
+        # m1 carries a one page PDF in the default corpus
+        ("download_attachment", "GET", lambda i: "/api/emails/m1/attachments/m1-att-0-1", None),
+        ("list_threads", "GET", lambda i: f"/api/threads?max_results=20&query=q{i % ids}", None),
+        ("list_threads_stream", "GET", lambda i: f"/api/threads?stream=true&max_results=50&limit=200&query=s{i % ids}", None),
+        ("get_thread", "GET", lambda i: f"/api/threads/{thread(i)}", None),
+        ("analyze", "GET", lambda i: f"/api/ai/analyze/{message(i)}", None),
+        ("analyze_stream", "GET", lambda i: f"/api/ai/analyze/{message(i)}/stream", None),
+        ("generate_response", "GET", lambda i: f"/api/ai/generate-response/{message(i)}", None),
+        ("generate_response_stream", "GET", lambda i: f"/api/ai/generate-response/{message(i)}/stream", None),
+        ("analyze_thread", "GET", lambda i: f"/api/ai/analyze-thread/{thread(i)}", None),
+        ("batch_create", "POST", lambda i: "/api/ai/batch",
+         lambda i: {"ids": [message(i + n) for n in range(5)], "mode": "concurrent"}),
+        ("batch_status", "GET", None, None),
+        ("cache_stats", "GET", lambda i: "/api/ai/cache/stats", None),
+        ("metrics", "GET", lambda i: "/metrics", None),
+    ]
+
+
+def create_session(data_dir, gmail_url):
+    """
+    Store a session holding credentials for the fake Gmail server.
+
+    Returns:
+        The session id to send as the session cookie
+    """
+    session = {
+        "credentials": {
+            "token": "fake-access-token",
+            "refresh_token": "fake-refresh-token",
+            "token_uri": f"{gmail_url}/token",
+            "client_id": "load-suite",
+            "client_secret": "load-suite",
+            "scopes": ["https://www.googleapis.com/auth/gmail.readonly"],
+            "expiry": "2999-01-01T00:00:00Z",
+        }
+    }
+    session_id = new_session_id()
+    SQLiteSessionStore(os.path.join(data_dir, "sessions.db")).set(session_id, session)
+    return session_id
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(port, gmail_url, openai_url, data_dir, workers=1):
+    """
+    Run the app under uvicorn in a subprocess, with its data files in data_dir.
+
+    With several workers it runs through the production entry point, sharing
+    state between them through the SQLite files.
+    """
+    env = {
+        **os.environ,
+        "SESSION_BACKEND": "sqlite",
+        "SESSION_STORE_PATH": os.path.join(data_dir, "sessions.db"),
+        "GMAIL_API_ROOT_URL": gmail_url,
+        "OPENAI_BASE_URL": openai_url,
+        "OPENAI_API_KEY": "fake",
+        "MESSAGE_STORE_PATH": os.path.join(data_dir, "messages.db"),
+        "AI_CACHE_PATH": os.path.join(data_dir, "ai_cache.db"),
+        # one simulated user makes far more calls than real quotas allow; the
+        # fake servers have no quotas, so measure the app rather than the pacing
+        "GMAIL_USER_QUOTA": "1000000",
+        "OPENAI_RPM": "1000000",
+        "OPENAI_TPM": "1000000000",
+        "PYTHONPATH": BACKEND_DIR,
+    }
+    if workers > 1:
+        env.update({
+            "STATE_BACKEND": "sqlite",
+            "WEB_CONCURRENCY": str(workers),
+            "HOST": "127.0.0.1",
+            "PORT": str(port),
+            "LOG_LEVEL": "warning",
+        })
+        # in its own process group, so the workers can be stopped along with it
+        return subprocess.Popen(
+            [sys.executable, "-m", "app.serve"], cwd=data_dir, env=env, start_new_session=True
+        )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--app-dir", BACKEND_DIR,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=data_dir, env=env
+    )
+
+
+async def wait_until_ready(client, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app exited with code {process.returncode}")
+        try:
+            await client.get("/")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("app did not start in time")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def one_request(client, method, url, body):
+    """Send one request, reading the whole body; returns (status, ttfb, total) in seconds."""
+    start = time.perf_counter()
+    ttfb = None
+    async with client.stream(method, url, json=body) as response:
+        async for _ in response.aiter_raw():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+    total = time.perf_counter() - start
+    return response.status_code, ttfb if ttfb is not None else total, total
+
+
+async def run_route(client, method, url_for, body_for, requests, concurrency):
+    """Drive one route with bounded concurrency and summarize the latencies."""
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+    ttfbs = []
+    totals = []
+    failures = 0
+
+    async def worker(i):
+        nonlocal failures
+        async with semaphore:
+            try:
+                status, ttfb, total = await one_request(
+                    client, method, url_for(i), body_for(i) if body_for else None
+                )
+            except httpx.HTTPError:
+                failures += 1
+                return
+            statuses[status] = statuses.get(status, 0) + 1
+            ttfbs.append(ttfb)
+            totals.append(total)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+
+    errors = failures + sum(count for status, count in statuses.items() if status >= 400)
+    result = {
+        "requests": requests,
+        "errors": errors,
+        "status_codes": {str(status): count for status, count in sorted(statuses.items())},
+        "throughput_rps": round(requests / elapsed, 2),
+    }
+    if totals:
+        result.update({
+            "p50_ms": round(percentile(totals, 50) * 1000, 2),
+            "p90_ms": round(percentile(totals, 90) * 1000, 2),
+            "p99_ms": round(percentile(totals, 99) * 1000, 2),
+            "mean_ms": round(sum(totals) / len(totals) * 1000, 2),
+            "max_ms": round(max(totals) * 1000, 2),
+            "ttfb_p50_ms": round(percentile(ttfbs, 50) * 1000, 2),
+        })
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Print per-route changes against a baseline run.
+
+    Returns:
+        Names of routes whose p50, p99 or throughput got worse by more than threshold percent
+    """
+    regressions = []
+    if baseline.get("meta", {}).get("config") != results["meta"]["config"]:
+        print("\nwarning: the baseline was run with a different configuration")
+    print(f"\n{'route':<26} {'p50':>16} {'p99':>16} {'rps':>16}")
+    for name, current in results["routes"].items():
+        previous = baseline.get("routes", {}).get(name)
+        if not previous or "p50_ms" not in current or "p50_ms" not in previous:
+            continue
+        cells = []
+        regressed = False
+        for key, higher_is_worse in (("p50_ms", True), ("p99_ms", True), ("throughput_rps", False)):
+            change = (current[key] - previous[key]) / previous[key] * 100 if previous[key] else 0.0
+            worse = change if higher_is_worse else -change
+            regressed = regressed or worse > threshold
+            cells.append(f"{previous[key]:.1f}->{current[key]:.1f} ({change:+.0f}%)")
+        print(f"{name:<26} " + " ".join(f"{cell:>16}" for cell in cells) + ("  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+async def run_suite(args):
+    gmail_server, gmail_url, _ = start_fake_gmail(args.gmail_latency, mailbox_size=args.mailbox_size)
+    openai_server, openai_url, _ = start_fake_openai(args.openai_latency)
+    data_dir = tempfile.mkdtemp(prefix="load-suite-")
+    port = free_port()
+    session_id = create_session(data_dir, gmail_url)
+    process = start_app(port, gmail_url, openai_url, data_dir, args.workers)
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "ids": args.ids,
+                "gmail_latency": args.gmail_latency,
+                "openai_latency": args.openai_latency,
+                "mailbox_size": args.mailbox_size,
+                "workers": args.workers,
+            },
+        },
+        "routes": {},
+    }
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}",
+            cookies={"session": session_id},
+            timeout=args.timeout,
+            limits=limits,
+        ) as client:
+            await wait_until_ready(client, process)
+
+            # a job to poll for the batch_status route
+            job = (await client.post("/api/ai/batch", json={"ids": ["m0"], "mode": "concurrent"})).json()
+
+            for name, method, url_for, body_for in route_table(args.ids):
+                if args.routes and not any(pattern in name for pattern in args.routes):
+                    continue
+                if name == "batch_status":
+                    url_for = lambda i: f"/api/ai/batch/{job['job_id']}"
+                result = await run_route(client, method, url_for, body_for, args.requests, args.concurrency)
+                results["routes"][name] = result
+                print(
+                    f"{name:<26} {result['throughput_rps']:8.1f} req/s  "
+                    f"p50={result.get('p50_ms', 0):8.1f}ms  p99={result.get('p99_ms', 0):8.1f}ms  "
+                    f"errors={result['errors']}"
+                )
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        if args.workers > 1:
+            # workers still finishing background jobs outlive the parent
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        gmail_server.shutdown()
+        openai_server.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load suite for every API route")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--ids", type=int, default=50, help="distinct message/thread ids per route")
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--mailbox-size", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--workers", type=int, default=1, help="app worker processes")
+    parser.add_argument("--routes", nargs="*", help="only run routes whose name contains one of these")
+    parser.add_argument("--output", help="results file (default benchmarks/results/load-<time>.json)")
+    parser.add_argument("--compare", help="baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_suite(args))
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} route(s) regressed by more than {args.threshold:.0f}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Synthetic PDF fixtures for the benchmarks.
+
+make_pdf writes a minimal but valid text PDF directly, so no PDF library is
+needed to produce large documents.
+"""
+import random
+
+
+WORDS = (
+    "agreement invoice payment party term clause schedule amount due date "
+    "service delivery notice period liability warranty contract supplier "
+    "customer total tax shipping order quantity price signature effective"
+).split()
+
+
+# page counts of the synthetic attachment corpus, from a short letter to a long contract
+PDF_CORPUS = {
+    "small": 1,
+    "medium": 20,
+    "large": 150,
+    "huge": 600,
+}
+
+
+def page_lines(rng, lines_per_page, words_per_line):
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(words_per_line))
+        for _ in range(lines_per_page)
+    ]
+
+
+def make_pdf(pages, lines_per_page=45, words_per_line=12, seed=0):
+    """Build a PDF with the given number of pages of random words."""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+
+    kids = []
+    for _ in range(pages):
+        lines = page_lines(rng, lines_per_page, words_per_line)
+        content = "BT /F1 10 Tf 40 760 Td 14 TL\n"
+        content += "".join(f"({line}) Tj T*\n" for line in lines)
+        content += "ET"
+        content = content.encode("latin-1")
+
+        page_number = len(objects) + 1
+        content_number = page_number + 1
+        kids.append(f"{page_number} 0 R")
+        objects.append(
+            (
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                "/Resources << /Font << /F1 3 0 R >> >> "
+                f"/Contents {content_number} 0 R >>"
+            ).encode("latin-1")
+        )
+        objects.append(
+            f"<< /Length {len(content)} >>\nstream\n".encode("latin-1")
+            + content
+            + b"\nendstream"
+        )
+
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode("latin-1")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode("latin-1") + body + b"\nendobj\n"
+
+    xref_offset = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n".encode("latin-1")
+    out += b"0000000000 65535 f \n"
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("latin-1")
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode("latin-1")
+    return bytes(out)
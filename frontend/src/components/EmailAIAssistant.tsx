@@ -111,10 +111,24 @@ export default function EmailAIAssistant({emailId}: EmailAIAssistantProps) {
                   <h3 className="text-lg font-medium text-gray-900 mb-2">
                     Key Points
                   </h3>
-                  <p className="text-gray-600 whitespace-pre-line">
-                    {analysis.email_analysis.key_points}
-                  </p>
+                  <ul className="list-disc pl-5 text-gray-600">
+                    {analysis.email_analysis.key_points.map((point, index) => (
+                      <li key={index}>{point}</li>
+                    ))}
+                  </ul>
                 </div>
+                {analysis.email_analysis.action_items.length > 0 && (
+                  <div>
+                    <h3 className="text-lg font-medium text-gray-900 mb-2">
+                      Action Items
+                    </h3>
+                    <ul className="list-disc pl-5 text-gray-600">
+                      {analysis.email_analysis.action_items.map((item, index) => (
+                        <li key={index}>{item}</li>
+                      ))}
+                    </ul>
+                  </div>
+                )}
                 <div>
                   <h3 className="text-lg font-medium text-gray-900 mb-2">
                     Suggested Next Steps
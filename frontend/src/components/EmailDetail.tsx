@@ -34,8 +34,13 @@ export default function EmailDetail({emailId, onBack}: EmailDetailProps) {
 
   const handleDownloadAttachment =  async (attachment: Attachment) => {
     try {
-      const response = await apiService.downloadAttachment(email.emailId, attachment.id);
-      console.log('Downloaded attachment: ', response);
+      const blob = await apiService.downloadAttachment(email.emailId, attachment.id);
+      const url = URL.createObjectURL(blob);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = attachment.filename;
+      link.click();
+      URL.revokeObjectURL(url);
     } catch (error) {
       console.error('Failed to download attachment: ', error);
     }
@@ -1,5 +1,6 @@
 export interface EmailListResponse {
   messages: EmailPreview[];
+  nextPageToken?: string | null;
 }
 
 export interface EmailPreview {
@@ -28,14 +29,14 @@ export interface Attachment {
 export interface AIAnalysis {
   email_analysis: {
     summary: string;
-    key_points: string;
+    key_points: string[];
+    action_items: string[];
     suggested_response: string;
-    full_analysis: string;
   };
   pdf_summary?: {
     page_count: number;
-    word_count: number;
-    char_count: number;
+    extracted_words: number;
+    extracted_chars: number;
     filename: string;
     title?: string;
     author?: string;
@@ -50,6 +51,7 @@ export interface AIResponse {
 
 export interface ThreadListResponse {
   threads: ThreadPreview[];
+  nextPageToken?: string | null;
 }
 
 export interface ThreadPreview {
@@ -68,6 +70,23 @@ export interface Thread {
   snippet: string;
 }
 
+export interface SearchHit {
+  messageId: string;
+  attachmentId: string | null;
+  threadId: string | null;
+  date: string | null;
+  subject: string;
+  from: string;
+  filename: string | null;
+  snippet: string;
+  score: number;
+}
+
+export interface SearchResponse {
+  query: string;
+  results: SearchHit[];
+}
+
 
 class ApiService {
   private baseUrl: string;
@@ -109,14 +128,27 @@ class ApiService {
     return response.json();
   }
 
-  async downloadAttachment(emailId: string, attachmentId: string): Promise<any> {
+  async search(query: string, scope: 'all' | 'messages' | 'attachments' = 'all', limit = 20): Promise<SearchResponse> {
+    const response = await fetch(
+      `${this.baseUrl}/api/search?q=${encodeURIComponent(query)}&scope=${scope}&limit=${limit}`, {
+        credentials: 'include',
+      }
+    );
+
+    if (!response.ok) {
+      throw new Error(`Failed to search emails: ${response.statusText}`);
+    }
+    return response.json();
+  }
+
+  async downloadAttachment(emailId: string, attachmentId: string): Promise<Blob> {
     const response = await fetch(`${this.baseUrl}/api/emails/${emailId}/attachments/${attachmentId}`, {
       credentials: 'include',
     });
     if (!response.ok) {
       throw new Error(`Failed to download attachment: ${response.statusText}`);
     }
-    return response.json();
+    return response.blob();
   }
 
   async analyzeEmail(emailId: string, includeAttachments = true): Promise<AIAnalysis> {